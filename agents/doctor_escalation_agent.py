@@ -1,9 +1,68 @@
 # agents/doctor_escalation_agent.py
-from utils import now_ts
+import heapq
+import threading
+from datetime import datetime, timedelta
+import pandas as pd
+from utils import now_ts, load_clinical_rules
+
+
+class DoctorScheduler:
+    """
+    Tele-consult slot scheduler over the doctor roster.
+
+    Keeps one min-heap of (next free slot, doctor_id) per specialty, so booking the
+    earliest slot is a pop and a push. Booking is serialised by a lock, so concurrent
+    escalations never receive the same slot.
+    """
+
+    def __init__(self, doctors_csv='data/doctors.csv', slot_minutes=30, rules_csv='data/clinical_rules.csv'):
+        roster = pd.read_csv(doctors_csv)
+        self.rules = load_clinical_rules(rules_csv)
+        self.slot = timedelta(minutes=slot_minutes)
+        self.doctors = {}
+        self._queues = {}
+        self._lock = threading.Lock()
+        for doc_id, name, specialty, first_slot in zip(roster['doctor_id'], roster['name'],
+                                                        roster['specialty'], roster['tele_slot_iso8601']):
+            self.doctors[doc_id] = {"doctor_id": doc_id, "name": name, "specialty": specialty}
+            self._queues.setdefault(specialty.lower(), []).append((datetime.fromisoformat(first_slot), doc_id))
+        for q in self._queues.values():
+            heapq.heapify(q)
+
+    def specialties_for(self, reasons):
+        """Preferred specialties for a list of escalation reasons, most specific first."""
+        wanted = []
+        for r in self.rules.find(" ".join(reasons), rule='specialty'):
+            if r['value'] not in wanted:
+                wanted.append(r['value'])
+        return wanted + ["general"]
+
+    def book(self, specialties, not_before=None):
+        """
+        Book the earliest free slot with the first specialty that has doctors on the roster.
+        Slots that already passed `not_before` are moved forward along the doctor's slot grid.
+        """
+        with self._lock:
+            q = next((self._queues[s.lower()] for s in specialties if self._queues.get(s.lower())), None)
+            if q is None:
+                q = next((q for q in self._queues.values() if q), None)
+            if q is None:
+                return None
+            if not_before is not None:
+                while q[0][0] < not_before:
+                    free_at, doc_id = heapq.heappop(q)
+                    skipped = -((free_at - not_before) // self.slot)
+                    heapq.heappush(q, (free_at + skipped * self.slot, doc_id))
+            slot, doc_id = heapq.heappop(q)
+            heapq.heappush(q, (slot + self.slot, doc_id))
+        return dict(self.doctors[doc_id], tele_slot=slot.isoformat())
+
 
 class DoctorEscalationAgent:
-    def __init__(self, event_log=None):
+    def __init__(self, event_log=None, scheduler=None, rules_csv='data/clinical_rules.csv'):
         self.log = event_log
+        self.rules = load_clinical_rules(rules_csv)
+        self.scheduler = scheduler or DoctorScheduler(rules_csv=rules_csv)
 
     def evaluate(self, imaging, therapy, patient):
         """
@@ -27,8 +86,7 @@ class DoctorEscalationAgent:
             escalation_reasons.extend(therapy["red_flags"])
 
         # Patient-based rules
-        notes = (patient.get("notes") or "").lower()
-        if "chest pain" in notes or "shortness of breath" in notes:
+        if self.rules.find(patient.get("notes"), rule='red_flag'):
             escalation_reasons.append("Patient symptoms indicate urgent care needed.")
 
         # If no OTC available for pneumonia/covid
@@ -40,12 +98,8 @@ class DoctorEscalationAgent:
         # If escalation is recommended, assign a doctor
         doctor_info = None
         if recommended:
-            # Simple mock roster pick
-            doctor_info = {
-                "doctor_id": "doc001" if "pneumonia" in escalation_reasons[0] else "doc002",
-                "name": "Dr. A Chopra" if "pneumonia" in escalation_reasons[0] else "Dr. S Patel",
-                "tele_slot": "2025-10-01T09:00:00"
-            }
+            specialties = self.scheduler.specialties_for(escalation_reasons)
+            doctor_info = self.scheduler.book(specialties, not_before=datetime.now())
 
         output = {
             "recommended": recommended,
@@ -1,26 +1,126 @@
 # agents/imaging_agent.py
+import asyncio
+import contextvars
+import hashlib
+import io
+import json
 import numpy as np
 import os
-from utils import now_ts
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from PIL import Image
+from utils import now_ts, load_clinical_rules, file_sha256, LRUCache
+from tracing import batch_span, span
 
 try:
+    import tensorflow as tf
     from tensorflow.keras.models import load_model
-    from tensorflow.keras.preprocessing import image
 
     TF_AVAILABLE = True
 except ImportError:
     TF_AVAILABLE = False
 
 
+def severity_from_probs(probs):
+    # Severity heuristic (just a rule on pneumonia prob)
+    severity = "mild"
+    if probs["pneumonia"] > 0.5:
+        severity = "moderate"
+    if probs["pneumonia"] > 0.75:
+        severity = "severe"
+    return severity
+
+
+def decode_xray(source, target_size=(64, 64)):
+    """
+    Decode an image (path, file object or bytes) to a uint8 HxWx3 array.
+    Same preprocessing as keras load_img: RGB, nearest-neighbour resize.
+    """
+    img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img = img.resize(target_size, Image.NEAREST)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def load_xray_array(source, target_size=(64, 64)):
+    """decode_xray scaled to float32 in [0, 1], the CNN's input format."""
+    return decode_xray(source, target_size).astype(np.float32) / 255.0
+
+
+def configure_tf_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Set TensorFlow's op thread pools. This only works before the TF runtime starts, so it
+    must run before the first model is loaded in the process. With N inference workers on
+    a node, intra_op_threads = cores // N and inter_op_threads = 1 avoid oversubscription.
+    Returns False if the runtime was already initialised.
+    """
+    try:
+        if intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError:
+        return False
+    return True
+
+
 class ImagingAgent:
-    def __init__(self, event_log=None, model_path="models/imaging_cnn.h5"):
+    def __init__(self, event_log=None, model_path="models/imaging_cnn.h5", rules_csv="data/clinical_rules.csv",
+                 cache_entries=4096, cache_bytes=8 << 20, cache_ttl_s=None,
+                 intra_op_threads=None, inter_op_threads=None, warmup=True):
         self.log = event_log
-        self.model = None
+        self.rules = load_clinical_rules(rules_csv)
+        self.model_path = model_path
         self.class_labels = ["normal", "pneumonia", "covid_suspect"]
+        self.input_shape = (64, 64, 3)
+        self.warmup = warmup
+        # (model, model sha256, traced fn or None), swapped as one reference on reload
+        self._snapshot = None
+
+        if TF_AVAILABLE and (intra_op_threads or inter_op_threads):
+            if not configure_tf_threads(intra_op_threads, inter_op_threads) and self.log:
+                self.log.log("ImagingAgent", "TensorFlow already initialised, thread settings ignored")
+
+        # CNN predictions keyed by (image sha256, model sha256, backend)
+        self.cache = LRUCache(cache_entries, cache_bytes, cache_ttl_s)
+        self._model_sig = None
+        self._model_lock = threading.Lock()
+        self._load_model()
+
+    def _model_file_signature(self):
+        if not self.model_path:
+            return None
+        try:
+            st = os.stat(self.model_path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    @property
+    def model(self):
+        snap = self._snapshot
+        return snap[0] if snap else None
 
-        if TF_AVAILABLE and os.path.exists(model_path):
+    @property
+    def model_checksum(self):
+        snap = self._snapshot
+        return snap[1] if snap else None
+
+    def _load_model(self):
+        """
+        Build the new model off to the side and publish it in one assignment, so requests
+        running during a reload see either the old model or the new one, never a half-built one.
+        """
+        sig = self._model_file_signature()
+        snapshot = None
+
+        if TF_AVAILABLE and sig is not None:
             try:
-                self.model = load_model(model_path)
+                model = load_model(self.model_path)
+                snapshot = (model, file_sha256(self.model_path), self._build_fast_path(model))
                 if self.log:
                     self.log.log("ImagingAgent", "Loaded CNN model successfully")
             except Exception as e:
@@ -30,38 +130,108 @@ class ImagingAgent:
             if self.log:
                 self.log.log("ImagingAgent", "CNN model not available, using rule-based fallback")
 
+        self._snapshot = snapshot
+        self._model_sig = sig
+        # Cache keys include the model checksum, so this only frees memory
+        self.cache.clear()
+
+    def _build_fast_path(self, model):
+        """
+        Wrap the model in a traced tf.function for direct calls. model.predict builds a
+        data pipeline on every call, which dominates single-image latency. One trace with
+        an unknown batch dimension serves all batch sizes; the warm-up call does the
+        tracing now instead of on the first request. Returns None if the model can't be traced.
+        """
+        try:
+            infer = tf.function(lambda x: model(x, training=False), reduce_retracing=True,
+                                input_signature=[tf.TensorSpec((None,) + self.input_shape, tf.float32)])
+            if self.warmup:
+                infer(tf.zeros((1,) + self.input_shape, tf.float32))
+            return infer
+        except Exception as e:
+            # Models that can't be called directly still work through model.predict
+            if self.log:
+                self.log.log("ImagingAgent", f"Using model.predict, traced inference unavailable: {e}")
+            return None
+
+    def _forward(self, batch, snapshot):
+        model, _, infer = snapshot
+        if infer is not None:
+            return infer(tf.convert_to_tensor(batch, tf.float32)).numpy()
+        return model.predict(batch, verbose=0)
+
+    def _check_model_file(self):
+        """Reload the model, dropping cached predictions, when the model file changed on disk."""
+        if TF_AVAILABLE and self._model_file_signature() != self._model_sig:
+            with self._model_lock:
+                if self._model_file_signature() != self._model_sig:
+                    self._load_model()
+
     def predict(self, xray_path, patient_notes=""):
+        self._check_model_file()
         # If model is available, use it
-        if self.model is not None:
-            return self._predict_with_cnn(xray_path)
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return self._predict_with_cnn_batch([xray_path], snapshot)[0]
         else:
             return self._predict_with_rules(xray_path, patient_notes)
 
-    def _predict_with_cnn(self, xray_path):
-        # Preprocess image
-        img = image.load_img(xray_path, target_size=(64, 64))
-        img_array = image.img_to_array(img) / 255.0
-        img_array = np.expand_dims(img_array, axis=0)
+    def predict_batch(self, xray_paths, patient_notes=None):
+        """Predict several X-rays at once; the CNN sees all uncached images in one forward pass."""
+        self._check_model_file()
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return self._predict_with_cnn_batch(xray_paths, snapshot)
+        notes = patient_notes or [""] * len(xray_paths)
+        return [self._predict_with_rules(p, n) for p, n in zip(xray_paths, notes)]
 
-        preds = self.model.predict(img_array)[0]
-        probs = {cls: float(round(preds[i], 2)) for i, cls in enumerate(self.class_labels)}
+    def predict_arrays(self, images):
+        """
+        CNN condition probabilities for already decoded uint8 images (N, 64, 64, 3), e.g.
+        from dataset shards, rounded as predict() rounds them. Not cached or logged.
+        """
+        self._check_model_file()
+        snapshot = self._snapshot
+        if snapshot is None:
+            raise RuntimeError("no CNN model is loaded")
+        preds = self._forward(np.asarray(images, dtype=np.float32) / 255.0, snapshot)
+        return [self._probs(row) for row in preds]
 
-        # Severity heuristic (just a rule on pneumonia prob)
-        severity = "mild"
-        if probs["pneumonia"] > 0.5:
-            severity = "moderate"
-        if probs["pneumonia"] > 0.75:
-            severity = "severe"
+    def _probs(self, row):
+        return {cls: float(round(row[j], 2)) for j, cls in enumerate(self.class_labels)}
 
-        output = {
-            "condition_probs": probs,
-            "severity_hint": severity,
-            "meta": {"ts": now_ts(), "file": os.path.basename(xray_path), "model": "CNN"}
-        }
+    def _predict_with_cnn_batch(self, xray_paths, snapshot):
+        datas, keys = [], []
+        for path in xray_paths:
+            with open(path, "rb") as f:
+                data = f.read()
+            datas.append(data)
+            keys.append((hashlib.sha256(data).hexdigest(), snapshot[1], "CNN"))
 
-        if self.log:
-            self.log.log("ImagingAgent", "Predicted conditions (CNN)", output)
-        return output
+        results = [self.cache.get(k) for k in keys]
+        misses = [i for i, r in enumerate(results) if r is None]
+        if misses:
+            with span("imaging.forward", batch_size=len(misses), cache_hits=len(xray_paths) - len(misses)):
+                batch = np.stack([load_xray_array(datas[i]) for i in misses])
+                preds = self._forward(batch, snapshot)
+            for i, row in zip(misses, preds):
+                probs = self._probs(row)
+                self.cache.put(keys[i], probs, nbytes=len(json.dumps(probs)) + len(keys[i][0]))
+                results[i] = probs
+
+        outputs = []
+        for i, (path, probs) in enumerate(zip(xray_paths, results)):
+            probs = dict(probs)
+            output = {
+                "condition_probs": probs,
+                "severity_hint": severity_from_probs(probs),
+                "meta": {"ts": now_ts(), "file": os.path.basename(path), "model": "CNN",
+                         "cache": "miss" if i in misses else "hit"}
+            }
+            if self.log:
+                self.log.log("ImagingAgent", "Predicted conditions (CNN)", output)
+            outputs.append(output)
+        return outputs
 
     def _predict_with_rules(self, xray_path, patient_notes=""):
         """
@@ -69,30 +239,107 @@ class ImagingAgent:
         Conditions are influenced by keywords in notes or filename.
         """
         fname = os.path.basename(xray_path).lower()
-        notes = (patient_notes or "").lower()
+        hits = {r["value"] for r in self.rules.find(fname, rule="imaging_file")}
+        hits.update(r["value"] for r in self.rules.find(patient_notes, rule="imaging_notes"))
 
         probs = {"pneumonia": 0.2, "normal": 0.6, "covid_suspect": 0.2}
 
-        if "pneumonia" in fname or "fever" in notes or "cough" in notes:
+        if "pneumonia" in hits:
             probs = {"pneumonia": 0.7, "normal": 0.2, "covid_suspect": 0.1}
-        elif "covid" in fname or "breath" in notes:
+        elif "covid_suspect" in hits:
             probs = {"pneumonia": 0.2, "normal": 0.2, "covid_suspect": 0.6}
-        elif "normal" in fname or "checkup" in notes:
+        elif "normal" in hits:
             probs = {"pneumonia": 0.1, "normal": 0.8, "covid_suspect": 0.1}
 
-        # Decide severity
-        severity = "mild"
-        if probs["pneumonia"] > 0.5:
-            severity = "moderate"
-        if probs["pneumonia"] > 0.75:
-            severity = "severe"
-
         output = {
             "condition_probs": probs,
-            "severity_hint": severity,
+            "severity_hint": severity_from_probs(probs),
             "meta": {"ts": now_ts(), "file": fname, "model": "rule-based"}
         }
 
         if self.log:
             self.log.log("ImagingAgent", "Predicted conditions (rule-based)", output)
-        return output
\ No newline at end of file
+        return output
+
+
+class ImagingBatcher:
+    """
+    Dynamic micro-batching in front of an ImagingAgent.
+
+    Requests from many threads (or coroutines, via predict_async) are collected until
+    `max_batch_size` are waiting or the oldest has waited `max_wait_ms`, then run as one
+    predict_batch call and the results are handed back to each caller. predict() has the
+    same signature as ImagingAgent.predict, so the batcher can stand in for the agent.
+    The batch is traced in the callers' traces (see tracing.batch_span).
+    """
+
+    def __init__(self, imaging, max_batch_size=8, max_wait_ms=5):
+        self.imaging = imaging
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batch_sizes = {}  # batch size -> number of batches run at that size
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, xray_path, patient_notes=""):
+        fut = Future()
+        self._queue.put((xray_path, patient_notes, fut, contextvars.copy_context()))
+        return fut
+
+    def predict(self, xray_path, patient_notes=""):
+        return self.submit(xray_path, patient_notes).result()
+
+    async def predict_async(self, xray_path, patient_notes=""):
+        return await asyncio.wrap_future(self.submit(xray_path, patient_notes))
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait_ms / 1000.0
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self._run(batch)
+
+    def _run(self, batch):
+        self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+        try:
+            # Results are handed out after the span ends, so it is in the trace before the caller finishes
+            with batch_span("imaging.batch", [b[3] for b in batch], batch_size=len(batch)):
+                outputs = self.imaging.predict_batch([b[0] for b in batch], [b[1] for b in batch])
+        except Exception:
+            # One bad input must not fail the whole batch: retry items individually
+            for path, notes, fut, ctx in batch:
+                try:
+                    with batch_span("imaging.batch", [ctx], batch_size=1):
+                        out = self.imaging.predict(path, patient_notes=notes)
+                except Exception as e:
+                    fut.set_exception(e)
+                    continue
+                fut.set_result(out)
+            return
+        for (_, _, fut, _), out in zip(batch, outputs):
+            fut.set_result(out)
+
+    def stats(self):
+        sizes = dict(self.batch_sizes)
+        batches = sum(sizes.values())
+        requests = sum(size * n for size, n in sizes.items())
+        return {"batches": batches, "requests": requests,
+                "mean_batch_size": round(requests / batches, 2) if batches else 0.0,
+                "batch_sizes": sizes}
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
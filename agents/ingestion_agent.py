@@ -1,17 +1,153 @@
 # agents/ingestion_agent.py
+import io
+import multiprocessing
 import os
 import platform
+import subprocess
+import threading
+import time
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from PyPDF2 import PdfReader
 from PIL import Image
 import pytesseract
+from agents.ocr_batch import tesseract_batch
 from utils import deidentify_text
+from tracing import record_span, span
+
+_ocr_pools = {}
+_ocr_pools_lock = threading.Lock()
+
+
+def _shared_ocr_pool(workers):
+    """One OCR process pool per size, shared by every IngestionAgent in the process."""
+    with _ocr_pools_lock:
+        pool = _ocr_pools.get(workers)
+        if pool is None:
+            # Not forked: the service and daemon processes already run TF, batcher and tracing threads
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            pool = _ocr_pools[workers] = ProcessPoolExecutor(max_workers=workers,
+                                                             mp_context=multiprocessing.get_context(method))
+        return pool
+
+
+def _drop_ocr_pool(workers, pool):
+    with _ocr_pools_lock:
+        if _ocr_pools.get(workers) is pool:
+            del _ocr_pools[workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_ocr_pools():
+    """Stop every shared OCR pool, e.g. before the process exits."""
+    with _ocr_pools_lock:
+        pools = list(_ocr_pools.values())
+        _ocr_pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def prepare_ocr_image(img, target_dpi=300, max_side=2500):
+    """
+    Grayscale and downscale to `target_dpi` (or to `max_side` pixels when the image carries
+    no usable DPI). Tesseract's run time grows with pixel count.
+    """
+    gray = img.convert("L")
+    dpi = img.info.get("dpi")
+    dpi = float(dpi[0]) if dpi and dpi[0] and dpi[0] >= 100 else None
+    scale = target_dpi / dpi if dpi else max_side / max(gray.size)
+    if scale < 1:
+        size = (max(1, round(gray.width * scale)), max(1, round(gray.height * scale)))
+        gray = gray.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    if dpi:
+        # pytesseract saves image.info with the image, so tesseract sees the real resolution
+        gray.info["dpi"] = (min(dpi, target_dpi),) * 2
+    return gray
+
+
+def _prepare(img, options):
+    if options.get("preprocess"):
+        return prepare_ocr_image(img, options.get("target_dpi", 300))
+    return img
+
+
+def _ocr(img, options, timeout=0):
+    psm = options.get("psm")
+    return pytesseract.image_to_string(_prepare(img, options), config=f"--psm {psm}" if psm is not None else "",
+                                       timeout=timeout)
+
+
+def _ocr_page(images, tesseract_cmd, options, deadline):
+    """
+    OCR one PDF page's embedded images (encoded image bytes); runs in a pool worker.
+    `deadline` (time.time()) is the document's: tesseract is killed when it passes, and a
+    page that only starts afterwards is not read at all, so no worker outlives the budget.
+    """
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    parts = []
+    for data in images:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError("OCR budget exhausted")
+        with Image.open(io.BytesIO(data)) as img:
+            try:
+                parts.append(_ocr(img, options, timeout=remaining).strip())
+            except RuntimeError:
+                if time.time() >= deadline:
+                    raise TimeoutError("OCR budget exhausted")
+                raise
+    return "\n".join(p for p in parts if p)
+
+
+def _ocr_chunk(pages, tesseract_cmd, options, deadline):
+    """
+    Like _ocr_page, for several pages in one tesseract run (list file) to amortize its start-up.
+    Returns {page index: text}.
+    """
+    images, owners = [], []
+    for i, page_images in pages:
+        for data in page_images:
+            with Image.open(io.BytesIO(data)) as img:
+                images.append(_prepare(img, options) if options.get("preprocess") else img.copy())
+            owners.append(i)
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise TimeoutError("OCR budget exhausted")
+    try:
+        texts = tesseract_batch(images, tesseract_cmd, options.get("psm"), timeout=remaining)
+    except subprocess.TimeoutExpired:
+        raise TimeoutError("OCR budget exhausted")
+    parts = {}
+    for i, image_pages in zip(owners, texts):
+        parts.setdefault(i, []).extend(p.strip() for p in image_pages)
+    return {i: "\n".join(p for p in ps if p) for i, ps in parts.items()}
+
 
 class IngestionAgent:
-    def __init__(self, event_log=None):
+    def __init__(self, event_log=None, ocr_workers=None, ocr_budget_s=60, ocr_psm=None, ocr_target_dpi=300,
+                 ocr_preprocess="downscale", ocr_batcher=None, tesseract_cmd=None):
+        """
+        Scanned PDF pages are OCRed in a pool of `ocr_workers` processes (default: up to 4,
+        one per core; 1 runs them in-process). Each document gets `ocr_budget_s` seconds of
+        OCR; tesseract runs still going then are killed, so the budget frees pool workers too.
+        With `ocr_preprocess` ("downscale") images are grayscaled and downscaled to
+        `ocr_target_dpi` before OCR (prepare_ocr_image); False passes them on unchanged;
+        `ocr_psm` is tesseract's page segmentation mode (None keeps its default, 3).
+        With `ocr_batcher` (agents.ocr_batch.TesseractBatcher, which has its own psm) single
+        images go through its shared multi-image tesseract runs, and each pool worker reads
+        its share of a scanned PDF in one tesseract run.
+        """
         self.log = event_log
+        self.ocr_batcher = ocr_batcher
+        self.ocr_workers = ocr_workers if ocr_workers is not None else min(4, os.cpu_count() or 1)
+        self.ocr_budget_s = ocr_budget_s
+        self.ocr_options = {"psm": ocr_psm, "target_dpi": ocr_target_dpi, "preprocess": ocr_preprocess}
 
         # Configure tesseract path based on OS
-        if platform.system() == "Windows":
+        if tesseract_cmd:
+            pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+        elif platform.system() == "Windows":
             tesseract_path = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
             if os.path.exists(tesseract_path):
                 pytesseract.pytesseract.tesseract_cmd = tesseract_path
@@ -21,30 +157,154 @@ class IngestionAgent:
             pytesseract.pytesseract.tesseract_cmd = "/usr/bin/tesseract"
 
     def _extract_text_from_pdf(self, pdf_path):
-        """Try extracting text from PDF, fallback to OCR if invalid."""
-        text = ""
+        """Text of every page; pages without a text layer (scans) are OCRed from their embedded images."""
+        texts, scanned = [], []
         try:
             reader = PdfReader(pdf_path)
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
+            for i, page in enumerate(reader.pages):
+                with span("pdf.extract_page", page=i) as sp:
+                    page_text = page.extract_text() or ""
+                    sp.set_attribute("chars", len(page_text))
+                    if not page_text.strip():
+                        images = self._page_images(page, i)
+                        sp.set_attribute("images", len(images))
+                        if images:
+                            scanned.append((i, images))
+                texts.append(page_text)
         except Exception as e:
             if self.log:
                 self.log.log("IngestionAgent", f"PDF text extraction failed: {e}")
-            # Try OCR on PDF as image (some PDFs are scanned images)
+        if scanned:
+            for i, page_text in self._ocr_pages(scanned).items():
+                texts[i] = page_text
+        return "".join(t + "\n" for t in texts if t)
+
+    def _page_images(self, page, index):
+        try:
+            return [img.data for img in page.images]
+        except Exception as e:
+            if self.log:
+                self.log.log("IngestionAgent", f"Could not extract images from PDF page {index}: {e}")
+            return []
+
+    def _ocr_pages(self, pages):
+        """
+        OCR [(page index, [image bytes])] within the document budget. Returns {page index: text};
+        pages that fail or don't finish in time are left out.
+        """
+        cmd = pytesseract.pytesseract.tesseract_cmd
+        deadline = time.time() + self.ocr_budget_s
+        out, errors = {}, []
+        with span("ocr.pdf_pages", pages=len(pages), workers=self.ocr_workers) as sp:
+            if self.ocr_workers > 1 and len(pages) > 1:
+                self._ocr_pages_pooled(pages, cmd, deadline, out, errors)
+            elif self.ocr_batcher is not None:
+                self._ocr_pages_batched(pages, out, errors)
+            else:
+                for i, images in pages:
+                    try:
+                        out[i] = _ocr_page(images, cmd, self.ocr_options, deadline)
+                    except TimeoutError:
+                        break
+                    except Exception as e:
+                        errors.append(f"page {i}: {e}")
+            sp.set_attribute("ocr_pages", len(out))
+        skipped = len(pages) - len(out) - len(errors)
+        if self.log and (errors or skipped):
+            self.log.log("IngestionAgent", "OCR of scanned PDF pages incomplete", {
+                "pages": len(pages), "ocr_pages": len(out), "errors": errors[:5],
+                "over_budget": skipped, "budget_s": self.ocr_budget_s
+            })
+        return out
+
+    def _ocr_pages_pooled(self, pages, cmd, deadline, out, errors):
+        """
+        Spread pages over the process pool. With batched OCR enabled (an `ocr_batcher`), each
+        worker reads its share of the pages in a single tesseract run; otherwise one run per page.
+        """
+        # (function, payload, page indices it covers)
+        if self.ocr_batcher is not None:
+            n = min(self.ocr_workers, len(pages))
+            jobs = [(_ocr_chunk, pages[k::n], [i for i, _ in pages[k::n]]) for k in range(n)]
+        else:
+            jobs = [(_ocr_page, images, [i]) for i, images in pages]
+        args = (cmd, self.ocr_options, deadline)
+        pool = _shared_ocr_pool(self.ocr_workers)
+        submitted_ns = time.time_ns()
+        try:
+            futures = {pool.submit(fn, payload, *args): owners for fn, payload, owners in jobs}
+        except BrokenProcessPool:
+            # A worker died during an earlier document; start a fresh pool
+            _drop_ocr_pool(self.ocr_workers, pool)
+            pool = _shared_ocr_pool(self.ocr_workers)
+            futures = {pool.submit(fn, payload, *args): owners for fn, payload, owners in jobs}
+        # Pool processes have no tracer; each job is recorded here, in the caller's trace
+        finished_ns = {}
+        for fut in futures:
+            fut.add_done_callback(lambda f: finished_ns.setdefault(f, time.time_ns()))
+        done, not_done = wait(futures, timeout=self.ocr_budget_s)
+        for fut in not_done:
+            # Queued jobs are dropped; running ones stop themselves at the deadline
+            fut.cancel()
+        for fut, owners in futures.items():
+            error = None if fut in done else "over budget"
+            if fut in done and fut.exception() is not None:
+                error = f"{type(fut.exception()).__name__}: {fut.exception()}"
+            record_span("ocr.pool_job", submitted_ns, finished_ns.get(fut, time.time_ns()), error=error,
+                        pages=len(owners))
+        for fut in done:
+            owners = futures[fut]
+            try:
+                result = fut.result()
+            except TimeoutError:
+                continue
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    _drop_ocr_pool(self.ocr_workers, pool)
+                errors.extend(f"page {i}: {e}" for i in owners)
+                continue
+            out.update(result if isinstance(result, dict) else {owners[0]: result})
+
+    def _ocr_pages_batched(self, pages, out, errors):
+        futures = {}
+        # Preprocessing runs on the batcher's threads, not the request thread
+        prepare = partial(_prepare, options=self.ocr_options)
+        for i, images in pages:
             try:
-                text = self._ocr_image(pdf_path)
-            except Exception as e2:
-                if self.log:
-                    self.log.log("IngestionAgent", f"OCR fallback on PDF failed: {e2}")
-        return text
+                decoded = []
+                for data in images:
+                    img = Image.open(io.BytesIO(data))
+                    img.load()
+                    decoded.append(img)
+            except Exception as e:
+                errors.append(f"page {i}: {e}")
+                continue
+            for img in decoded:
+                futures[self.ocr_batcher.submit(img, prepare)] = i
+        done, not_done = wait(futures, timeout=self.ocr_budget_s)
+        for fut in not_done:
+            fut.cancel()
+        failed = set()
+        for fut in done:
+            if fut.exception() is not None and futures[fut] not in failed:
+                failed.add(futures[fut])
+                errors.append(f"page {futures[fut]}: {fut.exception()}")
+        # A page counts only if all of its images were read in time
+        unfinished = {futures[f] for f in not_done} | failed
+        by_page = {}
+        for fut, i in futures.items():
+            if i not in unfinished:
+                by_page.setdefault(i, []).extend(p.strip() for p in fut.result())
+        for i, parts in by_page.items():
+            out[i] = "\n".join(p for p in parts if p)
 
     def _ocr_image(self, image_path):
         """Run OCR on an image file."""
         try:
-            img = Image.open(image_path)
-            return pytesseract.image_to_string(img)
+            with span("ocr.image_to_string", file=os.path.basename(image_path)), Image.open(image_path) as img:
+                if self.ocr_batcher is not None:
+                    return self.ocr_batcher.image_to_string(img, partial(_prepare, options=self.ocr_options))
+                return _ocr(img, self.ocr_options)
         except Exception as e:
             if self.log:
                 self.log.log("IngestionAgent", f"OCR failed: {e}")
@@ -0,0 +1,183 @@
+# agents/ocr_batch.py
+"""
+Batched tesseract OCR.
+
+pytesseract starts a new tesseract process, and loads the language model again, for every
+image. On small images that start-up costs more than the OCR itself. Tesseract can also
+be given a text file listing image paths. It then OCRs them all in one process and
+writes each page's text followed by a form feed. tesseract_batch() does that for a list of
+images and splits the output back per image. A multi-frame image (e.g. a TIFF) keeps one
+text per frame.
+
+TesseractBatcher gathers images from many threads into such batches, in the same way that
+ImagingBatcher gathers X-rays for the CNN, and traces each run in the callers' traces.
+"""
+import contextvars
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+import pytesseract
+
+from tracing import batch_span
+
+PAGE_SEPARATOR = "\f"
+
+
+def tesseract_batch(images, tesseract_cmd=None, psm=None, lang=None, timeout=None):
+    """OCR PIL images in a single tesseract run. Returns a list of page texts per image."""
+    if not images:
+        return []
+    cmd = tesseract_cmd or pytesseract.pytesseract.tesseract_cmd
+    tmp = tempfile.mkdtemp(prefix="ocr_batch_")
+    try:
+        paths, counts = [], []
+        for i, img in enumerate(images):
+            frames = getattr(img, "n_frames", 1)
+            path = os.path.join(tmp, f"{i:05d}.tif" if frames > 1 else f"{i:05d}.png")
+            if img.mode not in ("1", "L", "RGB", "RGBA"):
+                img = img.convert("RGB")
+            save_kwargs = {"dpi": img.info["dpi"]} if img.info.get("dpi") else {}
+            img.save(path, save_all=frames > 1, **save_kwargs)
+            paths.append(path)
+            counts.append(frames)
+        list_file = os.path.join(tmp, "images.txt")
+        with open(list_file, "w") as f:
+            f.write("\n".join(paths) + "\n")
+
+        args = [cmd, list_file, "stdout"]
+        if psm is not None:
+            args += ["--psm", str(psm)]
+        if lang:
+            args += ["-l", lang]
+        proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        if proc.returncode != 0:
+            raise RuntimeError(f"tesseract exited with {proc.returncode}: "
+                               f"{proc.stderr.decode('utf-8', 'replace').strip()}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    # Every page's text is followed by a separator, so the last piece is empty
+    pages = proc.stdout.decode("utf-8", "replace").split(PAGE_SEPARATOR)[:-1]
+    if len(pages) != sum(counts):
+        raise RuntimeError(f"tesseract returned {len(pages)} pages for {sum(counts)} input pages")
+    out, pos = [], 0
+    for n in counts:
+        out.append(pages[pos:pos + n])
+        pos += n
+    return out
+
+
+class TesseractBatcher:
+    """
+    Micro-batching OCR front-end. Images submitted from any thread are collected until
+    `max_batch_size` are waiting or the oldest has waited `max_wait_ms`, then OCRed in one
+    tesseract run. `workers` batches (default: one per core) run at once, each in its own
+    tesseract process. A `prepare` function given with an image (e.g. preprocessing) runs
+    on the batcher's threads, not the caller's. Callers must not close a submitted image
+    before its result is ready.
+    """
+
+    def __init__(self, max_batch_size=16, max_wait_ms=20, workers=None, tesseract_cmd=None, psm=None, lang=None,
+                 timeout_s=120):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.tesseract_cmd = tesseract_cmd
+        self.psm = psm
+        self.lang = lang
+        self.timeout_s = timeout_s
+        self.batch_sizes = {}  # batch size -> number of tesseract runs at that size
+        self._stats_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = [threading.Thread(target=self._loop, daemon=True) for _ in range(self.workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, img, prepare=None):
+        """Future resolving to the image's list of page texts."""
+        fut = Future()
+        self._queue.put((img, prepare, fut, contextvars.copy_context()))
+        return fut
+
+    def ocr_pages(self, img, prepare=None):
+        return self.submit(img, prepare).result()
+
+    def image_to_string(self, img, prepare=None):
+        """Like pytesseract.image_to_string: all pages, each followed by a form feed if there are several."""
+        pages = self.ocr_pages(img, prepare)
+        return pages[0] if len(pages) == 1 else "".join(p + PAGE_SEPARATOR for p in pages)
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait_ms / 1000.0
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            # Callers that gave up (e.g. an exhausted OCR budget) have cancelled their futures
+            batch = [b for b in batch if b[2].set_running_or_notify_cancel()]
+            ready = []
+            for img, prepare, fut, ctx in batch:
+                try:
+                    ready.append((prepare(img) if prepare else img, fut, ctx))
+                except Exception as e:
+                    fut.set_exception(e)
+            if ready:
+                self._run(ready)
+
+    def _ocr(self, images):
+        return tesseract_batch(images, self.tesseract_cmd, self.psm, self.lang, self.timeout_s)
+
+    def _run(self, batch):
+        with self._stats_lock:
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+        try:
+            with batch_span("ocr.tesseract_batch", [b[2] for b in batch], batch_size=len(batch)):
+                outputs = self._ocr([b[0] for b in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # One unreadable image must not fail the whole batch: retry items individually
+            for img, fut, ctx in batch:
+                try:
+                    with batch_span("ocr.tesseract_batch", [ctx], batch_size=1):
+                        pages = self._ocr([img])[0]
+                except Exception as e2:
+                    fut.set_exception(e2)
+                    continue
+                fut.set_result(pages)
+            return
+        for (_, fut, _), pages in zip(batch, outputs):
+            fut.set_result(pages)
+
+    def stats(self):
+        with self._stats_lock:
+            sizes = dict(self.batch_sizes)
+        batches = sum(sizes.values())
+        requests = sum(size * n for size, n in sizes.items())
+        return {"batches": batches, "requests": requests,
+                "mean_batch_size": round(requests / batches, 2) if batches else 0.0,
+                "batch_sizes": sizes}
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
@@ -1,61 +1,204 @@
 # agents/orchestrator.py
-import json
-from utils import EventLog
+import copy
+from utils import EventLog, triage_key
 from agents.ingestion_agent import IngestionAgent
 from agents.imaging_agent import ImagingAgent
 from agents.therapy_agent import TherapyAgent
 from agents.pharmacy_agent import PharmacyAgent
 from agents.doctor_escalation_agent import DoctorEscalationAgent
-import random
+from order_store import OrderStore
+from tracing import span
+
+LOG_MODES = ("full", "summary", "none")
+# Plan sections that event data may point into instead of repeating them
+ANALYSIS_STAGES = ("ingestion", "imaging", "therapy", "doctor_escalation")
+STAGE_KEYS = ANALYSIS_STAGES + ("pharmacy_matches", "order")
+
+
+class InvalidRequest(ValueError):
+    """A run argument the caller got wrong, as opposed to a failure inside the pipeline."""
+
+
+def _stage_refs(plan, depth=3):
+    """id(object) -> JSON pointer for the stage outputs in `plan` and their nested dicts/lists."""
+    refs = {}
+
+    def walk(obj, pointer, level):
+        if not isinstance(obj, (dict, list)) or id(obj) in refs:
+            return
+        refs[id(obj)] = pointer
+        if level < depth:
+            items = obj.items() if isinstance(obj, dict) else enumerate(obj)
+            for k, v in items:
+                walk(v, f"{pointer}/{k}", level + 1)
+
+    for key in STAGE_KEYS:
+        walk(plan.get(key), f"#/{key}", 1)
+    return refs
+
+
+def _slim_event(event, refs):
+    """Copy of `event` whose data, or any top-level value of it, is replaced by a $ref if it's in the plan."""
+    data = event.get("data")
+    if id(data) in refs:
+        data = {"$ref": refs[id(data)]}
+    elif isinstance(data, dict):
+        data = {k: {"$ref": refs[id(v)]} if id(v) in refs else v for k, v in data.items()}
+    return dict(event, data=data)
 
 
 class Orchestrator:
-    def __init__(self):
+    def __init__(self, pharmacy=None, scheduler=None, single_flight=None, imaging=None, order_store=None,
+                 refdata=None, ocr=None):
+        # `pharmacy` and `scheduler` may be shared between orchestrators (e.g. a worker pool)
+        # so that stock reservations and tele-slot bookings stay consistent. A shared
+        # `single_flight` (utils.SingleFlight) coalesces identical in-flight triage jobs, and
+        # a shared `imaging` (e.g. an ImagingBatcher) batches inference across workers.
+        # `order_store` (order_store.OrderStore) issues order IDs; pass a shared, log-backed
+        # store to keep orders across runs and restarts. `refdata` (refdata.ReferenceData)
+        # supplies memory-mapped medication, interaction and pharmacy tables shared by all
+        # local workers instead of per-orchestrator copies. A shared `ocr`
+        # (agents.ocr_batch.TesseractBatcher) runs OCR for all workers in batched tesseract calls.
         self.event_log = EventLog()
-        self.ingest = IngestionAgent(event_log=self.event_log)
-        self.imaging = ImagingAgent(event_log=self.event_log)
-        self.therapy = TherapyAgent(event_log=self.event_log)
-        self.pharmacy = PharmacyAgent(event_log=self.event_log)
-        self.doctor = DoctorEscalationAgent(event_log=self.event_log)
+        self.single_flight = single_flight
+        self.ingest = IngestionAgent(event_log=self.event_log, ocr_batcher=ocr)
+        self.imaging = imaging or ImagingAgent(event_log=self.event_log)
+        # A shared imaging agent can't write to this orchestrator's log, so its results are logged here
+        self._log_imaging = imaging is not None
+        if refdata is not None:
+            self.therapy = TherapyAgent(event_log=self.event_log, meds_df=refdata.meds, inter_df=refdata.interactions,
+                                        interaction_index=refdata.interaction_index,
+                                        otc_catalogue=refdata.otc_catalogue)
+            self.pharmacy = pharmacy or PharmacyAgent(event_log=self.event_log, pharmacies=refdata.pharmacies)
+        else:
+            self.therapy = TherapyAgent(event_log=self.event_log)
+            self.pharmacy = pharmacy or PharmacyAgent(event_log=self.event_log)
+        self.doctor = DoctorEscalationAgent(event_log=self.event_log, scheduler=scheduler)
+        self.orders = order_store or OrderStore()
+
+    def run(self, xray_path, pdf_path=None, patient_info=None, patient_lat=19.12, patient_lon=72.84, pincode=None,
+            include_log="full"):
+        """
+        Run the pipeline and return the plan. `include_log` controls plan['event_log'], which
+        only holds this run's events: "full" (event data already in the plan becomes a
+        {"$ref": "#/<stage>/..."} pointer), "summary" (ts/source/message only) or "none".
+        """
+        for stage, output in self.run_iter(xray_path, pdf_path, patient_info, patient_lat, patient_lon, pincode,
+                                           include_log):
+            if stage == "plan":
+                return output
+
+    def run_iter(self, xray_path, pdf_path=None, patient_info=None, patient_lat=19.12, patient_lon=72.84,
+                 pincode=None, include_log="full"):
+        """
+        Same as run(), but a generator of (stage, output) pairs yielded as each stage
+        finishes: "ingestion", "imaging", "therapy", "doctor_escalation", "pharmacy_matches",
+        "order", and finally ("plan", plan). With single-flight coalescing the four analysis
+        stages arrive together, once the shared analysis is done.
+        """
+        if include_log not in LOG_MODES:
+            raise InvalidRequest(f"include_log must be one of {LOG_MODES}")
+        with span("triage.run", pincode=pincode, has_pdf=bool(pdf_path), include_log=include_log) as root:
+            log_start = len(self.event_log.to_list())
+            aliases = {}
+
+            # A pincode, when given, replaces the raw delivery coordinates
+            if pincode is not None:
+                coords = self.pharmacy.geocode(pincode)
+                if coords is None:
+                    raise InvalidRequest(f"Unknown pincode: {pincode}")
+                patient_lat, patient_lon = coords
+                self.event_log.log("Orchestrator", "Resolved delivery pincode",
+                                   {"pincode": str(pincode), "lat": patient_lat, "lon": patient_lon})
+
+            if self.single_flight is not None:
+                key = triage_key(xray_path, pdf_path, patient_info)
+                shared, leader = self.single_flight.do(key, lambda: self._analyze(xray_path, pdf_path, patient_info))
+                root.set_attribute("coalesced", not leader)
+                if not leader:
+                    self.event_log.log("Orchestrator", "Coalesced with identical in-flight triage job")
+                # Every caller gets its own copy; fulfilment below mutates the plan. The deepcopy
+                # memo maps the originals our own events refer to onto their copies.
+                plan = copy.deepcopy(shared, aliases)
+                for stage in ANALYSIS_STAGES:
+                    yield stage, plan[stage]
+            else:
+                plan = {}
+                for stage, output in self._analyze_iter(xray_path, pdf_path, patient_info):
+                    plan[stage] = output
+                    yield stage, output
+
+            for stage, output in self._fulfil_iter(plan, patient_lat, patient_lon, pincode):
+                yield stage, output
+            root.set_attribute("order_created", bool(plan['order']))
+            if include_log != "none":
+                plan['event_log'] = self._run_events(plan, log_start, include_log, aliases)
+        yield "plan", plan
+
+    def _run_events(self, plan, start, include_log, aliases):
+        events = self.event_log.to_list()[start:]
+        if include_log == "summary":
+            return [{"ts": e.get("ts"), "source": e["source"], "message": e["message"]} for e in events]
+        refs = _stage_refs(plan)
+        for orig_id, obj in aliases.items():
+            if id(obj) in refs:
+                refs[orig_id] = refs[id(obj)]
+        return [_slim_event(e, refs) for e in events]
+
+    def _analyze(self, xray_path, pdf_path=None, patient_info=None):
+        """Ingestion, imaging, therapy and escalation: everything that depends only on the inputs."""
+        return dict(self._analyze_iter(xray_path, pdf_path, patient_info))
 
-    def run(self, xray_path, pdf_path=None, patient_info=None, patient_lat=19.12, patient_lon=72.84):
-        plan = {}
-        ing = self.ingest.process_inputs(xray_path, pdf_path=pdf_path, patient_info=patient_info)
-        plan['ingestion'] = ing
+    def _analyze_iter(self, xray_path, pdf_path=None, patient_info=None):
+        with span("IngestionAgent.process_inputs"):
+            ing = self.ingest.process_inputs(xray_path, pdf_path=pdf_path, patient_info=patient_info)
+        yield 'ingestion', ing
 
-        img = self.imaging.predict(ing['xray_path'], patient_notes=ing.get('notes', ''))
-        plan['imaging'] = img
+        with span("ImagingAgent.predict") as s:
+            img = self.imaging.predict(ing['xray_path'], patient_notes=ing.get('notes', ''))
+            s.set_attribute("model", img.get('meta', {}).get('model'))
+        if self._log_imaging:
+            self.event_log.log("ImagingAgent", f"Predicted conditions ({img.get('meta', {}).get('model')})", img)
+        yield 'imaging', img
 
         patient = ing['patient']
         patient['notes'] = ing.get('notes', '')
 
-        therapy_out = self.therapy.suggest_otc(img['condition_probs'], patient)
-        plan['therapy'] = therapy_out
+        with span("TherapyAgent.suggest_otc") as s:
+            therapy_out = self.therapy.suggest_otc(img['condition_probs'], patient)
+            s.set_attribute("otc_options", len(therapy_out['otc_options']))
+        yield 'therapy', therapy_out
 
         # Doctor Escalation Agent
-        doctor_out = self.doctor.evaluate(img, therapy_out, patient)
-        plan['doctor_escalation'] = doctor_out
+        with span("DoctorEscalationAgent.evaluate") as s:
+            doctor_out = self.doctor.evaluate(img, therapy_out, patient)
+            s.set_attribute("recommended", bool(doctor_out.get('recommended')))
+        yield 'doctor_escalation', doctor_out
 
+    def _fulfil_iter(self, plan, patient_lat, patient_lon, pincode=None):
+        """Pharmacy matching, reservation and order creation, done once per request."""
         matches = []
-        for opt in therapy_out['otc_options']:
+        for opt in plan['therapy']['otc_options']:
             sku = opt['sku']
-            match = self.pharmacy.find_nearest_with_stock(patient_lat, patient_lon, sku, qty=1)
-            if match:
-                reserved = self.pharmacy.reserve_items(match['pharmacy_id'], sku, qty=1)
-                match['reserved'] = reserved
+            with span("PharmacyAgent.fulfil_sku", sku=sku):
+                match = self.pharmacy.find_nearest_with_stock(patient_lat, patient_lon, sku, qty=1, pincode=pincode)
+                if match:
+                    reserved = self.pharmacy.reserve_items(match['pharmacy_id'], sku, qty=1)
+                    # A copy: the logged match keeps what was known when it was logged
+                    match = dict(match, reserved=reserved)
             matches.append({"sku": sku, "match": match})
         plan['pharmacy_matches'] = matches
+        yield 'pharmacy_matches', matches
 
         # Order building
         reserved_items = [m for m in matches if m['match'] and m['match'].get('reserved')]
         if reserved_items:
-            order_id = f"MOCKORD-{random.randint(1000, 9999)}"
-            plan['order'] = {"order_id": order_id, "items": reserved_items}
+            with span("OrderStore.create", items=len(reserved_items)):
+                plan['order'] = self.orders.create({"items": reserved_items})
         else:
             plan['order'] = None
 
         plan[
             'disclaimer'] = "Educational demo only — NOT medical advice. For emergencies, call local emergency services."
-        plan['event_log'] = self.event_log.to_list()
         self.event_log.log("Orchestrator", "Run completed", {"order_created": bool(plan['order'])})
-        return plan
\ No newline at end of file
+        yield 'order', plan['order']
@@ -1,28 +1,137 @@
 # agents/pharmacy_agent.py
 import pandas as pd
+import csv
 import json
+import math
+import os
+import queue
+import threading
 from utils import haversine_km
+from tracing import span
+
+
+def load_zipcodes(path):
+    """{pincode: (lat, lon)} from a pincode,lat,lon CSV; empty if the file is missing."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, newline='') as f:
+        return {row['pincode'].strip(): (float(row['lat']), float(row['lon'])) for row in csv.DictReader(f)}
+
 
 class PharmacyAgent:
-    def __init__(self, pharmacies_json='data/pharmacies.json', inventory_csv='data/inventory.csv', event_log=None):
-        with open(pharmacies_json, 'r') as f:
-            self.pharmacies = json.load(f)
-        self.inventory_df = pd.read_csv(inventory_csv)
+    def __init__(self, pharmacies_json='data/pharmacies.json', inventory_csv='data/inventory.csv', event_log=None,
+                 zipcodes_csv='data/zipcodes.csv', pharmacies=None, inventory_df=None):
+        # `pharmacies` (a sequence of dicts, e.g. a shared refdata view) and `inventory_df`
+        # replace the files
+        self.pharmacies_json = pharmacies_json
+        if pharmacies is None:
+            with open(pharmacies_json, 'r') as f:
+                pharmacies = json.load(f)
+        self._set_pharmacies(pharmacies)
+        self.zipcodes = load_zipcodes(zipcodes_csv)
+        self.inventory_df = pd.read_csv(inventory_csv) if inventory_df is None else inventory_df.reset_index(drop=True)
+        self.inventory_df['price'] = self.inventory_df['price'].astype(float)
         self.log = event_log
 
-    def find_nearest_with_stock(self, patient_lat, patient_lon, sku, qty=1):
-        candidates = []
-        for p in self.pharmacies:
-            dist = haversine_km(patient_lat, patient_lon, p['lat'], p['lon'])
-            if dist <= p.get('delivery_km', 10):
-                inv = self.inventory_df[(self.inventory_df['pharmacy_id']==p['id']) & (self.inventory_df['sku']==sku)]
-                if not inv.empty and int(inv.iloc[0]['qty']) >= qty:
-                    candidates.append((p, float(inv.iloc[0]['price']), int(inv.iloc[0]['qty']), dist))
-        if not candidates:
+        # Highest delta sequence number applied so far (feeds are replay-safe)
+        self.inventory_seq = 0
+        self._lock = threading.RLock()
+        self._build_inventory_index()
+        self._build_area_index()
+
+    def _set_pharmacies(self, pharmacies):
+        """
+        Keep the pharmacy list and the columns matching reads for every pharmacy. A shared
+        refdata view (it has a `table`) is kept as is and read column by column, so its rows
+        are only decoded for the pharmacies a caller gets back.
+        """
+        table = getattr(pharmacies, 'table', None)
+        if table is not None:
+            self.pharmacies = pharmacies
+            self._ids, self._lat, self._lon = table['id'], table['lat'], table['lon']
+            self._km = table['delivery_km'] if 'delivery_km' in table.columns else [10] * len(table)
+        else:
+            self.pharmacies = list(pharmacies)
+            self._ids = [p['id'] for p in self.pharmacies]
+            self._lat = [p['lat'] for p in self.pharmacies]
+            self._lon = [p['lon'] for p in self.pharmacies]
+            self._km = [p.get('delivery_km', 10) for p in self.pharmacies]
+
+    def _build_area_index(self):
+        """
+        Precompute, for every known pincode, the pharmacies that deliver there as
+        (pharmacy row, distance_km) sorted by distance. Rebuilt whenever the pharmacy list changes.
+        """
+        self._area_index = {
+            pincode: self._pharmacies_in_range(lat, lon)
+            for pincode, (lat, lon) in self.zipcodes.items()
+        }
+
+    def _pharmacies_in_range(self, lat, lon):
+        """[(row in self.pharmacies, distance_km)] of pharmacies delivering to (lat, lon), nearest first."""
+        in_range = []
+        for i in range(len(self._ids)):
+            dist = haversine_km(lat, lon, self._lat[i], self._lon[i])
+            if dist <= self._km[i]:
+                in_range.append((i, dist))
+        return sorted(in_range, key=lambda x: x[1])
+
+    def set_pharmacies(self, pharmacies):
+        """Replace the pharmacy list and refresh the per-pincode candidate lists."""
+        with self._lock:
+            self._set_pharmacies(pharmacies)
+            self._build_area_index()
+        if self.log:
+            self.log.log("PharmacyAgent", "Pharmacy list updated", {"pharmacies": len(self.pharmacies)})
+
+    def reload_pharmacies(self):
+        with open(self.pharmacies_json, 'r') as f:
+            self.set_pharmacies(json.load(f))
+
+    def geocode(self, pincode):
+        """(lat, lon) for a pincode, or None if it isn't in the zipcodes table."""
+        return self.zipcodes.get(str(pincode).strip())
+
+    def pharmacies_for_pincode(self, pincode):
+        """Precomputed [(pharmacy, distance_km)] delivering to `pincode`, nearest first; None if unknown."""
+        in_range = self._area_index.get(str(pincode).strip())
+        return None if in_range is None else [(self.pharmacies[i], dist) for i, dist in in_range]
+
+    def _build_inventory_index(self):
+        """Map (pharmacy_id, sku) -> inventory_df row label, first row wins."""
+        df = self.inventory_df
+        self._inv_index = {}
+        for idx, ph, sku in zip(df.index, df['pharmacy_id'], df['sku']):
+            self._inv_index.setdefault((ph, sku), idx)
+
+    def _stock(self, pharmacy_id, sku):
+        idx = self._inv_index.get((pharmacy_id, sku))
+        if idx is None:
             return None
-        candidates = sorted(candidates, key=lambda x: (x[1], x[3]))
-        chosen = candidates[0]
-        pharmacy, price, available_qty, dist_km = chosen
+        return int(self.inventory_df.at[idx, 'qty']), float(self.inventory_df.at[idx, 'price'])
+
+    def find_nearest_with_stock(self, patient_lat, patient_lon, sku, qty=1, pincode=None):
+        """
+        Cheapest (then nearest) in-range pharmacy with `qty` of `sku` in stock. With a known
+        `pincode` the precomputed delivery-area list is used instead of scanning every pharmacy.
+        """
+        candidates = []
+        with span("pharmacy.lookup", sku=sku, qty=qty) as sp, self._lock:
+            in_range = self._area_index.get(str(pincode).strip()) if pincode is not None else None
+            sp.set_attribute("precomputed_area", in_range is not None)
+            if in_range is None:
+                in_range = self._pharmacies_in_range(patient_lat, patient_lon)
+            for i, dist in in_range:
+                stock = self._stock(self._ids[i], sku)
+                if stock and stock[0] >= qty:
+                    candidates.append((i, stock[1], stock[0], dist))
+            sp.set_attribute("in_range", len(in_range))
+            sp.set_attribute("candidates", len(candidates))
+            if not candidates:
+                return None
+            candidates = sorted(candidates, key=lambda x: (x[1], x[3]))
+            row, price, available_qty, dist_km = candidates[0]
+            pharmacy = self.pharmacies[row]
         eta_min = int(10 + 5 * dist_km)
         delivery_fee = 25 if dist_km < 10 else 50
         out = {
@@ -38,13 +147,154 @@ class PharmacyAgent:
         return out
 
     def reserve_items(self, pharmacy_id, sku, qty=1):
-        mask = (self.inventory_df['pharmacy_id']==pharmacy_id) & (self.inventory_df['sku']==sku)
-        if mask.any():
-            idx = self.inventory_df[mask].index[0]
-            cur_qty = int(self.inventory_df.at[idx, 'qty'])
-            if cur_qty >= qty:
-                self.inventory_df.at[idx, 'qty'] = cur_qty - qty
-                if self.log:
-                    self.log.log("PharmacyAgent", f"Reserved {qty} of {sku} at {pharmacy_id}")
-                return True
-        return False
\ No newline at end of file
+        with span("pharmacy.reserve", pharmacy_id=pharmacy_id, sku=sku, qty=qty), self._lock:
+            idx = self._inv_index.get((pharmacy_id, sku))
+            if idx is not None:
+                cur_qty = int(self.inventory_df.at[idx, 'qty'])
+                if cur_qty >= qty:
+                    self.inventory_df.at[idx, 'qty'] = cur_qty - qty
+                    if self.log:
+                        self.log.log("PharmacyAgent", f"Reserved {qty} of {sku} at {pharmacy_id}")
+                    return True
+        return False
+
+    def apply_inventory_deltas(self, deltas):
+        """
+        Apply a batch of stock deltas to the in-memory inventory.
+
+        Each delta is a dict with `seq`, `pharmacy_id`, `sku` and either `qty_delta`
+        (relative change) or `qty` (absolute level), plus an optional `price`. A delta for
+        a (pharmacy, sku) that has no row yet must carry a price.
+
+        Deltas are applied in feed order and the highest applied seq is kept as a
+        high-water mark. A delta at or below it is skipped: that makes replaying a feed a
+        no-op, but it also drops a delta that arrives after a higher seq, including later
+        in the same batch. Skipped deltas are counted and logged, never applied.
+        Malformed deltas are rejected one by one; the rest of the batch still applies.
+        """
+        applied = skipped = rejected = out_of_order = 0
+        with self._lock:
+            df = self.inventory_df
+            seq = self.inventory_seq
+            updates = {}   # (pharmacy_id, sku) -> [qty, price]
+            new_rows = {}  # (pharmacy_id, sku) -> extra columns for unseen rows
+
+            for d in deltas:
+                # Convert every field before touching any state, so a bad delta changes nothing
+                try:
+                    d_seq = int(d['seq'])
+                    key = (d['pharmacy_id'], d['sku'])
+                    hash(key)
+                    qty = int(d['qty']) if 'qty' in d else None
+                    qty_delta = int(d['qty_delta']) if 'qty_delta' in d else None
+                    price = float(d['price']) if 'price' in d else None
+                except (KeyError, TypeError, ValueError, OverflowError):
+                    rejected += 1
+                    continue
+                if (qty is None and qty_delta is None and price is None) or \
+                        (price is not None and not math.isfinite(price)):
+                    rejected += 1
+                    continue
+                if d_seq <= seq:
+                    skipped += 1
+                    if d_seq > self.inventory_seq:
+                        out_of_order += 1
+                    continue
+
+                cur = updates.get(key)
+                if cur is None:
+                    idx = self._inv_index.get(key)
+                    if idx is not None:
+                        cur = [int(df.at[idx, 'qty']), float(df.at[idx, 'price'])]
+                    elif price is None:
+                        # A new row without a price would be sold at 0.0
+                        rejected += 1
+                        continue
+                    else:
+                        cur = [0, price]
+                        new_rows[key] = {c: d[c] for c in ('drug_name', 'form', 'strength') if c in d}
+                    updates[key] = cur
+
+                if qty is not None:
+                    cur[0] = qty
+                elif qty_delta is not None:
+                    cur[0] += qty_delta
+                cur[0] = max(cur[0], 0)
+                if price is not None:
+                    cur[1] = price
+                seq = d_seq
+                applied += 1
+
+            existing = [k for k in updates if k not in new_rows]
+            if existing:
+                labels = [self._inv_index[k] for k in existing]
+                df.loc[labels, 'qty'] = [updates[k][0] for k in existing]
+                df.loc[labels, 'price'] = [updates[k][1] for k in existing]
+            if new_rows:
+                rows = [dict(pharmacy_id=k[0], sku=k[1], qty=updates[k][0], price=updates[k][1], **extra)
+                        for k, extra in new_rows.items()]
+                self.inventory_df = pd.concat([df, pd.DataFrame(rows)], ignore_index=True)
+                self._build_inventory_index()
+            self.inventory_seq = seq
+
+        out = {"applied": applied, "skipped": skipped, "rejected": rejected, "seq": self.inventory_seq}
+        if self.log and (applied or rejected):
+            self.log.log("PharmacyAgent", "Applied inventory deltas", out)
+        if self.log and skipped:
+            self.log.log("PharmacyAgent", "Skipped inventory deltas at or below the applied seq",
+                         {"skipped": skipped, "out_of_order": out_of_order, "seq": self.inventory_seq})
+        return out
+
+    def consume_inventory_feed(self, source, batch_size=5000):
+        """
+        Consume stock deltas from a JSONL file path or a queue.Queue.
+
+        Queue items may be dicts or JSON strings; a None item ends consumption.
+        Deltas are applied in batches of up to `batch_size`.
+        """
+        totals = {"applied": 0, "skipped": 0, "rejected": 0}
+
+        def flush(batch):
+            res = self.apply_inventory_deltas(batch)
+            for k in totals:
+                totals[k] += res[k]
+            batch.clear()
+
+        batch = []
+        if isinstance(source, queue.Queue):
+            done = False
+            while not done:
+                item = source.get()
+                while True:
+                    if item is None:
+                        done = True
+                        break
+                    try:
+                        batch.append(json.loads(item) if isinstance(item, (str, bytes)) else item)
+                    except ValueError:
+                        totals["rejected"] += 1
+                    if len(batch) >= batch_size:
+                        break
+                    try:
+                        item = source.get_nowait()
+                    except queue.Empty:
+                        break
+                flush(batch)
+        else:
+            with open(source, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        batch.append(json.loads(line))
+                    except ValueError:
+                        totals["rejected"] += 1
+                        continue
+                    if len(batch) >= batch_size:
+                        flush(batch)
+            if batch:
+                flush(batch)
+
+        totals["seq"] = self.inventory_seq
+        return totals
@@ -0,0 +1,360 @@
+# agents/pharmacy_shards.py
+"""
+Geo-sharded pharmacy matching across local worker processes.
+
+Pharmacies are bucketed into square lat/lon cells of `cell_deg` degrees. The cells are
+ordered along a Z-order (Morton) curve, which keeps nearby cells close together, and the
+curve is cut into `n_shards` contiguous ranges holding about the same number of
+pharmacies. Each range goes to one worker process, which runs an ordinary PharmacyAgent
+over only its own pharmacies and inventory rows. The inventory CSV is partitioned in
+chunks, so neither the router nor any worker holds the whole table.
+
+ShardedPharmacyRouter has the PharmacyAgent methods the orchestrator and the inventory
+feed use. It keeps only the shard bounds, not a map of every pharmacy: a match request
+goes to the shards whose ranges hold the cells within the largest delivery radius of the
+patient, and their best candidates are merged. Reservations and inventory deltas carry
+no location, so they are offered to every shard and applied by the one that owns the
+pharmacy. Shard processes are started with forkserver (spawn where that's missing), not
+forked from a process that may already run TF and tracing threads. A shard process that
+dies makes the requests it should answer fail with a RuntimeError; the other shards keep
+serving.
+"""
+import bisect
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+
+import pandas as pd
+
+from agents.pharmacy_agent import PharmacyAgent, load_zipcodes
+from tracing import span
+
+KM_PER_DEG_LAT = 111.32
+SHARD_METHODS = ("find_nearest_with_stock", "reserve_items", "apply_owned_deltas", "set_pharmacies",
+                 "pharmacies_for_pincode", "owned_ids", "shard_stats")
+_MORTON_BITS = 21
+
+
+def geo_cell(lat, lon, cell_deg):
+    return math.floor(lat / cell_deg), math.floor(lon / cell_deg)
+
+
+def morton(cell):
+    """Z-order code of a cell: the bits of its row and column interleaved."""
+    i, j = cell[0] + (1 << (_MORTON_BITS - 1)), cell[1] + (1 << (_MORTON_BITS - 1))
+    code = 0
+    for b in range(_MORTON_BITS):
+        code |= ((i >> b) & 1) << (2 * b + 1) | ((j >> b) & 1) << (2 * b)
+    return code
+
+
+def shard_bounds(pharmacies, n_shards, cell_deg):
+    """Morton codes at which shards 1..n_shards-1 start, so every shard gets about as many pharmacies."""
+    codes = sorted(morton(geo_cell(p['lat'], p['lon'], cell_deg)) for p in pharmacies)
+    if not codes:
+        return []
+    return [codes[k * len(codes) // n_shards] for k in range(1, n_shards)]
+
+
+def range_shard(cell, bounds):
+    return bisect.bisect_right(bounds, morton(cell))
+
+
+def max_delivery_km(pharmacies):
+    return max((p.get('delivery_km', 10) for p in pharmacies), default=0.0)
+
+
+def cells_within(lat, lon, radius_km, cell_deg):
+    """Cells overlapping the bounding box of a `radius_km` circle around (lat, lon)."""
+    dlat = radius_km / KM_PER_DEG_LAT
+    dlon = radius_km / (KM_PER_DEG_LAT * max(math.cos(math.radians(lat)), 1e-6))
+    i0, j0 = geo_cell(lat - dlat, lon - dlon, cell_deg)
+    i1, j1 = geo_cell(lat + dlat, lon + dlon, cell_deg)
+    return [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+
+
+def partition(pharmacies, shard_of, inventory_csv, out_dir, n_shards, chunksize=100000):
+    """Write out_dir/shard_<k>/{pharmacies.json,inventory.csv} for every shard, as given by `shard_of`."""
+    buckets = [[] for _ in range(n_shards)]
+    for p in pharmacies:
+        buckets[shard_of[p['id']]].append(p)
+
+    dirs = [os.path.join(out_dir, f"shard_{k}") for k in range(n_shards)]
+    for d, bucket in zip(dirs, buckets):
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, 'pharmacies.json'), 'w') as f:
+            json.dump(bucket, f)
+
+    header_written = False
+    for chunk in pd.read_csv(inventory_csv, chunksize=chunksize):
+        if not header_written:
+            for d in dirs:
+                chunk.iloc[:0].to_csv(os.path.join(d, 'inventory.csv'), index=False)
+            header_written = True
+        shards = chunk['pharmacy_id'].map(shard_of)
+        for k, part in chunk[shards.notna()].groupby(shards[shards.notna()].astype(int)):
+            part.to_csv(os.path.join(dirs[k], 'inventory.csv'), mode='a', header=False, index=False)
+
+
+class _ShardAgent(PharmacyAgent):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Pharmacies this shard holds, or has held: their inventory stays here
+        self._owned = set(self._ids) | set(self.inventory_df['pharmacy_id'])
+
+    def set_pharmacies(self, pharmacies):
+        super().set_pharmacies(pharmacies)
+        self._owned.update(self._ids)
+
+    def owned_ids(self, pharmacy_ids):
+        return [pid for pid in pharmacy_ids if pid in self._owned]
+
+    def apply_owned_deltas(self, deltas):
+        """Apply the deltas for this shard's pharmacies; `owned` tells the router how many were ours."""
+        owned = []
+        for d in deltas:
+            try:
+                if d['pharmacy_id'] in self._owned:
+                    owned.append(d)
+            except (KeyError, TypeError):
+                pass  # nobody's delta; the router counts it as rejected
+        return dict(self.apply_inventory_deltas(owned), owned=len(owned))
+
+    def shard_stats(self):
+        return {"pharmacies": len(self.pharmacies), "inventory_rows": len(self.inventory_df)}
+
+
+def _shard_worker(conn, shard_dir, zipcodes_csv):
+    agent = _ShardAgent(os.path.join(shard_dir, 'pharmacies.json'), os.path.join(shard_dir, 'inventory.csv'),
+                        zipcodes_csv=zipcodes_csv)
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:  # the router went away
+            break
+        if msg is None:
+            break
+        method, args, kwargs = msg
+        try:
+            if method not in SHARD_METHODS:
+                raise AttributeError(f"shards don't serve {method}")
+            conn.send((True, getattr(agent, method)(*args, **kwargs)))
+        except Exception as e:
+            conn.send((False, f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+class ShardedPharmacyRouter:
+    def __init__(self, pharmacies_json='data/pharmacies.json', inventory_csv='data/inventory.csv', event_log=None,
+                 zipcodes_csv='data/zipcodes.csv', n_shards=4, cell_deg=0.25, work_dir=None):
+        self.log = event_log
+        self.pharmacies_json = pharmacies_json
+        self.n_shards = n_shards
+        self.cell_deg = cell_deg
+        self.zipcodes = load_zipcodes(zipcodes_csv)
+        self._own_dir = work_dir is None
+        self.work_dir = work_dir or tempfile.mkdtemp(prefix="pharmacy_shards_")
+        self._partition(inventory_csv)
+        # Highest delta sequence number any shard has applied
+        self.inventory_seq = 0
+        # Requests sent to each shard, for checking that routing stays local
+        self.requests = [0] * n_shards
+
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        ctx = multiprocessing.get_context(method)
+        self._conns, self._procs, self._locks = [], [], []
+        for k in range(n_shards):
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_shard_worker, daemon=True,
+                                           args=(child_conn, os.path.join(self.work_dir, f"shard_{k}"),
+                                                 zipcodes_csv))
+            proc.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._procs.append(proc)
+            self._locks.append(threading.Lock())
+
+    def _partition(self, inventory_csv):
+        """Fix the shard ranges and write each shard's files; the pharmacy list is not kept."""
+        with open(self.pharmacies_json, 'r') as f:
+            pharmacies = json.load(f)
+        # The shard ranges are fixed here; later pharmacy lists are placed into the same ranges
+        self.bounds = shard_bounds(pharmacies, self.n_shards, self.cell_deg)
+        self.max_delivery_km = max_delivery_km(pharmacies)
+        # {cell: shards} only for pharmacies kept on a shard whose range doesn't hold their cell
+        self.strays = {}
+        shard_of = {p['id']: self._range_shard(p) for p in pharmacies}
+        partition(pharmacies, shard_of, inventory_csv, self.work_dir, self.n_shards)
+
+    def _range_shard(self, pharmacy):
+        return range_shard(geo_cell(pharmacy['lat'], pharmacy['lon'], self.cell_deg), self.bounds)
+
+    def _fan_out(self, shards, method, *args, **kwargs):
+        """Send one request to each shard in `shards` (all at once); returns [(shard, ok, value)] in shard order."""
+        shards = sorted(set(shards))
+        replies = []
+        # Locks are taken in shard order, so concurrent fan-outs cannot deadlock
+        for k in shards:
+            self._locks[k].acquire()
+        try:
+            sent = []
+            for k in shards:
+                try:
+                    self._conns[k].send((method, args, kwargs))
+                    sent.append(k)
+                except OSError:
+                    replies.append((k, False, self._down(k)))
+                self.requests[k] += 1
+            # Every shard that got the request must be read, or its reply would answer the next request
+            for k in sent:
+                try:
+                    replies.append((k, *self._conns[k].recv()))
+                except (EOFError, OSError):
+                    replies.append((k, False, self._down(k)))
+        finally:
+            for k in shards:
+                self._locks[k].release()
+        replies.sort(key=lambda r: r[0])
+        return replies
+
+    def _call(self, shards, method, *args, **kwargs):
+        """Values from every shard in `shards`; any failed shard raises."""
+        replies = self._fan_out(shards, method, *args, **kwargs)
+        self._raise_failed(method, replies)
+        return [value for _, _, value in replies]
+
+    def _broadcast(self, method, *args, **kwargs):
+        """
+        Ask every shard, for requests that only the owning shard answers. A dead shard
+        doesn't stop the live ones; returns ([(shard, value)] from live shards, dead replies).
+        """
+        replies = self._fan_out(range(self.n_shards), method, *args, **kwargs)
+        dead = [r for r in replies if not r[1] and not self._procs[r[0]].is_alive()]
+        dead_shards = {r[0] for r in dead}
+        self._raise_failed(method, [r for r in replies if r[0] not in dead_shards])
+        return [(k, value) for k, ok, value in replies if ok], dead
+
+    @staticmethod
+    def _raise_failed(method, replies):
+        for k, ok, value in replies:
+            if not ok:
+                raise RuntimeError(f"pharmacy shard {k} failed in {method}: {value}")
+
+    def _down(self, k):
+        return f"shard process is not running (exit code {self._procs[k].exitcode})"
+
+    def shards_for(self, lat, lon):
+        """Shards whose ranges hold a cell within the largest delivery radius of (lat, lon)."""
+        cells = cells_within(lat, lon, self.max_delivery_km, self.cell_deg)
+        shards = {range_shard(c, self.bounds) for c in cells}
+        for c in cells:
+            shards.update(self.strays.get(c, ()))
+        return sorted(shards)
+
+    def owners(self, pharmacy_ids):
+        """{pharmacy_id: shard} for the given ids that some shard holds."""
+        pharmacy_ids = list(pharmacy_ids)
+        owned = self._call(range(self.n_shards), "owned_ids", pharmacy_ids)
+        return {pid: k for k, ids in enumerate(owned) for pid in ids}
+
+    def geocode(self, pincode):
+        return self.zipcodes.get(str(pincode).strip())
+
+    def pharmacies_for_pincode(self, pincode):
+        """[(pharmacy, distance_km)] delivering to `pincode` from every nearby shard, nearest first; None if unknown."""
+        coords = self.geocode(pincode)
+        if coords is None:
+            return None
+        areas = self._call(self.shards_for(*coords), "pharmacies_for_pincode", pincode)
+        return sorted((x for area in areas if area for x in area), key=lambda x: x[1])
+
+    def set_pharmacies(self, pharmacies):
+        """
+        Replace the pharmacy list. Known pharmacies stay on their shard, where their inventory
+        is; new ones go to the shard whose range holds their cell. The cells of pharmacies
+        that moved out of their shard's range are remembered, so queries there still reach it.
+        """
+        pharmacies = list(pharmacies)
+        owner = self.owners(p['id'] for p in pharmacies)
+        buckets, strays = [[] for _ in range(self.n_shards)], {}
+        for p in pharmacies:
+            home = self._range_shard(p)
+            k = owner.get(p['id'], home)
+            buckets[k].append(p)
+            if k != home:
+                strays.setdefault(geo_cell(p['lat'], p['lon'], self.cell_deg), set()).add(k)
+        for k, bucket in enumerate(buckets):
+            self._call([k], "set_pharmacies", bucket)
+        self.strays, self.max_delivery_km = strays, max_delivery_km(pharmacies)
+        if self.log:
+            self.log.log("PharmacyAgent", "Pharmacy list updated", {"pharmacies": len(pharmacies)})
+
+    def reload_pharmacies(self):
+        with open(self.pharmacies_json, 'r') as f:
+            self.set_pharmacies(json.load(f))
+
+    def find_nearest_with_stock(self, patient_lat, patient_lon, sku, qty=1, pincode=None):
+        coords = self.geocode(pincode) if pincode is not None else None
+        if coords:
+            patient_lat, patient_lon = coords
+        shards = self.shards_for(patient_lat, patient_lon)
+        with span("pharmacy.route", sku=sku, shards=len(shards)):
+            matches = [m for m in self._call(shards, "find_nearest_with_stock", patient_lat, patient_lon, sku,
+                                             qty=qty, pincode=pincode) if m]
+        if not matches:
+            return None
+        # Same ordering as PharmacyAgent: cheapest, then nearest
+        out = min(matches, key=lambda m: (m['items'][0]['price'], m['distance_km']))
+        if self.log:
+            self.log.log("PharmacyAgent", "Matched pharmacy", out)
+        return out
+
+    def reserve_items(self, pharmacy_id, sku, qty=1):
+        results, dead = self._broadcast("reserve_items", pharmacy_id, sku, qty=qty)
+        reserved = any(value for _, value in results)
+        if not reserved:
+            # The pharmacy may be on a dead shard
+            self._raise_failed("reserve_items", dead)
+        if reserved and self.log:
+            self.log.log("PharmacyAgent", f"Reserved {qty} of {sku} at {pharmacy_id}")
+        return reserved
+
+    def apply_inventory_deltas(self, deltas):
+        """Offer a delta batch to every shard; each applies its own pharmacies' deltas. Unclaimed ones are rejected."""
+        deltas = list(deltas)
+        results, dead = self._broadcast("apply_owned_deltas", deltas)
+        out = {"applied": 0, "skipped": 0, "rejected": 0}
+        claimed = 0
+        for _, res in results:
+            claimed += res["owned"]
+            for k in out:
+                out[k] += res[k]
+            self.inventory_seq = max(self.inventory_seq, res["seq"])
+        if claimed < len(deltas):
+            # Unclaimed deltas may belong to a dead shard; the live shards' deltas are applied
+            self._raise_failed("apply_inventory_deltas", dead)
+            out["rejected"] += len(deltas) - claimed
+        out["seq"] = self.inventory_seq
+        return out
+
+    # Same file/queue reading and batching as a single agent, applied through the router
+    consume_inventory_feed = PharmacyAgent.consume_inventory_feed
+
+    def shard_stats(self):
+        return self._call(range(self.n_shards), "shard_stats")
+
+    def close(self):
+        for k, conn in enumerate(self._conns):
+            with self._locks[k]:
+                try:
+                    conn.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+        for proc in self._procs:
+            proc.join(timeout=5)
+        if self._own_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
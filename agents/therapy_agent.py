@@ -1,39 +1,127 @@
 # agents/therapy_agent.py
 import pandas as pd
 import os
+from utils import load_clinical_rules
+
+
+def normalize_drug_name(name):
+    return " ".join(str(name).lower().split())
+
+
+def build_interaction_index(inter_df):
+    """
+    Symmetric adjacency map over interactions.csv:
+    normalized drug -> {normalized other drug: (other drug name, level, note)}.
+    """
+    index = {}
+    if inter_df is None:
+        return index
+    for drug, other, other_name, level, note in interaction_edges(inter_df):
+        index.setdefault(drug, {})[other] = (other_name, level, note)
+    return index
+
+
+def interaction_edges(inter_df):
+    """
+    The interaction index as rows (drug, other, other_name, level, note), both directions,
+    sorted by (drug, other); a later CSV row wins over an earlier one for the same pair.
+    A missing level or note becomes "", so findings stay valid JSON.
+    """
+    edges = {}
+    for a, b, level, note in zip(inter_df['drug_a'], inter_df['drug_b'], inter_df['level'], inter_df['note']):
+        level, note = ("" if pd.isna(level) else level), ("" if pd.isna(note) else note)
+        na, nb = normalize_drug_name(a), normalize_drug_name(b)
+        edges[(na, nb)] = (b, level, note)
+        edges[(nb, na)] = (a, level, note)
+    return [key + value for key, value in sorted(edges.items(), key=lambda kv: kv[0])]
+
+
+def otc_rows(meds_df):
+    """
+    The medication rows suggest_otc matches against, parsed once: (lowercased indications,
+    ';'-separated, age_min, lowercased allergy keywords, sku, drug_name).
+    """
+    rows = []
+    for _, row in meds_df.iterrows():
+        contra = str(row.get('contra_allergy_keywords', ''))
+        keywords = [k.strip().lower() for k in contra.split(',') if k]
+        rows.append((str(row['indication']).lower(), int(row.get('age_min', 0)), keywords, row['sku'],
+                     row['drug_name']))
+    return rows
+
+
+class OtcCatalogue:
+    """otc_rows() held in memory; refdata.SharedOtcCatalogue serves the same lookups from shared memory."""
+
+    def __init__(self, meds_df):
+        self.rows = otc_rows(meds_df)
+
+    def matching(self, condition):
+        """Rows with an indication containing `condition` (lowercase), in catalogue order."""
+        return [r for r in self.rows if any(condition in ind for ind in r[0].split(';'))]
 
 
 class TherapyAgent:
-    def __init__(self, meds_csv_path='data/meds.csv', interactions_csv='data/interactions.csv', event_log=None):
-        self.meds_df = pd.read_csv(meds_csv_path)
-        try:
-            self.inter_df = pd.read_csv(interactions_csv)
-        except Exception:
-            self.inter_df = None
+    def __init__(self, meds_csv_path='data/meds.csv', interactions_csv='data/interactions.csv', event_log=None,
+                 rules_csv='data/clinical_rules.csv', meds_df=None, inter_df=None, interaction_index=None,
+                 otc_catalogue=None):
+        # `meds_df` / `inter_df` replace the CSVs; refdata.SharedTable works here too.
+        # `interaction_index` (anything with the dict's get()) and `otc_catalogue` (anything
+        # with OtcCatalogue.matching()) are prebuilt lookups, e.g. refdata's shared ones.
+        self.meds_df = pd.read_csv(meds_csv_path) if meds_df is None else meds_df
+        self.rules = load_clinical_rules(rules_csv)
+        self.inter_df = inter_df
+        if inter_df is None and interaction_index is None:
+            try:
+                self.inter_df = pd.read_csv(interactions_csv)
+            except Exception:
+                self.inter_df = None
+        self.interactions = build_interaction_index(self.inter_df) if interaction_index is None else interaction_index
+        self.otc_catalogue = OtcCatalogue(self.meds_df) if otc_catalogue is None else otc_catalogue
         self.log = event_log
 
+    def check_interactions(self, suggestions, current_meds):
+        """
+        Attach interaction findings to each suggestion, checked against the patient's
+        current medications and the other suggestions (one dict lookup per pair).
+        `current_meds` is a list of names or one comma-separated string.
+        """
+        if isinstance(current_meds, str):
+            current_meds = current_meds.split(',')
+        current = [(str(m).strip(), normalize_drug_name(m)) for m in current_meds or [] if str(m).strip()]
+        for s in suggestions:
+            neighbours = self.interactions.get(normalize_drug_name(s['drug_name']))
+            found = []
+            if neighbours:
+                others = current + [(o['drug_name'], normalize_drug_name(o['drug_name']))
+                                    for o in suggestions if o is not s]
+                for name, norm in others:
+                    hit = neighbours.get(norm)
+                    if hit:
+                        found.append({"with": name, "level": hit[1], "note": hit[2]})
+                        s['warnings'].append(f"Interaction with {name} ({hit[1]}): {hit[2]}")
+            s['interactions'] = found
+        return suggestions
+
     def suggest_otc(self, conditions, patient):
         # pick top condition
         top = sorted(conditions.items(), key=lambda x: x[1], reverse=True)[0][0]
         suggestions = []
-        for _, row in self.meds_df.iterrows():
-            inds = str(row['indication']).split(';')
-            if any(top.lower() in ind.lower() for ind in inds):
-                if patient.get("age", 0) < int(row.get('age_min', 0)):
-                    continue
-                contra = str(row.get('contra_allergy_keywords', ''))
-                allergies = patient.get("allergies", []) or []
-                conflict = any(k.strip().lower() in (',').join(allergies).lower() for k in contra.split(',') if k)
-                warnings = []
-                if conflict:
-                    warnings.append("Possible allergy/conflict with patient's allergy list.")
-                suggestions.append({
-                    "sku": row['sku'],
-                    "drug_name": row['drug_name'],
-                    "dose": "Follow label",
-                    "freq": "As per label",
-                    "warnings": warnings
-                })
+        allergies = (',').join(patient.get("allergies", []) or []).lower()
+        for _, age_min, keywords, sku, drug_name in self.otc_catalogue.matching(top.lower()):
+            if patient.get("age", 0) < age_min:
+                continue
+            conflict = any(k in allergies for k in keywords)
+            warnings = []
+            if conflict:
+                warnings.append("Possible allergy/conflict with patient's allergy list.")
+            suggestions.append({
+                "sku": sku,
+                "drug_name": drug_name,
+                "dose": "Follow label",
+                "freq": "As per label",
+                "warnings": warnings
+            })
 
         # Fallback for pneumonia/covid if nothing found
         if not suggestions and top in ["pneumonia", "covid_suspect"]:
@@ -45,11 +133,9 @@ class TherapyAgent:
                 "warnings": ["Supportive care only, see doctor if symptoms worsen"]
             })
 
-        red_flags = []
-        if 'chest pain' in (patient.get('notes', '') or '').lower():
-            red_flags.append("Chest pain reported — advise immediate emergency care.")
-        if 'shortness of breath' in (patient.get('notes', '') or '').lower():
-            red_flags.append("Shortness of breath reported — advise immediate emergency care.")
+        self.check_interactions(suggestions, patient.get("medications"))
+
+        red_flags = [r['value'] for r in self.rules.find(patient.get('notes', ''), rule='red_flag')]
 
         if self.log:
             self.log.log("TherapyAgent", "OTC suggestions computed",
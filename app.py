@@ -3,14 +3,17 @@
 import streamlit as st
 import os
 import json
+import uuid
 from datetime import datetime
 import plotly.express as px
 import plotly.graph_objects as go
 
 # *** CRITICAL: Import classes by their original names ***
-from agents.orchestrator import Orchestrator
+from agents.doctor_escalation_agent import DoctorScheduler
+from agents.orchestrator import InvalidRequest, Orchestrator
+from order_store import OrderStore
 from utils_display import (
-    colorize_json,
+    display_event_log,
     display_metric_card,
     display_agent_card,
     display_medication_card,
@@ -20,6 +23,19 @@ from utils_display import (
 #uploads directory
 os.makedirs("uploads", exist_ok=True)
 
+
+@st.cache_resource
+def get_order_store():
+    # One store per server process, so order IDs keep increasing across reruns and restarts
+    return OrderStore("data/orders-app.jsonl")
+
+
+@st.cache_resource
+def get_scheduler():
+    # One roster of booked tele-consult slots per server process; a scheduler per run would hand out the same slot twice
+    return DoctorScheduler()
+
+
 # Custom CSS for theme application
 st.markdown("""
 <style>
@@ -562,6 +578,7 @@ with st.sidebar:
     st.markdown('<div class="sidebar-section"><h4>🧑 Patient Context</h4></div>', unsafe_allow_html=True)
     age = st.number_input("Patient Age", min_value=0, max_value=120, value=45)
     allergies_input = st.text_input("Known Allergies (e.g., ibuprofen, penicillin)", value="ibuprofen")
+    medications_input = st.text_input("Current Medications (e.g., warfarin, metformin)", value="")
 
     st.markdown('<div class="sidebar-section"><h4>📝 Symptom Summary</h4></div>', unsafe_allow_html=True)
     notes_input = st.text_area(
@@ -571,12 +588,46 @@ with st.sidebar:
     )
 
     st.markdown('<div class="sidebar-section"><h4>📍 Fulfillment Location</h4></div>', unsafe_allow_html=True)
+    pincode_input = st.text_input("Delivery Pincode (e.g., 400058; overrides coordinates)", value="")
     patient_lat = st.number_input("Latitude (Delivery Point)", value=19.12, format="%.6f")
     patient_lon = st.number_input("Longitude (Delivery Point)", value=72.84, format="%.6f")
 
     run_button = st.button("🚀 EXECUTE MULTI-AGENT PIPELINE", use_container_width=True)
 
+STAGE_TITLES = {
+    "ingestion": "📥 Ingestion Agent",
+    "imaging": "🩻 Imaging Agent",
+    "therapy": "💊 Therapy Agent",
+    "doctor_escalation": "👨‍⚕️ Doctor Escalation Agent",
+    "pharmacy_matches": "🏪 Pharmacy Agent",
+    "order": "🧾 Order",
+}
+
+
+def render_stage_card(stage, output):
+    """One-line result card for a finished pipeline stage."""
+    if stage == "ingestion":
+        text = f"Notes ready ({len(output.get('notes', ''))} characters, PII masked)."
+    elif stage == "imaging":
+        probs = output["condition_probs"]
+        top = max(probs, key=probs.get)
+        text = f"Most likely: <b>{top.title()}</b> ({probs[top]:.0%}), severity {output['severity_hint']}."
+    elif stage == "therapy":
+        text = f"{len(output['otc_options'])} OTC option(s), {len(output['red_flags'])} red flag(s)."
+    elif stage == "doctor_escalation":
+        text = "Referral <b>required</b>." if output["recommended"] else "No referral needed."
+        if output.get("doctor"):
+            text += f" Booked {output['doctor']['name']} at {output['doctor']['tele_slot']}."
+    elif stage == "pharmacy_matches":
+        found = sum(1 for m in output if m["match"])
+        text = f"Stock found for {found} of {len(output)} item(s)."
+    else:
+        text = f"Order <b>{output['order_id']}</b> created." if output else "No order created."
+    display_agent_card(f"✅ {STAGE_TITLES[stage]}", f"<p class='card-text'>{text}</p>")
+
+
 # Main execution
+streamed = False
 if run_button:
     if not uploaded_xray:
         st.error("🚨 X-ray image is required to initiate the Ingestion Agent.")
@@ -595,208 +646,223 @@ if run_button:
         patient_payload = {  # Using 'payload' for the input dict for better separation
             "age": int(age),
             "allergies": [a.strip() for a in allergies_input.split(",") if a.strip()],
+            "medications": [m.strip() for m in medications_input.split(",") if m.strip()],
             "notes": notes_input
         }
 
-        # 2. Call the Orchestrator
-        orch = Orchestrator()
-        with st.spinner("Processing data through sequential AI agents (Ingestion -> Imaging -> Therapy)..."):
-            # CRITICAL: Call the original run() method with the specific arguments
-            plan = orch.run(
-                xray_path,
-                pdf_path=pdf_path,
-                patient_info=patient_payload,
-                patient_lat=patient_lat,
-                patient_lon=patient_lon
-            )
-
-        # --- Summary Cards ---
-        st.markdown("## 📊 Final Triage and Fulfillment Summary")
+        # 2. Call the Orchestrator, showing each agent's result as soon as it is ready
+        orch = Orchestrator(order_store=get_order_store(), scheduler=get_scheduler())
+        st.markdown("## ⚙️ Agent Pipeline Progress")
+        progress = st.progress(0.0, text="Running Ingestion Agent...")
+        stage_area = st.container()
+        try:
+            for done, (stage, output) in enumerate(orch.run_iter(
+                    xray_path,
+                    pdf_path=pdf_path,
+                    patient_info=patient_payload,
+                    patient_lat=patient_lat,
+                    patient_lon=patient_lon,
+                    pincode=pincode_input.strip() or None
+            ), start=1):
+                if stage == "plan":
+                    plan = output
+                    break
+                with stage_area:
+                    render_stage_card(stage, output)
+                progress.progress(done / len(STAGE_TITLES), text=f"{STAGE_TITLES[stage]} done")
+        except InvalidRequest as e:
+            st.error(f"🚨 {e}. Check the pincode or leave it empty to use the coordinates.")
+            st.stop()
+        progress.empty()
+
+        st.session_state["plan"] = plan
+        st.session_state["pdf_provided"] = bool(pdf_path)
+        # Unique across sessions: it also keys the shared audit-log render cache
+        st.session_state["run_id"] = uuid.uuid4().hex
+        streamed = True
+
+# Results stay on screen across reruns triggered by widgets (e.g. audit log paging)
+plan = st.session_state.get("plan")
+if plan:
+    pdf_provided = st.session_state.get("pdf_provided", False)
+    if not streamed:
+        # Reruns redraw the per-stage cards that were streamed during the run
+        st.markdown("## ⚙️ Agent Pipeline Progress")
+        for stage in STAGE_TITLES:
+            render_stage_card(stage, plan[stage])
+
+    # --- Summary Cards ---
+    st.markdown("## 📊 Final Triage and Fulfillment Summary")
+
+    # Pull key data points for the metric cards
+    condition_probs = plan["imaging"]["condition_probs"]
+    top_condition = max(condition_probs, key=condition_probs.get)
+    top_prob = condition_probs[top_condition]
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        display_metric_card("Primary Diagnosis", top_condition.title(), f"Confidence: {top_prob:.0%}",
+                            color="#2b6cb0")
+    with col2:
+        esc = plan["doctor_escalation"]["recommended"]
+        reasons = plan["doctor_escalation"].get("reasons", [])
+        reason_text = reasons[0] if reasons else "No mandatory referral"
+        display_metric_card("Mandatory Referral", "YES" if esc else "NO", reason_text,
+                            color="#f56565" if esc else "#48bb78")
+    with col3:
+        order = plan["order"]
+        display_metric_card("Fulfillment Status", "ORDER CREATED" if order else "NO ORDER",
+                            order["order_id"] if order else "No safe items suggested",
+                            color="#48bb78" if order else "#718096")
+    with col4:
+        otc_count = len(plan["therapy"]["otc_options"])
+        display_metric_card("OTC Options", str(otc_count), "Meds passed safety check", color="#ed8936")
+
+    # --- Detailed Tabs ---
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs(
+        ["📥 Ingestion", "📝 Clean Notes", "🩻 Diagnostics", "💊 Therapy Plan", "👨‍⚕️ Referral", "🏪 Fulfillment",
+         "📜 Audit Log"]
+    )
 
-        # Pull key data points for the metric cards
-        condition_probs = plan["imaging"]["condition_probs"]
-        top_condition = max(condition_probs, key=condition_probs.get)
-        top_prob = condition_probs[top_condition]
+    with tab1:
+        st.markdown("### 📥 Ingestion Agent: Data Transformation")
+        patient = plan["ingestion"]["patient"]
+
+        # Displaying Agent outputs using humanized titles
+        display_agent_card("Patient Context Payload",
+                           f"<p class='card-text'><span class='card-highlight'>Age:</span> {patient['age']}</p><p class='card-text'><span class='card-highlight'>Allergies:</span> {', '.join(patient['allergies']) or 'None Reported'}</p>")
+
+        display_agent_card("Source File Integrity Check",
+                           f"<p class='card-text'><span class='card-highlight'>X-ray Path:</span> {os.path.basename(plan['ingestion']['xray_path'])}</p><p class='card-text'><span class='card-highlight'>PDF Status:</span> {'Extracted' if pdf_provided else 'No PDF Provided'}</p>")
+
+        display_agent_card("Data Processing Summary",
+                           f"<p class='card-text'><span class='card-highlight'>Text Extracted (OCR/PDF):</span> {'Yes' if plan['ingestion']['notes_raw'] else 'No'}</p><p class='card-text'><span class='card-highlight'>PII Masking Applied:</span> {'Yes (De-ID)' if plan['ingestion']['notes'] != plan['ingestion']['notes_raw'] else 'No changes needed'}</p>")
+
+    with tab2:
+        st.markdown("### 📝 Combined and Sanitized Notes")
+        if plan["ingestion"].get("notes"):
+            display_agent_card("Notes Used for Downstream Agents (Masked)",
+                               f"<p class='card-text'>{plan['ingestion']['notes']}</p>")
+            if plan["ingestion"]["notes_raw"]:
+                with st.expander("View RAW Extracted Text (Pre-Masking)"):
+                    st.code(plan["ingestion"]["notes_raw"])
+        else:
+            st.info("No text notes were provided or extracted via OCR.")
+
+    with tab3:
+        st.markdown("### 🩻 Imaging Agent: Model Inference Results")
+
+        probs = plan["imaging"]["condition_probs"]
+        severity = plan["imaging"]["severity_hint"]
+        model_info = plan["imaging"]["meta"]
+
+        # --- Analytics: Metrics Row ---
+        col_a1, col_a2, col_a3 = st.columns(3)
+        with col_a1:
+            display_metric_card("Model Used", model_info.get("model_name", "N/A"),
+                                f"Version: {model_info.get('version', 'N/A')}", color="#4299e1")
+        with col_a2:
+            display_metric_card("Highest Severity", severity.upper(), "Based on clinical scoring", color="#ed8936")
+        with col_a3:
+            display_metric_card("Run Time", f"{plan['imaging'].get('runtime_ms', 'N/A')} ms",
+                                "Model inference time", color="#48bb78")
+
+        # --- Analytics: Charts Row ---
+        col1, col2 = st.columns(2)
 
-        col1, col2, col3, col4 = st.columns(4)
         with col1:
-            display_metric_card("Primary Diagnosis", top_condition.title(), f"Confidence: {top_prob:.0%}",
-                                color="#2b6cb0")
+            st.markdown("#### 📊 Condition Probability Distribution")
+            # Create bar chart
+            fig_bar = px.bar(
+                x=list(probs.keys()), y=list(probs.values()),
+                labels={"x": "Condition", "y": "Probability"},
+                color=list(probs.values()), color_continuous_scale=["#bee3f8", "#2b6cb0"],
+                title="Model Confidence by Condition"
+            )
+            fig_bar.update_layout(plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)', font_color="#2c5282",
+                                  height=300)
+            st.plotly_chart(fig_bar, use_container_width=True)
+
         with col2:
-            esc = plan["doctor_escalation"]["recommended"]
-            reasons = plan["doctor_escalation"].get("reasons", [])
-            reason_text = reasons[0] if reasons else "No mandatory referral"
-            display_metric_card("Mandatory Referral", "YES" if esc else "NO", reason_text,
-                                color="#f56565" if esc else "#48bb78")
-        with col3:
-            order = plan["order"]
-            display_metric_card("Fulfillment Status", "ORDER CREATED" if order else "NO ORDER",
-                                order["order_id"] if order else "No safe items suggested",
-                                color="#48bb78" if order else "#718096")
-        with col4:
-            otc_count = len(plan["therapy"]["otc_options"])
-            display_metric_card("OTC Options", str(otc_count), "Meds passed safety check", color="#ed8936")
-
-        # --- Detailed Tabs ---
-        tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs(
-            ["📥 Ingestion", "📝 Clean Notes", "🩻 Diagnostics", "💊 Therapy Plan", "👨‍⚕️ Referral", "🏪 Fulfillment",
-             "📜 Audit Log"]
-        )
-
-        with tab1:
-            st.markdown("### 📥 Ingestion Agent: Data Transformation")
-            patient = plan["ingestion"]["patient"]
-
-            # Displaying Agent outputs using humanized titles
-            display_agent_card("Patient Context Payload",
-                               f"<p class='card-text'><span class='card-highlight'>Age:</span> {patient['age']}</p><p class='card-text'><span class='card-highlight'>Allergies:</span> {', '.join(patient['allergies']) or 'None Reported'}</p>")
-
-            display_agent_card("Source File Integrity Check",
-                               f"<p class='card-text'><span class='card-highlight'>X-ray Path:</span> {os.path.basename(plan['ingestion']['xray_path'])}</p><p class='card-text'><span class='card-highlight'>PDF Status:</span> {'Extracted' if pdf_path else 'No PDF Provided'}</p>")
-
-            display_agent_card("Data Processing Summary",
-                               f"<p class='card-text'><span class='card-highlight'>Text Extracted (OCR/PDF):</span> {'Yes' if plan['ingestion']['notes_raw'] else 'No'}</p><p class='card-text'><span class='card-highlight'>PII Masking Applied:</span> {'Yes (De-ID)' if plan['ingestion']['notes'] != plan['ingestion']['notes_raw'] else 'No changes needed'}</p>")
-
-        with tab2:
-            st.markdown("### 📝 Combined and Sanitized Notes")
-            if plan["ingestion"].get("notes"):
-                display_agent_card("Notes Used for Downstream Agents (Masked)",
-                                   f"<p class='card-text'>{plan['ingestion']['notes']}</p>")
-                if plan["ingestion"]["notes_raw"]:
-                    with st.expander("View RAW Extracted Text (Pre-Masking)"):
-                        st.code(plan["ingestion"]["notes_raw"])
-            else:
-                st.info("No text notes were provided or extracted via OCR.")
-
-        with tab3:
-            st.markdown("### 🩻 Imaging Agent: Model Inference Results")
-
-            probs = plan["imaging"]["condition_probs"]
-            severity = plan["imaging"]["severity_hint"]
-            model_info = plan["imaging"]["meta"]
-
-            # --- Analytics: Metrics Row ---
-            col_a1, col_a2, col_a3 = st.columns(3)
-            with col_a1:
-                display_metric_card("Model Used", model_info.get("model_name", "N/A"),
-                                    f"Version: {model_info.get('version', 'N/A')}", color="#4299e1")
-            with col_a2:
-                display_metric_card("Highest Severity", severity.upper(), "Based on clinical scoring", color="#ed8936")
-            with col_a3:
-                display_metric_card("Run Time", f"{plan['imaging'].get('runtime_ms', 'N/A')} ms",
-                                    "Model inference time", color="#48bb78")
-
-            # --- Analytics: Charts Row ---
-            col1, col2 = st.columns(2)
-
-            with col1:
-                st.markdown("#### 📊 Condition Probability Distribution")
-                # Create bar chart
-                fig_bar = px.bar(
-                    x=list(probs.keys()), y=list(probs.values()),
-                    labels={"x": "Condition", "y": "Probability"},
-                    color=list(probs.values()), color_continuous_scale=["#bee3f8", "#2b6cb0"],
-                    title="Model Confidence by Condition"
-                )
-                fig_bar.update_layout(plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)', font_color="#2c5282",
-                                      height=300)
-                st.plotly_chart(fig_bar, use_container_width=True)
-
-            with col2:
-                st.markdown("#### 🥧 Probability Breakdown")
-                # Create pie chart
-                fig_pie = px.pie(
-                    values=list(probs.values()), names=list(probs.keys()), title="Condition Distribution",
-                    color_discrete_map={"normal": "#48bb78", "pneumonia": "#ed8936", "covid_suspect": "#f56565"}
-                )
-                fig_pie.update_layout(font_color="#2c5282", height=300, showlegend=True)
-                st.plotly_chart(fig_pie, use_container_width=True)
-
-            # --- Detailed Analysis ---
-            st.markdown("#### 🔬 Model Insight")
-            st.markdown(f"""
-            <div class="insight-box">
-                <p class="insight-title">Highest Risk Identified</p>
-                <p class="insight-text">The model predicts **{top_condition.title()}** with a confidence of **{top_prob:.2%}**. The clinical severity hint is **{severity.upper()}**.</p>
-            </div>
-            """, unsafe_allow_html=True)
-
-        with tab4:
-            st.markdown("### 💊 Therapy Agent: OTC Treatment Plan")
-            if plan["therapy"]["red_flags"]:
-                for flag in plan["therapy"]["red_flags"]:
-                    display_agent_card("⚠️ **Safety/Contraindication Alert**", f"<p class='card-text'>{flag}</p>",
-                                       card_type="severe")
-
-            if plan["therapy"]["otc_options"]:
-                st.markdown("#### Safe Medication Suggestions:")
-                for med in plan["therapy"]["otc_options"]:
-                    st.markdown(display_medication_card(med), unsafe_allow_html=True)
-            else:
-                st.info("No safe OTC medications were suggested, likely due to red flags or missing data.")
-
-        with tab5:
-            st.markdown("### 👨‍⚕️ Doctor Escalation Agent: Final Risk Review")
-            esc = plan["doctor_escalation"]
-            if esc["recommended"]:
-                reasons = "".join([f"<li>{r}</li>" for r in esc.get("reasons", [])])
-                display_agent_card("🔴 **Mandatory Referral Required**",
-                                   f"**Reasons for Escalation:** <ul class='card-text'>{reasons}</ul>",
-                                   card_type="escalation-yes")
-                if esc.get("doctor"):
-                    doc = esc["doctor"]
-                    display_agent_card("Assigned Tele-Consult Slot",
-                                       f"<p class='card-text'><span class='card-highlight'>Dr.</span> {doc['name']} (ID: {doc['doctor_id']})<br><span class='card-highlight'>Confirmed Slot:</span> {doc['tele_slot']}</p>")
-            else:
-                display_agent_card("🟢 **Escalation NOT Required**",
-                                   "<p class='card-text'>Risk assessment indicates low acuity. Proceeding to fulfillment.</p>",
-                                   card_type="escalation-no")
-
-        with tab6:
-            st.markdown("### 🏪 Pharmacy Agent: Fulfillment & Logistics")
-            st.markdown("#### 📍 Nearest Pharmacies with Stock Check:")
-            for match_data in plan["pharmacy_matches"]:
-                match = match_data["match"]
-                sku = match_data["sku"]
-                if match and match.get("pharmacy_id"):
-                    st.markdown(display_pharmacy_card(match, reserved=match.get("reserved", False)),
-                                unsafe_allow_html=True)
-                else:
-                    display_agent_card("SKU Stock Alert",
-                                       f"<p class='card-text'>SKU **{sku}**: No nearby pharmacy found with available stock.</p>",
-                                       card_type="moderate")
-
-            if plan["order"]:
-                order = plan["order"]
-                st.markdown("#### Final Order Confirmation:")
-                display_agent_card("Order Details",
-                                   f"<p class='card-text'><span class='card-highlight'>Order ID:</span> {order['order_id']}</p><p class='card-text'><span class='card-highlight'>Items Reserved:</span> {len(order['items'])}</p>")
-                st.download_button("⬇️ Download Fulfillment JSON", data=json.dumps(order, indent=2),
-                                   file_name=f"order_{order['order_id']}.json", mime="application/json")
+            st.markdown("#### 🥧 Probability Breakdown")
+            # Create pie chart
+            fig_pie = px.pie(
+                values=list(probs.values()), names=list(probs.keys()), title="Condition Distribution",
+                color_discrete_map={"normal": "#48bb78", "pneumonia": "#ed8936", "covid_suspect": "#f56565"}
+            )
+            fig_pie.update_layout(font_color="#2c5282", height=300, showlegend=True)
+            st.plotly_chart(fig_pie, use_container_width=True)
+
+        # --- Detailed Analysis ---
+        st.markdown("#### 🔬 Model Insight")
+        st.markdown(f"""
+        <div class="insight-box">
+            <p class="insight-title">Highest Risk Identified</p>
+            <p class="insight-text">The model predicts **{top_condition.title()}** with a confidence of **{top_prob:.2%}**. The clinical severity hint is **{severity.upper()}**.</p>
+        </div>
+        """, unsafe_allow_html=True)
+
+    with tab4:
+        st.markdown("### 💊 Therapy Agent: OTC Treatment Plan")
+        if plan["therapy"]["red_flags"]:
+            for flag in plan["therapy"]["red_flags"]:
+                display_agent_card("⚠️ **Safety/Contraindication Alert**", f"<p class='card-text'>{flag}</p>",
+                                   card_type="severe")
+
+        if plan["therapy"]["otc_options"]:
+            st.markdown("#### Safe Medication Suggestions:")
+            for med in plan["therapy"]["otc_options"]:
+                st.markdown(display_medication_card(med), unsafe_allow_html=True)
+        else:
+            st.info("No safe OTC medications were suggested, likely due to red flags or missing data.")
+
+    with tab5:
+        st.markdown("### 👨‍⚕️ Doctor Escalation Agent: Final Risk Review")
+        esc = plan["doctor_escalation"]
+        if esc["recommended"]:
+            reasons = "".join([f"<li>{r}</li>" for r in esc.get("reasons", [])])
+            display_agent_card("🔴 **Mandatory Referral Required**",
+                               f"**Reasons for Escalation:** <ul class='card-text'>{reasons}</ul>",
+                               card_type="escalation-yes")
+            if esc.get("doctor"):
+                doc = esc["doctor"]
+                display_agent_card("Assigned Tele-Consult Slot",
+                                   f"<p class='card-text'><span class='card-highlight'>Dr.</span> {doc['name']} (ID: {doc['doctor_id']})<br><span class='card-highlight'>Confirmed Slot:</span> {doc['tele_slot']}</p>")
+        else:
+            display_agent_card("🟢 **Escalation NOT Required**",
+                               "<p class='card-text'>Risk assessment indicates low acuity. Proceeding to fulfillment.</p>",
+                               card_type="escalation-no")
+
+    with tab6:
+        st.markdown("### 🏪 Pharmacy Agent: Fulfillment & Logistics")
+        st.markdown("#### 📍 Nearest Pharmacies with Stock Check:")
+        for match_data in plan["pharmacy_matches"]:
+            match = match_data["match"]
+            sku = match_data["sku"]
+            if match and match.get("pharmacy_id"):
+                st.markdown(display_pharmacy_card(match, reserved=match.get("reserved", False)),
+                            unsafe_allow_html=True)
             else:
-                st.info("Fulfillment was halted: No safe or available items were reserved.")
-
-        with tab7:
-            st.markdown("### 📜 System Audit Log (Chronological)")
-            # Event log with improved visibility
-            for event in plan["event_log"][::-1][:20]:
-                st.markdown(f"""
-                <div class="event-log-item">
-                    <span class="event-timestamp">{event['ts']}</span> - 
-                    <span class="event-source">[{event['source']}]</span>: 
-                    <span class="event-message">{event['message']}</span>
-                </div>
-                """, unsafe_allow_html=True)
-
-                if event.get("data"):
-                    expander_title = f"📋 View raw data from [{event['source']}]"
-                    with st.expander(expander_title, expanded=False):
-                        st.markdown(f"""
-                        <div class="event-expander" style="margin-top: 0.5rem;">
-                            <div class="event-expander-content">
-                                <pre style="background-color: #f7fafc; padding: 1rem; border-radius: 0.375rem; overflow-x: auto;">{colorize_json(event['data'])}</pre>
-                            </div>
-                        </div> """, unsafe_allow_html=True)
+                display_agent_card("SKU Stock Alert",
+                                   f"<p class='card-text'>SKU **{sku}**: No nearby pharmacy found with available stock.</p>",
+                                   card_type="moderate")
+
+        if plan["order"]:
+            order = plan["order"]
+            st.markdown("#### Final Order Confirmation:")
+            display_agent_card("Order Details",
+                               f"<p class='card-text'><span class='card-highlight'>Order ID:</span> {order['order_id']}</p><p class='card-text'><span class='card-highlight'>Items Reserved:</span> {len(order['items'])}</p>")
+            st.download_button("⬇️ Download Fulfillment JSON", data=json.dumps(order, indent=2),
+                               file_name=f"order_{order['order_id']}.json", mime="application/json")
+        else:
+            st.info("Fulfillment was halted: No safe or available items were reserved.")
+
+    with tab7:
+        st.markdown("### 📜 System Audit Log (Chronological)")
+        # Paged, newest first; each event's data is rendered only when opened
+        run_id = st.session_state.get("run_id")
+        display_event_log(plan["event_log"], key=f"audit-{run_id}", plan=plan, run_id=run_id)
+
 
 # Footer (The final block for the footer )
 st.markdown("""
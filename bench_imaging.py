@@ -0,0 +1,58 @@
+# bench_imaging.py
+"""
+Single-image CNN latency: keras model.predict vs ImagingAgent's traced fast path.
+
+    python bench_imaging.py --model models/imaging_cnn.h5 --image uploads/pneumonia1.jpeg --runs 200
+"""
+import argparse
+import time
+import numpy as np
+
+from agents.imaging_agent import ImagingAgent, configure_tf_threads, load_xray_array, load_model
+from utils import percentiles_ms
+
+
+def time_calls(fn, batch, runs):
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn(batch)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="models/imaging_cnn.h5")
+    parser.add_argument("--image", default="uploads/pneumonia1.jpeg")
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--intra-op-threads", type=int, default=None)
+    parser.add_argument("--inter-op-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    configure_tf_threads(args.intra_op_threads, args.inter_op_threads)
+    batch = np.expand_dims(load_xray_array(args.image), axis=0)
+
+    # Baseline: freshly loaded model, first call pays tf.data setup and tracing
+    model = load_model(args.model)
+    t0 = time.perf_counter()
+    model.predict(batch, verbose=0)
+    predict_first = time.perf_counter() - t0
+    predict_steady = time_calls(lambda b: model.predict(b, verbose=0), batch, args.runs)
+
+    t0 = time.perf_counter()
+    agent = ImagingAgent(model_path=args.model)
+    construct = time.perf_counter() - t0
+    forward = lambda b: agent._forward(b, agent._snapshot)
+    t0 = time.perf_counter()
+    forward(batch)
+    fast_first = time.perf_counter() - t0
+    fast_steady = time_calls(forward, batch, args.runs)
+
+    print(f"model.predict   first call {predict_first * 1000:.1f} ms, steady {percentiles_ms(predict_steady)}")
+    print(f"traced fast path first call {fast_first * 1000:.1f} ms (agent construction incl. warm-up "
+          f"{construct * 1000:.0f} ms), steady {percentiles_ms(fast_steady)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+# dataset_shards.py
+"""
+Preprocess a labelled X-ray tree (<src>/<class>/*.jpg) into fixed-shape uint8 NumPy
+shards that training and evaluation read through memory maps instead of re-decoding.
+
+    python dataset_shards.py --src data/xrays --out data/shards --shard-size 4096
+
+<out>/manifest.json lists the shards and every source file seen (size, mtime, sha256,
+and where its image is stored). Later runs only decode files that are new or changed,
+and write them to new shards. A shard holding images whose source files were changed or
+deleted is rewritten without them. Files with the same content in the same class share
+one stored image. Use --rebuild to start over.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+from agents.imaging_agent import decode_xray
+
+# Index order must match ImagingAgent.class_labels
+CLASS_NAMES = ["normal", "pneumonia", "covid_suspect"]
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+IMAGE_SHAPE = (64, 64, 3)
+MANIFEST = "manifest.json"
+MANIFEST_VERSION = 2
+
+
+def _empty_manifest():
+    return {"version": MANIFEST_VERSION, "image_shape": list(IMAGE_SHAPE), "class_names": CLASS_NAMES,
+            "shards": [], "files": {}, "next_shard": 0}
+
+
+def load_manifest(shards_dir):
+    path = os.path.join(shards_dir, MANIFEST)
+    if not os.path.exists(path):
+        return _empty_manifest()
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_manifest(shards_dir, manifest):
+    tmp = os.path.join(shards_dir, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(shards_dir, MANIFEST))
+
+
+def _write_shard(shards_dir, manifest, images, labels):
+    """Write a new shard file pair and return its manifest entry (not yet listed)."""
+    name = f"shard_{manifest['next_shard']:05d}"
+    manifest["next_shard"] += 1
+    out = np.lib.format.open_memmap(os.path.join(shards_dir, name + ".npy"), mode="w+",
+                                    dtype=np.uint8, shape=(len(images),) + IMAGE_SHAPE)
+    for i, img in enumerate(images):
+        out[i] = img
+    out.flush()
+    del out
+    np.save(os.path.join(shards_dir, name + "_labels.npy"), np.asarray(labels, dtype=np.int8))
+    return {"name": name, "images": name + ".npy", "labels": name + "_labels.npy", "count": len(images)}
+
+
+def _compact(shards_dir, manifest, files):
+    """
+    Rewrite shards holding images no file refers to any more, and drop shards left empty.
+    Returns the file names that are no longer listed, to delete once the manifest is saved.
+    """
+    users = {}  # shard name -> {index: [file entries]}
+    for entry in files.values():
+        if entry.get("shard") is not None:
+            users.setdefault(entry["shard"], {}).setdefault(entry["index"], []).append(entry)
+    kept, obsolete = [], []
+    for shard in manifest["shards"]:
+        live = users.get(shard["name"], {})
+        if len(live) == shard["count"]:
+            kept.append(shard)
+            continue
+        obsolete += [shard["images"], shard["labels"]]
+        if not live:
+            continue
+        keep = sorted(live)
+        images = np.load(os.path.join(shards_dir, shard["images"]), mmap_mode="r")
+        labels = np.load(os.path.join(shards_dir, shard["labels"]))
+        new = _write_shard(shards_dir, manifest, images[keep], labels[keep])
+        for new_index, old_index in enumerate(keep):
+            for entry in live[old_index]:
+                entry["shard"], entry["index"] = new["name"], new_index
+        kept.append(new)
+    manifest["shards"] = kept
+    return obsolete
+
+
+def build_shards(src_dir, shards_dir, shard_size=4096, rebuild=False):
+    """Bring the shard set in line with the images under src_dir. Returns the number of images added."""
+    manifest = load_manifest(shards_dir)
+    if manifest.get("version") != MANIFEST_VERSION:
+        if manifest["shards"]:
+            print(f"{shards_dir} was built by an older version; rebuilding")
+        rebuild = True
+    if rebuild and os.path.isdir(shards_dir):
+        shutil.rmtree(shards_dir)
+        manifest = _empty_manifest()
+    os.makedirs(shards_dir, exist_ok=True)
+    seen_files, files = manifest["files"], {}
+    # One stored image per (content, label): {(sha256, label): {"shard": name, "index": i}}
+    slots = {}
+    for entry in seen_files.values():
+        if entry.get("shard") is not None:
+            slots.setdefault((entry["sha256"], entry["label"]), {"shard": entry["shard"], "index": entry["index"]})
+
+    images, labels, pending, added = [], [], [], 0
+
+    def flush():
+        shard = _write_shard(shards_dir, manifest, images, labels)
+        manifest["shards"].append(shard)
+        for slot in pending:
+            slot["shard"] = shard["name"]
+        images.clear()
+        labels.clear()
+        pending.clear()
+
+    for label, cls in enumerate(CLASS_NAMES):
+        class_dir = os.path.join(src_dir, cls)
+        if not os.path.isdir(class_dir):
+            continue
+        for fname in sorted(os.listdir(class_dir)):
+            if not fname.lower().endswith(IMAGE_EXTS):
+                continue
+            path = os.path.join(class_dir, fname)
+            rel = os.path.relpath(path, src_dir)
+            st = os.stat(path)
+            seen = seen_files.get(rel)
+            if seen and seen["size"] == st.st_size and seen["mtime_ns"] == st.st_mtime_ns:
+                files[rel] = seen
+                continue
+
+            with open(path, "rb") as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            # Without a stored image (it failed to decode) the file is not retried until it changes
+            files[rel] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest, "label": label}
+            if (digest, label) in slots:
+                continue
+            try:
+                images.append(decode_xray(data, IMAGE_SHAPE[:2]))
+            except Exception as e:
+                print(f"Skipping {rel}: {e}")
+                continue
+            labels.append(label)
+            slots[(digest, label)] = {"shard": None, "index": len(pending)}
+            pending.append(slots[(digest, label)])
+            added += 1
+            if len(images) == shard_size:
+                flush()
+
+    if images:
+        flush()
+    for entry in files.values():
+        slot = slots.get((entry["sha256"], entry["label"]))
+        if slot is not None:
+            entry["shard"], entry["index"] = slot["shard"], slot["index"]
+    # Changed and deleted files no longer refer to their old images
+    obsolete = _compact(shards_dir, manifest, files)
+    manifest["files"] = files
+    _save_manifest(shards_dir, manifest)
+    for name in obsolete:
+        os.remove(os.path.join(shards_dir, name))
+    return added
+
+
+def open_shards(shards_dir):
+    """List of (images, labels) per shard; images are read-only memory maps, no copy is made."""
+    manifest = load_manifest(shards_dir)
+    return [(np.load(os.path.join(shards_dir, s["images"]), mmap_mode="r"),
+             np.load(os.path.join(shards_dir, s["labels"])))
+            for s in manifest["shards"]]
+
+
+def iter_batches(shards_dir, batch_size=256):
+    """Yield (uint8 image batch, labels) views over the shards in order."""
+    for images, labels in open_shards(shards_dir):
+        for start in range(0, len(labels), batch_size):
+            yield images[start:start + batch_size], labels[start:start + batch_size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a labelled X-ray tree into memory-mapped shards.")
+    parser.add_argument("--src", default="data/xrays")
+    parser.add_argument("--out", default="data/shards")
+    parser.add_argument("--shard-size", type=int, default=4096)
+    parser.add_argument("--rebuild", action="store_true", help="discard existing shards and start over")
+    args = parser.parse_args()
+
+    added = build_shards(args.src, args.out, args.shard_size, args.rebuild)
+    total = sum(s["count"] for s in load_manifest(args.out)["shards"])
+    print(f"Added {added} images; {total} images in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+# dropfolder.py
+"""
+Drop-folder ingestion daemon, for clinics that hand over scans through a shared folder.
+
+    python dropfolder.py --watch uploads --outbox uploads/outbox --workers 2
+
+Every X-ray image in the watched folder is one job. `<stem>.pdf` is its companion report
+and `<stem>.json` its sidecar: patient_info fields, plus optional `patient_lat`,
+`patient_lon` and `pincode`. Files modified within the last `--settle` seconds are left
+for a later poll, so half-copied inputs are not picked up.
+
+Jobs go through a bounded queue to a pool of warm orchestrators. Each plan is written to
+`<stem>.<key>.plan.json` (or `.error.json`), either in the outbox or next to the inputs.
+`key` is a hash of the X-ray, PDF and sidecar contents. Finished keys are appended to a
+ledger (`.triage_state.jsonl` in the watched folder), so a restart does not process them
+again. Renaming a file does not trigger a new run, but editing it does. Anything not in
+the ledger is picked up on the next scan. A plan written just before a crash, but not yet
+in the ledger, is recorded as done rather than recomputed.
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+from utils import file_sha256, to_compact_json
+
+XRAY_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+SIDECAR_RUN_ARGS = ("patient_lat", "patient_lon", "pincode")
+
+
+def _is_candidate(name):
+    # Hidden files, editor/copy temporaries and our own outputs are never inputs
+    return not (name.startswith((".", "~")) or name.endswith((".part", ".tmp", ".plan.json", ".error.json")))
+
+
+def read_sidecar(path):
+    """(patient_info, run kwargs) from a sidecar JSON file; ({}, {}) when there is none."""
+    if not path:
+        return {}, {}
+    with open(path, "r") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"sidecar {os.path.basename(path)} must hold a JSON object")
+    info = data.pop("patient_info", None)
+    kwargs = {k: data.pop(k) for k in SIDECAR_RUN_ARGS if k in data}
+    return (info if isinstance(info, dict) else data), kwargs
+
+
+class Ledger:
+    """Append-only JSONL record of finished job keys. A torn last line is cut off on load."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self.failed = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        good_end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partial write from a crash; truncated below so the next record starts clean
+                good_end += len(line)
+                try:
+                    rec = json.loads(line)
+                    key, status = rec["key"], rec.get("status")
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if status == "done":
+                    self.done[key] = rec
+                    self.failed.pop(key, None)
+                else:
+                    self.failed[key] = rec
+        if good_end < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(good_end)
+
+    def record(self, key, status, **fields):
+        rec = dict(key=key, status=status, ts=time.time(), **fields)
+        line = json.dumps(rec) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            if status == "done":
+                self.done[key] = rec
+                self.failed.pop(key, None)
+            else:
+                self.failed[key] = rec
+        return rec
+
+
+class DropFolderDaemon:
+    def __init__(self, watch_dir, outbox_dir=None, state_path=None, workers=2, queue_size=16, settle_s=2.0,
+                 retry_failed=False, orchestrator_factory=None):
+        """`outbox_dir` None writes plans next to the inputs."""
+        self.watch_dir = watch_dir
+        self.outbox_dir = outbox_dir
+        if outbox_dir:
+            os.makedirs(outbox_dir, exist_ok=True)
+        self.settle_s = settle_s
+        self.ledger = Ledger(state_path or os.path.join(watch_dir, ".triage_state.jsonl"))
+        if retry_failed:
+            # Earlier failures get one more attempt in this process; new failures don't loop
+            self.ledger.failed.clear()
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.stats = {"queued": 0, "completed": 0, "failed": 0, "recovered": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self._pending = set()  # keys queued or running
+        self._errored = set()  # keys whose outputs could not be saved; retried after a restart
+        self._hashes = {}      # path -> ((size, mtime_ns), sha256), so unchanged files aren't re-read
+
+        if orchestrator_factory is None:
+            from service import default_orchestrator_factory
+            orchestrator_factory = default_orchestrator_factory()
+        self._workers = [threading.Thread(target=self._worker_loop, args=(orchestrator_factory(),), daemon=True)
+                         for _ in range(workers)]
+        for t in self._workers:
+            t.start()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _sha256(self, path, st):
+        sig = (st.st_size, st.st_mtime_ns)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == sig:
+            return cached[1]
+        digest = file_sha256(path)
+        self._hashes[path] = (sig, digest)
+        return digest
+
+    def _output_path(self, job, suffix):
+        out_dir = self.outbox_dir or self.watch_dir
+        return os.path.join(out_dir, f"{job['stem']}.{job['key'][:12]}.{suffix}.json")
+
+    def _written_plans(self):
+        """{key prefix: path} of plan files already in the output folder."""
+        out_dir = self.outbox_dir or self.watch_dir
+        written = {}
+        try:
+            names = os.listdir(out_dir)
+        except OSError:
+            return written  # outbox missing; writes will fail and be reported per job
+        for name in names:
+            if name.endswith(".plan.json"):
+                written[name[:-len(".plan.json")].rsplit(".", 1)[-1]] = os.path.join(out_dir, name)
+        return written
+
+    def find_jobs(self):
+        """Settled X-rays in the watched folder with their companions, as job dicts keyed by content."""
+        now = time.time()
+        entries = {}
+        with os.scandir(self.watch_dir) as it:
+            for e in it:
+                if e.is_file() and _is_candidate(e.name):
+                    entries[e.name] = e
+        jobs = []
+        for name, e in sorted(entries.items()):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in XRAY_EXTS:
+                continue
+            group = [e] + [entries[c] for c in (stem + ".pdf", stem + ".json") if c in entries]
+            try:
+                stats = [g.stat() for g in group]
+                if any(now - st.st_mtime < self.settle_s for st in stats):
+                    continue
+                h = hashlib.sha256()
+                for g, st in zip(group, stats):
+                    # The extension is hashed too, so a PDF and a sidecar can't stand in for each other
+                    h.update(os.path.splitext(g.name)[1].lower().encode() + b":" +
+                             self._sha256(g.path, st).encode() + b";")
+            except OSError:
+                continue  # removed between listing and hashing
+            pdf = entries.get(stem + ".pdf")
+            sidecar = entries.get(stem + ".json")
+            jobs.append({"key": h.hexdigest(), "stem": stem, "xray_path": e.path,
+                         "pdf_path": pdf.path if pdf else None, "sidecar_path": sidecar.path if sidecar else None})
+        return jobs
+
+    def scan(self):
+        """Queue every settled job not yet finished or in flight. Returns how many were queued."""
+        queued = 0
+        written = self._written_plans()
+        for job in self.find_jobs():
+            key = job["key"]
+            with self._lock:
+                if (key in self._pending or key in self._errored or key in self.ledger.done
+                        or key in self.ledger.failed):
+                    continue
+                self._pending.add(key)
+            plan_path = written.get(key[:12])
+            if plan_path:
+                # Written before a crash that came ahead of the ledger update
+                self.ledger.record(key, "done", xray=job["xray_path"], plan=plan_path)
+                self._count("recovered")
+                with self._lock:
+                    self._pending.discard(key)
+                continue
+            try:
+                self.jobs.put_nowait(job)
+            except queue.Full:
+                # Left for the next scan once the workers catch up
+                with self._lock:
+                    self._pending.discard(key)
+                break
+            queued += 1
+            self._count("queued")
+        return queued
+
+    def _write(self, path, data):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _worker_loop(self, orch):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            try:
+                self._process(orch, job)
+            except Exception as e:
+                # Saving the outcome failed (outbox unwritable, disk full): keep the worker alive and
+                # leave the job out of the ledger so a restart tries it again
+                with self._lock:
+                    self._errored.add(job["key"])
+                self._count("errors")
+                print(f"dropfolder: could not save result for {job['xray_path']}: {type(e).__name__}: {e}",
+                      file=sys.stderr)
+            finally:
+                with self._lock:
+                    self._pending.discard(job["key"])
+                # A warm orchestrator would otherwise keep every past run's events
+                orch.event_log.events = []
+                self.jobs.task_done()
+
+    def _process(self, orch, job):
+        try:
+            patient_info, kwargs = read_sidecar(job["sidecar_path"])
+            plan = orch.run(job["xray_path"], pdf_path=job["pdf_path"], patient_info=patient_info,
+                            include_log="summary", **kwargs)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            path = self._output_path(job, "error")
+            self._write(path, to_compact_json({"xray_path": job["xray_path"], "error": error}))
+            self.ledger.record(job["key"], "failed", xray=job["xray_path"], error=error, output=path)
+            self._count("failed")
+            return
+        path = self._output_path(job, "plan")
+        self._write(path, to_compact_json(plan))
+        self.ledger.record(job["key"], "done", xray=job["xray_path"], plan=path)
+        self._count("completed")
+
+    def run_once(self):
+        """Process everything currently settled in the folder, then return."""
+        while self.scan():
+            self.jobs.join()
+
+    def run_forever(self, stop, poll_s=2.0):
+        """Scan every `poll_s` seconds until `stop` (a threading.Event) is set."""
+        while not stop.is_set():
+            self.scan()
+            stop.wait(poll_s)
+
+    def drain(self, timeout=None):
+        """Let queued and running jobs finish, then stop the workers."""
+        for _ in self._workers:
+            self.jobs.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for t in self._workers:
+            t.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Triage X-rays dropped into a shared folder.")
+    parser.add_argument("--watch", default="uploads", help="folder clinics drop X-rays, PDFs and sidecars into")
+    parser.add_argument("--outbox", default=None, help="write plans here (default: next to the inputs)")
+    parser.add_argument("--state", default=None, help="ledger of processed inputs (default: <watch>/.triage_state.jsonl)")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=16)
+    parser.add_argument("--poll", type=float, default=2.0, help="seconds between folder scans")
+    parser.add_argument("--settle", type=float, default=2.0, help="ignore files modified within this many seconds")
+    parser.add_argument("--retry-failed", action="store_true", help="run inputs that failed before again")
+    parser.add_argument("--once", action="store_true", help="process what is in the folder now, then exit")
+    parser.add_argument("--orders-log", default="data/orders-dropfolder.jsonl",
+                        help="append-only order log, owned by one process at a time ('' keeps orders in memory only)")
+    parser.add_argument("--ocr-batch-size", type=int, default=8, help="max images per tesseract run (1 disables)")
+    parser.add_argument("--ocr-workers", type=int, default=None,
+                        help="concurrent batched tesseract runs (default: one per core)")
+    args = parser.parse_args()
+
+    from service import default_orchestrator_factory
+    factory = default_orchestrator_factory(orders_log=args.orders_log or None, ocr_batch_size=args.ocr_batch_size,
+                                           ocr_workers=args.ocr_workers)
+    daemon = DropFolderDaemon(args.watch, args.outbox, args.state, workers=args.workers,
+                              queue_size=args.queue_size, settle_s=args.settle, retry_failed=args.retry_failed,
+                              orchestrator_factory=factory)
+    if args.once:
+        daemon.run_once()
+    else:
+        print(f"Watching {args.watch} ({args.workers} workers)")
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        signal.signal(signal.SIGINT, lambda *_: stop.set())
+        daemon.run_forever(stop, args.poll)
+        print("Draining drop-folder queue...")
+    daemon.drain()
+    print(json.dumps(daemon.stats))
+
+
+if __name__ == "__main__":
+    main()
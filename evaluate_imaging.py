@@ -0,0 +1,168 @@
+# evaluate_imaging.py
+"""
+Offline quality and throughput report for ImagingAgent on a labelled set.
+
+    python evaluate_imaging.py --data-dir data/xrays --backend cnn --batch-size 32 --out eval.json
+    python evaluate_imaging.py --shards data/shards --backend cnn
+    python evaluate_imaging.py --data-dir data/xrays --backend rules
+
+Reports accuracy, the confusion matrix (rows = true class, columns = predicted class),
+per-class precision/recall, calibration (expected calibration error and Brier score),
+images/sec and per-image latency percentiles, as JSON. Both sources are scored on the
+probabilities ImagingAgent serves, which are rounded to two decimals.
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+from agents.imaging_agent import ImagingAgent
+from dataset_shards import CLASS_NAMES, IMAGE_EXTS, iter_batches
+from utils import percentiles_ms
+
+
+def list_labelled_files(data_dir):
+    """(paths, labels) for every image under <data_dir>/<class>/, in CLASS_NAMES order."""
+    paths, labels = [], []
+    for label, cls in enumerate(CLASS_NAMES):
+        class_dir = os.path.join(data_dir, cls)
+        if not os.path.isdir(class_dir):
+            continue
+        for fname in sorted(os.listdir(class_dir)):
+            if fname.lower().endswith(IMAGE_EXTS):
+                paths.append(os.path.join(class_dir, fname))
+                labels.append(label)
+    return paths, labels
+
+
+def calibration(labels, probs, bins=10):
+    """Expected calibration error of the top-1 confidence, and the multi-class Brier score."""
+    conf = probs.max(axis=1)
+    correct = probs.argmax(axis=1) == labels
+    edges = np.linspace(0.0, 1.0, bins + 1)
+    which = np.clip(np.digitize(conf, edges[1:-1], right=True), 0, bins - 1)
+    ece = 0.0
+    for b in range(bins):
+        in_bin = which == b
+        if in_bin.any():
+            ece += in_bin.mean() * abs(correct[in_bin].mean() - conf[in_bin].mean())
+    onehot = np.eye(probs.shape[1])[labels]
+    brier = float(np.mean(np.sum((probs - onehot) ** 2, axis=1)))
+    return round(float(ece), 4), round(brier, 4)
+
+
+def quality_metrics(labels, probs, class_names=CLASS_NAMES):
+    labels = np.asarray(labels, dtype=np.int64)
+    probs = np.asarray(probs, dtype=np.float64)
+    preds = probs.argmax(axis=1)
+    k = len(class_names)
+    confusion = np.zeros((k, k), dtype=np.int64)
+    np.add.at(confusion, (labels, preds), 1)
+
+    per_class = {}
+    for i, cls in enumerate(class_names):
+        tp = int(confusion[i, i])
+        predicted, actual = int(confusion[:, i].sum()), int(confusion[i].sum())
+        per_class[cls] = {"support": actual,
+                          "precision": round(tp / predicted, 4) if predicted else None,
+                          "recall": round(tp / actual, 4) if actual else None}
+
+    ece, brier = calibration(labels, probs)
+    return {"accuracy": round(float((preds == labels).mean()), 4) if len(labels) else None,
+            "confusion_matrix": {"labels": list(class_names), "matrix": confusion.tolist()},
+            "per_class": per_class,
+            "ece": ece, "brier": brier}
+
+
+def _probs_row(probs):
+    return [probs[cls] for cls in CLASS_NAMES]
+
+
+def run_files(agent, paths, batch_size):
+    """Predict every path in batches. Returns (probs rows, per-batch latencies, batch sizes)."""
+    rows, latencies, sizes = [], [], []
+    for start in range(0, len(paths), batch_size):
+        chunk = paths[start:start + batch_size]
+        t0 = time.perf_counter()
+        outputs = agent.predict_batch(chunk)
+        latencies.append(time.perf_counter() - t0)
+        sizes.append(len(chunk))
+        rows.extend(_probs_row(o["condition_probs"]) for o in outputs)
+    return rows, latencies, sizes
+
+
+def run_shards(agent, shards_dir, batch_size):
+    """CNN forward passes straight over memmapped shards; decode time is not included."""
+    rows, labels, latencies, sizes = [], [], [], []
+    for images, batch_labels in iter_batches(shards_dir, batch_size):
+        t0 = time.perf_counter()
+        probs = agent.predict_arrays(images)
+        latencies.append(time.perf_counter() - t0)
+        sizes.append(len(batch_labels))
+        rows.extend(_probs_row(p) for p in probs)
+        labels.extend(int(x) for x in batch_labels)
+    return rows, labels, latencies, sizes
+
+
+def evaluate(data_dir="data/xrays", backend="cnn", model_path="models/imaging_cnn.h5", batch_size=32,
+             shards_dir=None):
+    # Caching disabled: duplicate images would otherwise inflate throughput. Without a model
+    # path the agent only has its rule-based classifier.
+    agent = ImagingAgent(model_path=model_path if backend == "cnn" else None, cache_entries=0)
+    if backend == "cnn" and agent.model is None:
+        raise RuntimeError(f"CNN backend requested but no model could be loaded from {model_path}")
+    if shards_dir and backend != "cnn":
+        raise ValueError("shards hold pixels only; the rule-based backend needs the source file names")
+
+    t0 = time.perf_counter()
+    if shards_dir:
+        rows, labels, latencies, sizes = run_shards(agent, shards_dir, batch_size)
+    else:
+        paths, labels = list_labelled_files(data_dir)
+        rows, latencies, sizes = run_files(agent, paths, batch_size)
+    wall = time.perf_counter() - t0
+    if not labels:
+        raise ValueError(f"no labelled images found in {shards_dir or data_dir}")
+
+    per_image = np.repeat(np.array(latencies) / np.array(sizes), sizes)
+    report = {
+        "backend": backend,
+        "source": shards_dir or data_dir,
+        "model_path": model_path if backend == "cnn" else None,
+        "model_sha256": agent.model_checksum if backend == "cnn" else None,
+        "images": len(labels),
+        "batch_size": batch_size,
+    }
+    report.update(quality_metrics(labels, rows))
+    report["throughput"] = {
+        "images_per_sec": round(len(labels) / wall, 2) if wall > 0 else None,
+        "wall_s": round(wall, 3),
+        "batch_latency_ms": percentiles_ms(latencies),
+        "per_image_latency_ms": percentiles_ms(per_image),
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate ImagingAgent accuracy, calibration and speed.")
+    parser.add_argument("--data-dir", default="data/xrays")
+    parser.add_argument("--shards", default=None, help="evaluate over memmap shards built by dataset_shards.py")
+    parser.add_argument("--backend", choices=["cnn", "rules"], default="cnn")
+    parser.add_argument("--model", default="models/imaging_cnn.h5")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--out", default=None, help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = evaluate(args.data_dir, args.backend, args.model, args.batch_size, args.shards)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+        print(f"Wrote {args.out} (accuracy {report['accuracy']}, {report['throughput']['images_per_sec']} img/s)")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
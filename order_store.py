@@ -0,0 +1,197 @@
+# order_store.py
+"""
+Order store with collision-free IDs and an optional append-only JSONL log.
+
+Order IDs are `<prefix>-<node>-<sequence>`. The node part is random per store instance,
+so stores in different processes or on different machines never issue the same ID; the
+sequence only ever increases and is recovered from the log on restart. With a log path,
+orders are written by one writer thread that takes everything queued since its last
+write, appends it in one write, and fsyncs once (group commit). Under load, many orders
+share a single fsync. An order is only visible to get() once it is durable; if the write
+fails, create() raises and the order is dropped. Lookups by ID use an in-memory dict
+rebuilt from the log when the store opens.
+
+Only one process may own a log file at a time. Opening a log that another process holds
+raises OrderLogLocked, instead of two processes issuing the same IDs.
+"""
+import json
+import os
+import queue
+import secrets
+import threading
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from utils import now_ts
+
+
+class OrderLogLocked(RuntimeError):
+    pass
+
+
+def _lock_file(path):
+    """Open `path` and take an exclusive, non-blocking lock on it; the OS drops it if the process dies."""
+    f = open(path, "a+b")
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class OrderStore:
+    def __init__(self, path=None, prefix="MOCKORD", max_batch=1024, node=None):
+        self.path = path
+        self.prefix = prefix
+        self.node = node or secrets.token_hex(4).upper()
+        self.max_batch = max_batch
+        self.stats = {"orders": 0, "batches": 0, "recovered": 0, "corrupt": 0}
+        self._orders = {}
+        self._seq = 0
+        self._durable_seq = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._lock_handle = None
+
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._lock_handle = _lock_file(path + ".lock")
+            if self._lock_handle is None:
+                raise OrderLogLocked(f"order log {path} is in use by another process; give each service, "
+                                     f"daemon or app its own log")
+            self._recover()
+            self._durable_seq = self._seq
+            self._size = os.path.getsize(path) if os.path.exists(path) else 0
+            self._file = open(path, "ab")
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+            self._thread.start()
+
+    def _recover(self):
+        """Rebuild the index and sequence from the log, dropping a torn final line."""
+        if not os.path.exists(self.path):
+            return
+        good_end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partial write from a crash; truncated below
+                good_end += len(line)
+                try:
+                    rec = json.loads(line)
+                    seq, order = int(rec["seq"]), rec["order"]
+                except (ValueError, KeyError, TypeError):
+                    self.stats["corrupt"] += 1
+                    continue
+                self._orders[order["order_id"]] = order
+                self._seq = max(self._seq, seq)
+                self.stats["recovered"] += 1
+        if good_end < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(good_end)
+
+    def create(self, order, wait=True):
+        """
+        Assign an ID to `order` (a dict), store it and return the stored copy.
+        With a log, the order is published once it is fsynced; wait=True blocks until then
+        and raises if the write failed.
+        """
+        with self._lock:
+            self._seq += 1
+            stored = dict(order, order_id=f"{self.prefix}-{self.node}-{self._seq:06d}", created_at=now_ts())
+            if self._file is None:
+                self._orders[stored["order_id"]] = stored
+                self.stats["orders"] += 1
+                return stored
+            line = json.dumps({"seq": self._seq, "order": stored}, separators=(",", ":"), default=str)
+            fut = Future()
+            # Queued under the lock so the log is in sequence order
+            self._queue.put((line.encode("utf-8") + b"\n", fut, self._seq, stored))
+        if wait:
+            fut.result()
+        return stored
+
+    def get(self, order_id):
+        return self._orders.get(order_id)
+
+    def __len__(self):
+        return len(self._orders)
+
+    def _writer_loop(self):
+        while True:
+            item = self._queue.get()
+            batch, stop = [], False
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                stop = True
+            if batch:
+                self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch):
+        data = b"".join(item[0] for item in batch)
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception as e:
+            self._discard_tail()
+            with self._lock:
+                # Give the sequence back unless later orders were numbered after this batch
+                if self._seq == batch[-1][2]:
+                    self._seq = self._durable_seq
+            for _, fut, _, _ in batch:
+                fut.set_exception(e)
+            return
+        self._size += len(data)
+        with self._lock:
+            for _, _, seq, stored in batch:
+                self._orders[stored["order_id"]] = stored
+            self._durable_seq = batch[-1][2]
+            self.stats["orders"] += len(batch)
+            self.stats["batches"] += 1
+        for _, fut, _, _ in batch:
+            fut.set_result(None)
+
+    def _discard_tail(self):
+        """Cut the log back to its last durable size after a failed write, dropping buffered bytes too."""
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        try:
+            with open(self.path, "r+b") as f:
+                f.truncate(self._size)
+            self._file = open(self.path, "ab")
+        except OSError:
+            pass  # later writes fail on the closed file and report it to their callers
+
+    def close(self):
+        """Write out everything queued, then close the log."""
+        if self._file is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        self._file = None
+        self._lock_handle.close()
+        self._lock_handle = None
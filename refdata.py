@@ -0,0 +1,253 @@
+# refdata.py
+"""
+Immutable reference tables (medication catalogue, interactions, pharmacy list) stored as
+memory-mapped column files, so every local worker process reads the same physical pages
+instead of holding its own pandas copy.
+
+    refdata = load_reference_data("data/refdata")   # builds on first use, then attaches
+    Orchestrator(refdata=refdata)
+
+Each table is a directory with meta.json plus one file per column. Numeric columns are
+.npy arrays. Text columns are one UTF-8 blob with int64 offsets, and are decoded only
+for the rows actually read. Values that aren't scalars (e.g. a pharmacy's `services`
+list) are stored as JSON text. Tables are built into a directory named after the
+source files' sizes and mtimes, so editing a CSV triggers a rebuild and running
+workers keep reading the old version safely.
+
+Lookups derived from the tables are stored the same way, so they are shared too: the
+drug interaction index as edge rows sorted by drug name (searched with bisect), and the
+OTC catalogue with lowercased indications (searched as one blob).
+"""
+import bisect
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from agents.therapy_agent import interaction_edges, otc_rows
+
+# Part of the version: bump when the exported layout (e.g. the derived lookups) changes
+FORMAT = 3
+DEFAULT_SOURCES = {
+    "meds": "data/meds.csv",
+    "interactions": "data/interactions.csv",
+    "pharmacies": "data/pharmacies.json",
+}
+
+
+class StringColumn:
+    """Read-only sequence of strings over a memory-mapped UTF-8 blob; missing values read as NaN."""
+
+    def __init__(self, blob, offsets, nulls=None, as_json=False):
+        self.blob = blob
+        self.offsets = offsets
+        self.nulls = nulls
+        self.as_json = as_json
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.nulls is not None and self.nulls[i]:
+            return float("nan")
+        text = self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+        return json.loads(text) if self.as_json else text
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class SharedTable:
+    """
+    Memory-mapped, read-only table. Supports the DataFrame access the agents use:
+    table[column], iterrows(), len(), plus records() for list-of-dict style access.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.n_rows = meta["rows"]
+        self.columns = [c["name"] for c in meta["columns"]]
+        self._data = {}
+        for col in meta["columns"]:
+            base = os.path.join(path, col["file"])
+            if col["kind"] == "num":
+                self._data[col["name"]] = np.load(base + ".npy", mmap_mode="r")
+            else:
+                nulls = np.load(base + ".nulls.npy", mmap_mode="r") if col.get("nulls") else None
+                blob = np.load(base + ".blob.npy", mmap_mode="r")
+                offsets = np.load(base + ".offsets.npy", mmap_mode="r")
+                self._data[col["name"]] = StringColumn(blob, offsets, nulls, col["kind"] == "json")
+
+    def __len__(self):
+        return self.n_rows
+
+    def __getitem__(self, column):
+        return self._data[column]
+
+    def row(self, i):
+        return {name: self._data[name][i] for name in self.columns}
+
+    def iterrows(self):
+        for i in range(self.n_rows):
+            yield i, self.row(i)
+
+    def records(self):
+        return RecordView(self)
+
+    def to_pandas(self):
+        return pd.DataFrame({name: list(self._data[name]) for name in self.columns})
+
+
+class RecordView:
+    """List-like view of a SharedTable's rows as dicts, decoded when accessed."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.table)
+        if not 0 <= i < len(self.table):
+            raise IndexError(i)
+        return self.table.row(i)
+
+    def __iter__(self):
+        return (self.table.row(i) for i in range(len(self.table)))
+
+
+def _save_strings(base, values, as_json=False):
+    nulls = np.array([v is None or (isinstance(v, float) and v != v) for v in values], dtype=bool)
+    encoded = [b"" if null else (json.dumps(v) if as_json else str(v)).encode("utf-8")
+               for v, null in zip(values, nulls)]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    np.save(base + ".blob.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(base + ".offsets.npy", offsets)
+    if nulls.any():
+        np.save(base + ".nulls.npy", nulls)
+    return bool(nulls.any())
+
+
+def export_table(df, path):
+    """Write a DataFrame as a SharedTable directory."""
+    os.makedirs(path, exist_ok=True)
+    columns = []
+    for i, name in enumerate(df.columns):
+        base = os.path.join(path, f"c{i}")
+        values = df[name]
+        col = {"name": name, "file": f"c{i}"}
+        if values.dtype.kind in "iufb":
+            np.save(base + ".npy", values.to_numpy())
+            col["kind"] = "num"
+        else:
+            as_json = any(isinstance(v, (list, dict)) for v in values)
+            col["kind"] = "json" if as_json else "str"
+            col["nulls"] = _save_strings(base, list(values), as_json)
+        columns.append(col)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"rows": len(df), "columns": columns}, f)
+
+
+def _read_source(path):
+    if path.endswith(".json"):
+        with open(path) as f:
+            return pd.DataFrame(json.load(f))
+    return pd.read_csv(path)
+
+
+def _sources_version(sources):
+    h = hashlib.sha256(f"format:{FORMAT}".encode())
+    for name in sorted(sources):
+        st = os.stat(sources[name])
+        h.update(f"{name}:{os.path.abspath(sources[name])}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()[:16]
+
+
+def build_reference_data(root, sources=None):
+    """Export the source tables under root/<version>/ unless that version exists. Returns its path."""
+    sources = dict(sources or DEFAULT_SOURCES)
+    final = os.path.join(root, _sources_version(sources))
+    if os.path.exists(os.path.join(final, "COMPLETE")):
+        return final
+    os.makedirs(root, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=".build_", dir=root)
+    frames = {name: _read_source(path) for name, path in sources.items()}
+    for name, df in frames.items():
+        export_table(df, os.path.join(tmp, name))
+    edges = pd.DataFrame(interaction_edges(frames["interactions"]),
+                         columns=["drug", "other", "other_name", "level", "note"])
+    export_table(edges, os.path.join(tmp, "interaction_index"))
+    otc = pd.DataFrame(otc_rows(frames["meds"]), columns=["indications", "age_min", "keywords", "sku", "drug_name"])
+    export_table(otc, os.path.join(tmp, "otc_catalogue"))
+    open(os.path.join(tmp, "COMPLETE"), "w").close()
+    try:
+        os.rename(tmp, final)
+    except OSError:
+        # Another worker finished the same version first; use theirs
+        shutil.rmtree(tmp, ignore_errors=True)
+    return final
+
+
+class SharedInteractionIndex:
+    """The drug interaction index over shared edge rows; get() returns what the in-memory dict would."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def get(self, drug, default=None):
+        drugs = self.table["drug"]
+        lo = bisect.bisect_left(drugs, drug)
+        hi = bisect.bisect_right(drugs, drug, lo)
+        if lo == hi:
+            return default
+        other, name, level, note = (self.table[c] for c in ("other", "other_name", "level", "note"))
+        return {other[i]: (name[i], level[i], note[i]) for i in range(lo, hi)}
+
+
+class SharedOtcCatalogue:
+    """therapy_agent.OtcCatalogue over a shared table: matching() searches the indications blob in place."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def matching(self, condition):
+        column = self.table["indications"]
+        offsets = column.offsets
+        rows = set()
+        # The lookahead finds overlapping matches too; each candidate row is then checked on its own
+        pattern = re.compile(b"(?=" + re.escape(condition.encode("utf-8")) + b")")
+        for m in pattern.finditer(memoryview(column.blob)):
+            i = bisect.bisect_right(offsets, m.start()) - 1
+            if i not in rows and any(condition in ind for ind in column[i].split(";")):
+                rows.add(i)
+        return [(column[i], int(self.table["age_min"][i]), self.table["keywords"][i], self.table["sku"][i],
+                 self.table["drug_name"][i]) for i in sorted(rows)]
+
+
+class ReferenceData:
+    """
+    The attached tables: `meds` and `interactions` (SharedTable) and `pharmacies` (RecordView),
+    plus the therapy lookups stored next to them, which every agent shares:
+    `interaction_index` (SharedInteractionIndex) and `otc_catalogue` (SharedOtcCatalogue).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meds = SharedTable(os.path.join(path, "meds"))
+        self.interactions = SharedTable(os.path.join(path, "interactions"))
+        self.pharmacies = SharedTable(os.path.join(path, "pharmacies")).records()
+        self.interaction_index = SharedInteractionIndex(SharedTable(os.path.join(path, "interaction_index")))
+        self.otc_catalogue = SharedOtcCatalogue(SharedTable(os.path.join(path, "otc_catalogue")))
+
+
+def load_reference_data(root="data/refdata", sources=None):
+    return ReferenceData(build_reference_data(root, sources))
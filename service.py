@@ -0,0 +1,331 @@
+# service.py
+"""
+Standalone HTTP/JSON triage service.
+
+    python service.py --port 8080 --workers 4 --queue-size 32 --timeout 60
+
+POST /triage  {"xray_path": ..., "pdf_path": ..., "patient_info": {...},
+               "patient_lat": ..., "patient_lon": ... | "pincode": ...,
+               "include_log": "summary" | "full" | "none"}  -> plan JSON
+GET  /health  -> queue depth, worker count and request counters
+
+Requests are validated before they are queued; xray_path and pdf_path must lie inside
+the input root (--input-root, default uploads/). Jobs go through a bounded queue to a
+pool of warm orchestrators. A full queue answers 429, a job that does not finish within
+the timeout answers 504 and is stopped before its next pipeline stage, and SIGTERM/SIGINT
+drains queued and in-flight jobs before the server exits.
+"""
+import argparse
+import json
+import math
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import CancelledError, Future, TimeoutError as FutureTimeout
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from agents.orchestrator import LOG_MODES, InvalidRequest, Orchestrator
+from agents.pharmacy_agent import PharmacyAgent
+from agents.pharmacy_shards import ShardedPharmacyRouter
+from agents.doctor_escalation_agent import DoctorScheduler
+from agents.imaging_agent import ImagingAgent, ImagingBatcher
+from agents.ocr_batch import TesseractBatcher
+import tracing
+from order_store import OrderStore
+from refdata import load_reference_data
+from utils import SingleFlight, to_compact_json
+
+RUN_ARGS = ("pdf_path", "patient_info", "patient_lat", "patient_lon", "pincode", "include_log")
+
+
+def default_orchestrator_factory(batch_size=8, batch_wait_ms=5, intra_op_threads=None, inter_op_threads=None,
+                                 orders_log=None, pharmacy_shards=0, refdata_dir=None, ocr_batch_size=8,
+                                 ocr_workers=None):
+    """
+    Orchestrators built by this factory share one pharmacy store, one doctor scheduler and
+    one order store (durable when `orders_log` is set), and coalesce identical jobs that are
+    in flight on different workers. When the CNN is available they also share one
+    micro-batching imaging front-end. With `pharmacy_shards` > 0 the pharmacy store is split
+    by geographic cell across that many worker processes. With `refdata_dir` (not allowed
+    together with `pharmacy_shards`), reference tables are memory-mapped from there and
+    shared with other processes on the node.
+    With `ocr_batch_size` > 1, OCR from all workers is grouped into multi-image tesseract runs,
+    `ocr_workers` of them (default: one per core) at a time.
+    """
+    if refdata_dir and pharmacy_shards > 0:
+        # The shard workers load pharmacies from data/pharmacies.json, not the shared tables
+        raise ValueError("refdata_dir can't be combined with pharmacy_shards")
+    refdata = load_reference_data(refdata_dir) if refdata_dir else None
+    if pharmacy_shards > 0:
+        pharmacy = ShardedPharmacyRouter(n_shards=pharmacy_shards)
+    else:
+        pharmacy = PharmacyAgent(pharmacies=refdata.pharmacies if refdata else None)
+    scheduler = DoctorScheduler()
+    single_flight = SingleFlight()
+    order_store = OrderStore(orders_log)
+    imaging = ImagingAgent(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+    if imaging.model is not None and batch_size > 1:
+        imaging = ImagingBatcher(imaging, max_batch_size=batch_size, max_wait_ms=batch_wait_ms)
+    ocr = TesseractBatcher(max_batch_size=ocr_batch_size, workers=ocr_workers) if ocr_batch_size > 1 else None
+    return lambda: Orchestrator(pharmacy=pharmacy, scheduler=scheduler, single_flight=single_flight,
+                                imaging=imaging, order_store=order_store, refdata=refdata, ocr=ocr)
+
+
+def validate_request(request, input_root):
+    """
+    Check and normalise a /triage body before it is queued. Raises InvalidRequest for
+    missing or mistyped fields and for input paths outside `input_root`.
+    """
+    if not isinstance(request, dict):
+        raise InvalidRequest("request body must be a JSON object")
+    out = dict(request)
+    root = os.path.realpath(input_root)
+    for field in ("xray_path", "pdf_path"):
+        path = request.get(field)
+        if path is None and field == "pdf_path":
+            continue
+        if not isinstance(path, str) or not path:
+            raise InvalidRequest(f"{field} is required" if path is None else f"{field} must be a string")
+        if os.path.commonpath([root, os.path.realpath(path)]) != root:
+            raise InvalidRequest(f"{field} must be inside {input_root}")
+    for field in ("patient_lat", "patient_lon"):
+        if field in request:
+            value = request[field]
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise InvalidRequest(f"{field} must be a number")
+            out[field] = float(value)
+    if "pincode" in request:
+        if not isinstance(request["pincode"], (str, int)) or isinstance(request["pincode"], bool):
+            raise InvalidRequest("pincode must be a string")
+        out["pincode"] = str(request["pincode"])
+    if request.get("patient_info") is not None and not isinstance(request["patient_info"], dict):
+        raise InvalidRequest("patient_info must be an object")
+    if "include_log" in request and request["include_log"] not in LOG_MODES:
+        raise InvalidRequest(f"include_log must be one of {LOG_MODES}")
+    return out
+
+
+class _Job(Future):
+    """A queued request's future. abandon() cancels it, or stops it between stages once it runs."""
+
+    def __init__(self, request):
+        super().__init__()
+        self.request = request
+        self.abandoned = threading.Event()
+
+    def abandon(self):
+        self.abandoned.set()
+        self.cancel()
+
+
+class TriageService:
+    def __init__(self, workers=2, queue_size=32, timeout_s=60, orchestrator_factory=None, input_root="uploads"):
+        self.timeout_s = timeout_s
+        self.input_root = input_root
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.stats = {"accepted": 0, "rejected": 0, "completed": 0, "failed": 0, "timed_out": 0, "abandoned": 0}
+        self._stats_lock = threading.Lock()
+        # Taken by submit and drain, so no job is queued behind the workers' stop sentinels
+        self._submit_lock = threading.Lock()
+        self._accepting = True
+
+        factory = orchestrator_factory or default_orchestrator_factory()
+        # Build every orchestrator up front so the first requests don't pay model/data loading
+        self._workers = [threading.Thread(target=self._worker_loop, args=(factory(),), daemon=True)
+                         for _ in range(workers)]
+        for t in self._workers:
+            t.start()
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def submit(self, request):
+        """
+        Queue a validated triage request (see validate_request). Returns a Future, or None
+        if the queue is full or draining.
+        """
+        job = _Job(request)
+        with self._submit_lock:
+            if not self._accepting:
+                return None
+            try:
+                self.jobs.put_nowait(job)
+            except queue.Full:
+                self._count("rejected")
+                return None
+        self._count("accepted")
+        return job
+
+    def _worker_loop(self, orch):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            request = job.request
+            # Skip jobs whose caller already gave up while they were queued
+            if not job.set_running_or_notify_cancel():
+                self._count("abandoned")
+                continue
+            try:
+                kwargs = {"include_log": "summary"}
+                kwargs.update((k, request[k]) for k in RUN_ARGS if k in request)
+                plan = None
+                for stage, output in orch.run_iter(request["xray_path"], **kwargs):
+                    if stage == "plan":
+                        plan = output
+                    elif job.abandoned.is_set():
+                        # Nobody waits for this plan; don't reserve stock or create an order for it
+                        break
+                if plan is None:
+                    job.set_exception(CancelledError())
+                    self._count("abandoned")
+                    continue
+                job.set_result(to_compact_json(plan))
+                self._count("completed")
+            except Exception as e:
+                job.set_exception(e)
+                self._count("failed")
+            finally:
+                # A warm orchestrator would otherwise keep every past run's events
+                orch.event_log.events = []
+
+    def health(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {
+            "status": "ok" if self._accepting else "draining",
+            "queue_depth": self.jobs.qsize(),
+            "workers": len(self._workers),
+            "stats": stats,
+        }
+
+    def drain(self, timeout=None):
+        """Stop accepting work, let queued and running jobs finish, then stop the workers."""
+        with self._submit_lock:
+            self._accepting = False
+        for _ in self._workers:
+            self.jobs.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for t in self._workers:
+            t.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+
+class TriageRequestHandler(BaseHTTPRequestHandler):
+    server_version = "TriageService/1.0"
+
+    def _send_json(self, status, body, headers=None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, self.server.service.health())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/triage":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = validate_request(json.loads(self.rfile.read(length) or b"{}"), self.server.service.input_root)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        service = self.server.service
+        fut = service.submit(request)
+        if fut is None:
+            if service.health()["status"] == "draining":
+                self._send_json(503, {"error": "service is draining"})
+            else:
+                self._send_json(429, {"error": "triage queue is full"}, {"Retry-After": "1"})
+            return
+
+        try:
+            self._send_json(200, fut.result(timeout=service.timeout_s))
+        except FutureTimeout:
+            fut.abandon()
+            service._count("timed_out")
+            self._send_json(504, {"error": f"triage did not finish within {service.timeout_s}s"})
+        except FileNotFoundError as e:
+            self._send_json(404, {"error": str(e)})
+        except InvalidRequest as e:
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(service, host="127.0.0.1", port=8080):
+    server = ThreadingHTTPServer((host, port), TriageRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the triage pipeline as a local HTTP/JSON service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=60, help="per-request timeout in seconds")
+    parser.add_argument("--input-root", default="uploads", help="xray_path and pdf_path must lie inside this folder")
+    parser.add_argument("--batch-size", type=int, default=8, help="max images per CNN forward pass (1 disables)")
+    parser.add_argument("--batch-wait-ms", type=float, default=5, help="max time a request waits for a batch")
+    parser.add_argument("--intra-op-threads", type=int, default=None,
+                        help="TensorFlow threads per op; with N services per node use cores // N")
+    parser.add_argument("--inter-op-threads", type=int, default=None, help="TensorFlow concurrent ops")
+    parser.add_argument("--trace-file", default=None, help="append OTLP/JSON traces of sampled runs here")
+    parser.add_argument("--trace-sample-rate", type=float, default=0.1, help="fraction of runs to trace")
+    parser.add_argument("--pharmacy-shards", type=int, default=0,
+                        help="partition pharmacies and inventory by geo cell across N processes (0 = in-process)")
+    parser.add_argument("--refdata", default=None,
+                        help="memory-map reference tables from this directory, shared by all local workers")
+    parser.add_argument("--orders-log", default="data/orders-service.jsonl",
+                        help="append-only order log, owned by one process at a time ('' keeps orders in memory only)")
+    parser.add_argument("--ocr-batch-size", type=int, default=8, help="max images per tesseract run (1 disables)")
+    parser.add_argument("--ocr-workers", type=int, default=None,
+                        help="concurrent batched tesseract runs (default: one per core)")
+    args = parser.parse_args()
+    if args.refdata and args.pharmacy_shards > 0:
+        parser.error("--refdata can't be combined with --pharmacy-shards: shards load data/pharmacies.json")
+
+    if args.trace_file:
+        tracing.configure(sample_rate=args.trace_sample_rate, path=args.trace_file)
+    factory = default_orchestrator_factory(args.batch_size, args.batch_wait_ms,
+                                           args.intra_op_threads, args.inter_op_threads, args.orders_log or None,
+                                           args.pharmacy_shards, args.refdata, args.ocr_batch_size,
+                                           args.ocr_workers)
+    service = TriageService(workers=args.workers, queue_size=args.queue_size, timeout_s=args.timeout,
+                            orchestrator_factory=factory, input_root=args.input_root)
+    server = make_server(service, args.host, args.port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Triage service listening on http://{args.host}:{args.port} ({args.workers} workers)")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    stop.wait()
+
+    print("Draining triage queue...")
+    service.drain()
+    server.shutdown()
+    print("Triage service stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# tests/conftest.py
+import stat
+import sys
+
+import pytest
+
+from agents.ingestion_agent import shutdown_ocr_pools
+
+# Stands in for the tesseract binary, both as pytesseract calls it (`tesseract <image>
+# <output base> ... txt`) and with a list file (`tesseract <list> stdout ...`). Every page
+# reads as "<width> frame <k>" followed by a form feed, as tesseract's text renderer writes
+# it. Runs are recorded in the log file; a 13 px wide image makes the run fail and a 77 px
+# wide one hangs. Paths are baked into the script because OCR pool workers don't share the
+# test's environment.
+FAKE_TESSERACT = '''#!{python}
+import os, sys, time
+from PIL import Image
+args = sys.argv[1:]
+with open({log!r}, "a") as log:
+    log.write(" ".join(args[2:]) + "\\n")
+with open({pids!r}, "a") as f:
+    f.write(f"{{os.getpid()}}\\n")
+listed = args[1] == "stdout"
+out = []
+for path in (open(args[0]).read().split() if listed else [args[0]]):
+    img = Image.open(path)
+    for k in range(getattr(img, "n_frames", 1)):
+        img.seek(k)
+        if img.width == 13:
+            sys.exit("Error in pixReadStream")
+        if img.width == 77:
+            time.sleep(30)
+        out.append(f"{{img.width}} frame {{k}}\\n\\f")
+if listed:
+    sys.stdout.write("".join(out))
+else:
+    with open(args[1] + ".txt", "w") as f:
+        f.write("".join(out))
+'''
+
+
+class FakeTesseract:
+    def __init__(self, tmp_path):
+        self.cmd = str(tmp_path / "tesseract")
+        self.log = tmp_path / "runs.log"
+        self.pid_file = tmp_path / "pids.log"
+        self.log.write_text("")
+        self.pid_file.write_text("")
+        with open(self.cmd, "w") as f:
+            f.write(FAKE_TESSERACT.format(python=sys.executable, log=str(self.log), pids=str(self.pid_file)))
+        st = (tmp_path / "tesseract").stat()
+        (tmp_path / "tesseract").chmod(st.st_mode | stat.S_IEXEC)
+
+    def runs(self):
+        return self.log.read_text().splitlines()
+
+    def pids(self):
+        return [int(p) for p in self.pid_file.read_text().split()]
+
+
+@pytest.fixture
+def fake_tesseract(tmp_path):
+    yield FakeTesseract(tmp_path)
+    # OCR pool workers outlive a test otherwise
+    shutdown_ocr_pools()
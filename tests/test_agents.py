@@ -1,5 +1,7 @@
 # tests/test_agents.py
 import os
+import json
+import queue
 import pytest
 from unittest.mock import MagicMock, patch, mock_open
 
@@ -7,6 +9,7 @@ from unittest.mock import MagicMock, patch, mock_open
 from agents.ingestion_agent import IngestionAgent
 from agents.imaging_agent import ImagingAgent
 from agents.therapy_agent import TherapyAgent
+from agents.pharmacy_agent import PharmacyAgent
 from agents.doctor_escalation_agent import DoctorEscalationAgent
 from agents.orchestrator import Orchestrator
 
@@ -45,6 +48,63 @@ def test_ingestion_basic(mock_exists, mock_ocr, mock_pdf, mock_deidentify, tmp_p
     assert "Processed inputs" in log._log[-1]["message"]
 
 
+# --- test_ingestion_scanned_pdf_ocr ---
+def _scanned_pdf(path, widths):
+    from PIL import Image
+    pages = [Image.new("RGB", (w, 60), (255, 255, 255)) for w in widths]
+    pages[0].save(path, "PDF", save_all=True, append_images=pages[1:])
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_ingestion_scanned_pdf_ocr(workers, fake_tesseract, tmp_path):
+    """Tests that scanned PDF pages are OCRed from their embedded images, in page order."""
+    pdf = str(tmp_path / "scan.pdf")
+    _scanned_pdf(pdf, [100, 200, 300])
+    agent = IngestionAgent(ocr_workers=workers, tesseract_cmd=fake_tesseract.cmd)
+    text = agent._extract_text_from_pdf(pdf)
+    assert text.splitlines() == ["100 frame 0", "200 frame 0", "300 frame 0"]
+    assert len(fake_tesseract.runs()) == 3
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_ingestion_ocr_budget(workers, fake_tesseract, tmp_path):
+    """Tests that OCR running past the budget is killed, and the pages it covers are reported."""
+    import time
+    pdf = str(tmp_path / "scan.pdf")
+    _scanned_pdf(pdf, [100, 77, 300])  # the fake tesseract hangs on 77 px wide pages
+    log = MockEventLog()
+    agent = IngestionAgent(event_log=log, ocr_workers=workers, ocr_budget_s=1.5, tesseract_cmd=fake_tesseract.cmd)
+    start = time.monotonic()
+    text = agent._extract_text_from_pdf(pdf)
+    assert time.monotonic() - start < 5
+    assert "100 frame 0" in text and "77 frame 0" not in text
+    report = [e for e in log.to_list() if e["message"] == "OCR of scanned PDF pages incomplete"]
+    assert report and report[0]["data"]["over_budget"] >= 1 and not report[0]["data"]["errors"]
+    # The hung tesseract was killed rather than left running in a pool worker
+    time.sleep(0.5)
+    for pid in fake_tesseract.pids():
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
+
+
+# --- test_prepare_ocr_image ---
+def test_prepare_ocr_image():
+    """Tests grayscale downscaling to the target DPI, or to max_side without a DPI."""
+    from PIL import Image, ImageDraw
+    import numpy as np
+    from agents.ingestion_agent import prepare_ocr_image
+    page = Image.new("RGB", (2400, 3000), (250, 250, 245))
+    page.info["dpi"] = (600, 600)
+    ImageDraw.Draw(page).rectangle((600, 400, 1800, 1000), fill=(20, 20, 20))
+    out = prepare_ocr_image(page, target_dpi=300)
+    assert out.mode == "L" and out.info["dpi"] == (300, 300)
+    # The whole page and its grey levels are kept
+    assert out.size == (1200, 1500) and len(np.unique(np.asarray(out))) > 2
+
+    assert prepare_ocr_image(Image.new("L", (5000, 1000)), max_side=2500).size == (2500, 500)
+    assert prepare_ocr_image(Image.new("L", (800, 600))).size == (800, 600)
+
+
 # --- test_imaging_output ---
 @patch('agents.imaging_agent.TF_AVAILABLE', False)  # Force rule-based fallback
 def test_imaging_output():
@@ -197,4 +257,414 @@ def test_orchestrator_flow(mock_ingest_init, mock_imaging_init, mock_therapy_ini
     # Check that the log was populated
     # Expected logs: Ingestion (1), Imaging (1), Therapy (1), Doctor (1), Pharmacy Find (1), Pharmacy Reserve (1), Orchestrator Final (1) = 7 entries
     assert len(plan["event_log"]) >= 7
-    assert "Run completed" in plan["event_log"][-1]["message"]
\ No newline at end of file
+    assert "Run completed" in plan["event_log"][-1]["message"]
+
+# --- test_pharmacy_inventory_deltas ---
+def test_pharmacy_inventory_deltas(tmp_path):
+    """Tests batched delta application, idempotent replay and new inventory rows."""
+    agent = PharmacyAgent(event_log=MockEventLog())
+    feed = tmp_path / "deltas.jsonl"
+    feed.write_text("\n".join(json.dumps(d) for d in [
+        {"seq": 1, "pharmacy_id": "ph001", "sku": "OTC001", "qty_delta": -45},
+        {"seq": 2, "pharmacy_id": "ph001", "sku": "OTC001", "qty_delta": 10, "price": 30},
+        {"seq": 3, "pharmacy_id": "ph003", "sku": "OTC001", "qty": 5, "price": 20},
+        {"pharmacy_id": "ph003", "sku": "OTC001", "qty": 1},
+    ]))
+
+    res = agent.consume_inventory_feed(str(feed), batch_size=2)
+    assert res == {"applied": 3, "skipped": 0, "rejected": 1, "seq": 3}
+
+    # Replaying the same feed is a no-op
+    res = agent.consume_inventory_feed(str(feed))
+    assert res["applied"] == 0 and res["skipped"] == 3
+
+    assert agent.reserve_items("ph001", "OTC001", qty=15) is True
+    assert agent.reserve_items("ph001", "OTC001", qty=1) is False
+    match = agent.find_nearest_with_stock(19.1, 72.86, "OTC001")
+    assert match["pharmacy_id"] == "ph003"
+    assert match["items"][0]["price"] == 20.0
+
+
+# --- test_pharmacy_rejects_malformed_deltas ---
+def test_pharmacy_rejects_malformed_deltas():
+    """Tests that bad deltas and queue items are counted and skipped without stopping the batch."""
+    agent = PharmacyAgent(event_log=MockEventLog())
+    feed = queue.Queue()
+    for item in [{"seq": 1, "pharmacy_id": "ph001", "sku": "OTC001", "qty": "lots"},
+                 "{not json",
+                 {"seq": 2, "pharmacy_id": "ph001", "sku": "OTC001", "qty_delta": None},
+                 {"seq": 3, "pharmacy_id": "ph001", "sku": "OTC001", "price": "nan"},
+                 {"seq": 4, "pharmacy_id": ["ph001"], "sku": "OTC001", "qty": 1},
+                 42,
+                 json.dumps({"seq": 5, "pharmacy_id": "ph001", "sku": "OTC001", "qty": 7, "price": 12}),
+                 None]:
+        feed.put(item)
+    assert agent.consume_inventory_feed(feed) == {"applied": 1, "skipped": 0, "rejected": 6, "seq": 5}
+    assert agent.reserve_items("ph001", "OTC001", qty=7) is True
+    assert agent.reserve_items("ph001", "OTC001", qty=1) is False
+
+
+# --- test_pharmacy_delta_new_rows_and_stale_seqs ---
+def test_pharmacy_delta_new_rows_and_stale_seqs():
+    """Tests that unpriced new rows are rejected and out-of-order deltas are counted and logged."""
+    log = MockEventLog()
+    agent = PharmacyAgent(event_log=log)
+    res = agent.apply_inventory_deltas([
+        {"seq": 1, "pharmacy_id": "ph003", "sku": "OTC099", "qty": 4},
+        {"seq": 3, "pharmacy_id": "ph003", "sku": "OTC099", "qty": 4, "price": 8},
+        {"seq": 2, "pharmacy_id": "ph003", "sku": "OTC099", "qty_delta": 10},
+    ])
+    assert res == {"applied": 1, "skipped": 1, "rejected": 1, "seq": 3}
+    assert agent.find_nearest_with_stock(19.1, 72.86, "OTC099", qty=5) is None
+    skipped = [e for e in log.to_list() if e["message"].startswith("Skipped inventory deltas")]
+    assert skipped[-1]["data"] == {"skipped": 1, "out_of_order": 1, "seq": 3}
+
+
+# --- test_pharmacy_pincode_index ---
+def test_pharmacy_pincode_index(tmp_path):
+    """Tests pincode geocoding, precomputed delivery areas and their refresh."""
+    agent = PharmacyAgent(event_log=MockEventLog())
+    assert agent.geocode("400050") == (19.05, 72.83)
+    assert agent.geocode(999999) is None
+
+    area = agent.pharmacies_for_pincode(400050)
+    assert [p["id"] for p, _ in area] == ["ph002", "ph003", "ph001"]
+    assert area[0][1] == 0.0
+
+    # Same match as the coordinate scan, but served from the precomputed list
+    by_pin = agent.find_nearest_with_stock(0, 0, "OTC003", pincode="400050")
+    assert by_pin == agent.find_nearest_with_stock(19.05, 72.83, "OTC003")
+    assert by_pin["pharmacy_id"] == "ph002"
+
+    agent.set_pharmacies([p for p in agent.pharmacies if p["id"] != "ph002"])
+    assert [p["id"] for p, _ in agent.pharmacies_for_pincode("400050")] == ["ph003", "ph001"]
+    assert agent.find_nearest_with_stock(0, 0, "OTC003", pincode="400050") is None
+
+
+# --- test_deidentify_single_pass ---
+def test_deidentify_single_pass():
+    """Tests the single-pass redactor against the original three-pass rules, whole and chunked."""
+    import re
+    from utils import deidentify_text, deidentify_stream
+
+    def three_pass(text):
+        text = re.sub(r'[\w\.-]+@[\w\.-]+\.\w+', '[REDACTED_EMAIL]', text)
+        text = re.sub(r'\b\d{10}\b', '[REDACTED_PHONE]', text)
+        return re.sub(r'\b\d{4,}\b', '[REDACTED_ID]', text)
+
+    text = ("Contact john.doe@mail.com or 9876543210. MRN-20231187 seen 2024, bp 120/80, "
+            "a@b.com-x@y.com ref 12345abc spo2 96%\nlab.id 4455@lab.in 123")
+    audit = {}
+    assert deidentify_text(text, audit=audit) == three_pass(text)
+    assert audit["counts"] == {"EMAIL": 4, "PHONE": 1, "ID": 2}
+    assert text[audit["spans"][0][0]:audit["spans"][0][1]] == "john.doe@mail.com"
+
+    chunks = [text[i:i + 7] for i in range(0, len(text), 7)]
+    stream_audit = {}
+    assert "".join(deidentify_stream(chunks, audit=stream_audit)) == three_pass(text)
+    assert stream_audit == audit
+
+
+# --- test_doctor_scheduler_concurrent_booking ---
+def test_doctor_scheduler_concurrent_booking(tmp_path):
+    """Tests specialty matching and that concurrent bookings never share a slot."""
+    import threading
+    from datetime import datetime
+    from agents.doctor_escalation_agent import DoctorScheduler
+
+    roster = tmp_path / "doctors.csv"
+    roster.write_text("doctor_id,name,specialty,tele_slot_iso8601\n" + "".join(
+        f"doc{i:03d},Dr. {i},{'Chest' if i % 2 else 'General'},2025-10-01T09:00:00\n" for i in range(20)))
+    scheduler = DoctorScheduler(str(roster), slot_minutes=15)
+
+    specialties = scheduler.specialties_for(["Imaging shows severe pneumonia risk."])
+    assert specialties == ["chest", "general"]
+
+    booked = []
+
+    def worker():
+        for _ in range(50):
+            booked.append(scheduler.book(specialties, not_before=datetime(2025, 10, 1, 9, 40)))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert all(b["specialty"] == "Chest" for b in booked)
+    assert len({(b["doctor_id"], b["tele_slot"]) for b in booked}) == len(booked) == 400
+    assert min(b["tele_slot"] for b in booked) == "2025-10-01T09:45:00"
+
+
+# --- test_clinical_rule_matcher ---
+def test_clinical_rule_matcher():
+    """Tests the rule-table automaton against plain substring checks and its use for red flags."""
+    from utils import PhraseMatcher, load_clinical_rules
+
+    phrases = ["he", "she", "his", "hers", "chest pain", "pain"]
+    text = "Ushers report CHEST PAIN since his checkup"
+    expected = [i for i, p in enumerate(phrases) if p in text.lower()]
+    assert PhraseMatcher(phrases).find(text) == expected
+
+    rules = load_clinical_rules()
+    flags = [r["value"] for r in rules.find("shortness of breath and chest pain", rule="red_flag")]
+    assert flags == ["Chest pain reported — advise immediate emergency care.",
+                     "Shortness of breath reported — advise immediate emergency care."]
+    assert load_clinical_rules() is rules
+
+
+def test_clinical_rules_reload_on_change(tmp_path):
+    """Tests that an edited rules file is picked up by the next load."""
+    import os
+    from utils import load_clinical_rules
+
+    path = tmp_path / "rules.csv"
+    path.write_text("phrase,rule,value\nwheeze,red_flag,Wheezing\n", encoding="utf-8")
+    first = load_clinical_rules(str(path))
+    assert [r["value"] for r in first.find("a wheeze")] == ["Wheezing"]
+
+    path.write_text("phrase,rule,value\nwheeze,red_flag,Wheezing\nrash,red_flag,Rash\n", encoding="utf-8")
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+    second = load_clinical_rules(str(path))
+    assert second is not first and [r["value"] for r in second.find("rash")] == ["Rash"]
+
+
+# --- test_therapy_interactions ---
+def test_therapy_interactions():
+    """Tests that suggestions are checked against current medications in both pair directions."""
+    agent = TherapyAgent(event_log=MockEventLog())
+    patient = {"age": 45, "allergies": [], "notes": "", "medications": ["warfarin ", "Metformin"]}
+
+    out = agent.suggest_otc({"normal": 0.1, "pneumonia": 0.2, "fever": 0.7}, patient)
+    para = next(s for s in out["otc_options"] if s["drug_name"] == "Paracetamol")
+    assert para["interactions"] == [{"with": "warfarin", "level": "moderate", "note": "May increase INR"}]
+    assert any("Interaction with warfarin" in w for w in para["warnings"])
+
+    ors = next(s for s in out["otc_options"] if s["drug_name"] == "ORS Solution")
+    assert ors["interactions"] == []
+
+    # A comma-separated string is a list of names, not of characters
+    patient["medications"] = "Metformin, warfarin"
+    out = agent.suggest_otc({"fever": 0.7}, patient)
+    para = next(s for s in out["otc_options"] if s["drug_name"] == "Paracetamol")
+    assert [i["with"] for i in para["interactions"]] == ["warfarin"]
+
+
+def test_interaction_edges_fill_missing_fields():
+    """Tests that blank level/note cells become "" in the index and the exported edges."""
+    import pandas as pd
+    from agents.therapy_agent import build_interaction_index, interaction_edges
+    inter = pd.DataFrame({"drug_a": ["Paracetamol"], "drug_b": ["Warfarin"],
+                          "level": [float("nan")], "note": [float("nan")]})
+    assert all(edge[3:] == ("", "") for edge in interaction_edges(inter))
+    index = build_interaction_index(inter)
+    assert json.loads(json.dumps(index["warfarin"]["paracetamol"], allow_nan=False))[1:] == ["", ""]
+
+
+# --- test_single_flight_coalescing ---
+def test_single_flight_coalescing(tmp_path):
+    """Tests that concurrent identical jobs share one computation and keys follow content."""
+    import threading
+    import time
+    from utils import SingleFlight, triage_key
+
+    xray = tmp_path / "a.png"
+    xray.write_bytes(b"scan-1")
+    copy_of_xray = tmp_path / "b.png"
+    copy_of_xray.write_bytes(b"scan-1")
+    patient = {"age": 40, "allergies": ["dust"]}
+    key = triage_key(str(xray), None, patient)
+    assert key == triage_key(str(copy_of_xray), None, dict(patient))
+    assert key != triage_key(str(xray), None, {"age": 41, "allergies": ["dust"]})
+
+    flight = SingleFlight()
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"plan": len(calls)}
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do(key, compute))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert [r[0] for r in results] == [{"plan": 1}] * 5
+    assert sum(leader for _, leader in results) == 1 and flight.coalesced == 4
+
+
+# --- test_orchestrator_slim_plan ---
+def test_orchestrator_slim_plan(tmp_path):
+    """Tests per-run event logs, $ref pointers into the plan and the log modes."""
+    from PIL import Image
+    from utils import SingleFlight, resolve_refs, to_compact_json
+
+    xray = tmp_path / "pneumonia_scan.png"
+    Image.new("RGB", (64, 64)).save(xray)
+    patient = {"age": 30, "allergies": [], "notes": "cough and fever"}
+
+    # The last one shares an imaging agent, as the service's workers do
+    for orch in (Orchestrator(), Orchestrator(single_flight=SingleFlight()), Orchestrator(imaging=ImagingAgent())):
+        orch.run(str(xray), patient_info=patient)
+        plan = orch.run(str(xray), patient_info=patient)
+        events = plan["event_log"]
+        # Only this run's events, ending with the completion event
+        assert [e["message"] for e in events].count("Run completed") == 1
+        assert events[-1]["message"] == "Run completed"
+        imaging_event = next(e for e in events if e["source"] == "ImagingAgent")
+        assert imaging_event["data"] == {"$ref": "#/imaging"}
+        assert resolve_refs(imaging_event["data"], plan) == plan["imaging"]
+        # The match was logged before it was reserved, and the log still says so
+        matched = next(e for e in events if e["message"] == "Matched pharmacy")
+        assert "reserved" not in matched["data"] and plan["pharmacy_matches"][0]["match"]["reserved"] is True
+        therapy_event = next(e for e in events if e["source"] == "TherapyAgent")
+        assert therapy_event["data"]["suggestions"] == {"$ref": "#/therapy/otc_options"}
+        # The orchestrator's own log keeps the full data
+        assert orch.event_log.events[-1]["data"] == {"order_created": True}
+
+        summary = orch.run(str(xray), patient_info=patient, include_log="summary")["event_log"]
+        assert set(summary[0]) == {"ts", "source", "message"}
+        slim = orch.run(str(xray), patient_info=patient, include_log="none")
+        assert "event_log" not in slim and slim["order"]["order_id"].startswith("MOCKORD-")
+        assert json.loads(to_compact_json(slim)) == json.loads(json.dumps(slim, default=str))
+
+    with pytest.raises(ValueError):
+        orch.run(str(xray), include_log="verbose")
+
+
+# --- test_orchestrator_run_iter ---
+def test_orchestrator_run_iter(tmp_path):
+    """Tests that run_iter yields each stage as it completes, then the same plan run() returns."""
+    from PIL import Image
+    from utils import SingleFlight
+
+    xray = tmp_path / "pneumonia_scan.png"
+    Image.new("RGB", (64, 64)).save(xray)
+    patient = {"age": 30, "allergies": [], "notes": "cough and fever"}
+
+    orch = Orchestrator()
+    seen, outputs = [], {}
+    for stage, output in orch.run_iter(str(xray), patient_info=patient):
+        # Later stages have not run yet when an earlier one is yielded
+        if stage == "imaging":
+            assert "Run completed" not in [e["message"] for e in orch.event_log.events]
+        seen.append(stage)
+        outputs[stage] = output
+    assert seen == ["ingestion", "imaging", "therapy", "doctor_escalation", "pharmacy_matches", "order", "plan"]
+    plan = outputs["plan"]
+    assert plan["order"] is outputs["order"] and plan["imaging"] is outputs["imaging"]
+    assert plan["event_log"][-1]["message"] == "Run completed"
+
+    coalescing = Orchestrator(single_flight=SingleFlight())
+    assert [stage for stage, _ in coalescing.run_iter(str(xray), patient_info=patient)] == seen
+
+
+# --- test_imaging_prediction_cache ---
+class FakeModel:
+    """Counts forward passes; always favours pneumonia."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def predict(self, batch, **kwargs):
+        import numpy as np
+        self.calls += 1
+        return np.tile([0.1, 0.8, 0.1], (len(batch), 1))
+
+
+def test_imaging_prediction_cache(tmp_path):
+    """Tests cache hits by image content and invalidation when the model file changes."""
+    from PIL import Image
+
+    model_file = tmp_path / "imaging_cnn.h5"
+    model_file.write_bytes(b"weights-v1")
+    xray = tmp_path / "scan.png"
+    Image.new("RGB", (128, 128), (200, 200, 200)).save(xray)
+    same_scan = tmp_path / "scan_copy.png"
+    same_scan.write_bytes(xray.read_bytes())
+
+    models = []
+    fake_load = lambda path: models.append(FakeModel()) or models[-1]
+    with patch('agents.imaging_agent.TF_AVAILABLE', True), \
+            patch('agents.imaging_agent.load_model', side_effect=fake_load, create=True):
+        agent = ImagingAgent(event_log=MockEventLog(), model_path=str(model_file))
+        first = agent.predict(str(xray))
+        second = agent.predict(str(same_scan))
+        assert first["condition_probs"] == second["condition_probs"] == {
+            "normal": 0.1, "pneumonia": 0.8, "covid_suspect": 0.1}
+        assert second["severity_hint"] == "severe" and second["meta"]["cache"] == "hit"
+        assert models[0].calls == 1
+        assert agent.cache.stats()["hits"] == 1 and agent.cache.stats()["misses"] == 1
+
+        model_file.write_bytes(b"weights-version-2")
+        third = agent.predict(str(xray))
+        assert len(models) == 2 and models[1].calls == 1
+        assert third["meta"]["cache"] == "miss"
+
+
+def test_imaging_reload_keeps_serving_old_model(tmp_path):
+    """Tests that the old model stays usable until the new one is fully built."""
+    from PIL import Image
+
+    model_file = tmp_path / "imaging_cnn.h5"
+    model_file.write_bytes(b"weights-v1")
+    xray = tmp_path / "scan.png"
+    Image.new("RGB", (32, 32), (90, 90, 90)).save(xray)
+
+    models, seen_during_load = [], []
+
+    def fake_load(path):
+        if models:
+            # Mid-reload, requests already past the file check still see the old model
+            snapshot = agent._snapshot
+            seen_during_load.append((agent.model, agent.model_checksum, agent._forward([[0.0]], snapshot)))
+        models.append(FakeModel())
+        return models[-1]
+
+    with patch('agents.imaging_agent.TF_AVAILABLE', True), \
+            patch('agents.imaging_agent.load_model', side_effect=fake_load, create=True):
+        agent = ImagingAgent(model_path=str(model_file))
+        old_checksum = agent.model_checksum
+        model_file.write_bytes(b"weights-version-2")
+        agent.predict(str(xray))
+
+    model, checksum, probs = seen_during_load[0]
+    assert model is models[0] and checksum == old_checksum
+    assert list(probs[0]) == [0.1, 0.8, 0.1]
+    assert agent.model is models[1] and agent.model_checksum != old_checksum
+
+
+# --- test_imaging_batcher ---
+def test_imaging_batcher(tmp_path):
+    """Tests that concurrent requests share forward passes and a bad input fails alone."""
+    from PIL import Image
+    from agents.imaging_agent import ImagingBatcher
+
+    model_file = tmp_path / "imaging_cnn.h5"
+    model_file.write_bytes(b"weights")
+    scans = []
+    for i in range(12):
+        path = tmp_path / f"scan{i}.png"
+        Image.new("RGB", (32, 32), (i * 10, 0, 0)).save(path)
+        scans.append(str(path))
+
+    model = FakeModel()
+    with patch('agents.imaging_agent.TF_AVAILABLE', True), \
+            patch('agents.imaging_agent.load_model', return_value=model, create=True):
+        batcher = ImagingBatcher(ImagingAgent(model_path=str(model_file)), max_batch_size=4, max_wait_ms=100)
+        futures = [batcher.submit(p) for p in scans]
+        bad = batcher.submit(str(tmp_path / "missing.png"))
+        results = [f.result(timeout=5) for f in futures]
+        with pytest.raises(FileNotFoundError):
+            bad.result(timeout=5)
+        batcher.close()
+
+    assert [r["meta"]["file"] for r in results] == [f"scan{i}.png" for i in range(12)]
+    assert all(r["condition_probs"]["pneumonia"] == 0.8 for r in results)
+    assert model.calls == 3
+    assert batcher.stats()["batch_sizes"] == {4: 3, 1: 1}
@@ -0,0 +1,72 @@
+# tests/test_dataset_shards.py
+import os
+
+import numpy as np
+from PIL import Image
+
+from dataset_shards import build_shards, open_shards, iter_batches, load_manifest
+
+
+def _make_image(path, shade):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new("RGB", (100, 80), (shade, shade, shade)).save(path)
+
+
+def test_shards_incremental_and_memmapped(tmp_path):
+    """Tests fixed-shape uint8 shards, incremental rebuilds and read-only memory maps."""
+    src, out = tmp_path / "xrays", tmp_path / "shards"
+    for i in range(3):
+        _make_image(src / "normal" / f"n{i}.png", 10 + i)
+    _make_image(src / "pneumonia" / "p0.png", 200)
+
+    assert build_shards(str(src), str(out), shard_size=2) == 4
+    assert [s["count"] for s in load_manifest(str(out))["shards"]] == [2, 2]
+
+    # Nothing new: no shards written. A new image and a byte-identical copy: one new shard.
+    assert build_shards(str(src), str(out), shard_size=2) == 0
+    _make_image(src / "covid_suspect" / "c0.png", 120)
+    (src / "normal" / "copy.png").write_bytes((src / "normal" / "n0.png").read_bytes())
+    assert build_shards(str(src), str(out), shard_size=2) == 1
+    assert len(load_manifest(str(out))["shards"]) == 3
+
+    shards = open_shards(str(out))
+    images, labels = shards[0]
+    assert isinstance(images, np.memmap) and not images.flags.writeable
+    assert images.shape == (2, 64, 64, 3) and images.dtype == np.uint8
+
+    all_labels = np.concatenate([labels for _, labels in iter_batches(str(out), batch_size=1)])
+    assert all_labels.tolist() == [0, 0, 0, 1, 2]
+    last_images, _ = shards[-1]
+    assert int(last_images[0, 0, 0, 0]) == 120
+
+
+def test_shards_drop_changed_and_deleted_images(tmp_path):
+    """Tests that stale copies leave the shards and that identical files in two classes keep both labels."""
+    src, out = tmp_path / "xrays", tmp_path / "shards"
+    for i in range(3):
+        _make_image(src / "normal" / f"n{i}.png", 10 + i)
+    assert build_shards(str(src), str(out), shard_size=2) == 3
+
+    # Same content as n0 in another class is stored again; under the same class it is not
+    (src / "pneumonia").mkdir()
+    (src / "pneumonia" / "p0.png").write_bytes((src / "normal" / "n0.png").read_bytes())
+    (src / "normal" / "copy.png").write_bytes((src / "normal" / "n0.png").read_bytes())
+    assert build_shards(str(src), str(out), shard_size=2) == 1
+
+    def contents():
+        return sorted((int(label), int(img[0, 0, 0])) for images, labels in open_shards(str(out))
+                      for img, label in zip(images, labels))
+
+    assert contents() == [(0, 10), (0, 11), (0, 12), (1, 10)]
+
+    # n1 changes and n2 is deleted: their old images go, n0's is kept for copy.png
+    _make_image(src / "normal" / "n1.png", 99)
+    (src / "normal" / "n2.png").unlink()
+    (src / "normal" / "n0.png").unlink()
+    assert build_shards(str(src), str(out), shard_size=2) == 1
+    assert contents() == [(0, 10), (0, 99), (1, 10)]
+    manifest = load_manifest(str(out))
+    assert sum(s["count"] for s in manifest["shards"]) == 3
+    assert sorted(f for f in os.listdir(out) if f.endswith(".npy")) == sorted(
+        name for s in manifest["shards"] for name in (s["images"], s["labels"]))
+    assert build_shards(str(src), str(out), shard_size=2) == 0 and contents() == [(0, 10), (0, 99), (1, 10)]
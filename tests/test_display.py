@@ -0,0 +1,37 @@
+# tests/test_display.py
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("plotly")
+
+from utils_display import colorize_json, event_data_html, paginate
+
+
+def test_colorize_json_single_pass():
+    """Tests token coloring, HTML escaping and truncation."""
+    out = colorize_json({"note": "<b>12</b>", "n": 3, "ok": True})
+    assert "&lt;b&gt;12&lt;/b&gt;" in out and "<b>" not in out
+    # Digits inside strings stay part of the string
+    assert '<span style="color:#FFB74D;">12</span>' not in out
+    assert '<span style="color:#FFB74D;">3</span>' in out
+    assert '<span style="color:#CE93D8;">true</span>' in out
+    assert "more characters" in colorize_json({"k": "v" * 100}, max_chars=20)
+
+
+def test_event_html_cache_and_pagination():
+    """Tests truncation flags, cached rendering and page clamping."""
+    event = {"ts": "t1", "source": "ImagingAgent", "message": "Predicted", "data": {"x": "y" * 5000}}
+    preview, truncated = event_data_html(event, cache_key=("run-a", 0))
+    assert truncated and len(preview) < 3000
+    assert event_data_html(event, cache_key=("run-a", 0)) is event_data_html(event, cache_key=("run-a", 0))
+    full, truncated = event_data_html(event, max_chars=None, cache_key=("run-a", 0))
+    assert not truncated and "y" * 5000 in full
+    # Same event index in another run (e.g. another session's patient)
+    other = dict(event, data={"x": "z"})
+    assert "z" in event_data_html(other, cache_key=("run-b", 0))[0]
+    assert "y" not in event_data_html(other, cache_key=("run-b", 0))[0]
+    # Uncached rendering
+    assert "z" in event_data_html(other)[0]
+
+    assert paginate(list(range(45)), 3, 20) == ([40, 41, 42, 43, 44], 3, 3)
+    assert paginate([], 5, 20) == ([], 1, 1)
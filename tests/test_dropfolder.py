@@ -0,0 +1,96 @@
+# tests/test_dropfolder.py
+import json
+import os
+
+from dropfolder import DropFolderDaemon, Ledger
+
+
+class FakeOrchestrator:
+    def __init__(self, calls):
+        self.calls = calls
+        self.event_log = type("Log", (), {"events": []})()
+
+    def run(self, xray_path, **kwargs):
+        self.calls.append((os.path.basename(xray_path), kwargs))
+        if "broken" in xray_path:
+            raise ValueError("not an image")
+        return {"xray": os.path.basename(xray_path), "patient_info": kwargs.get("patient_info")}
+
+
+def _daemon(tmp_path, calls, **kwargs):
+    return DropFolderDaemon(str(tmp_path / "in"), outbox_dir=str(tmp_path / "out"), settle_s=0,
+                            orchestrator_factory=lambda: FakeOrchestrator(calls), **kwargs)
+
+
+def test_dropfolder_pairs_inputs_and_survives_restart(tmp_path):
+    inbox = tmp_path / "in"
+    inbox.mkdir()
+    (inbox / "a.png").write_bytes(b"xray-a")
+    (inbox / "a.pdf").write_bytes(b"%PDF-a")
+    (inbox / "a.json").write_text(json.dumps({"age": 40, "pincode": "400001"}))
+    (inbox / "b.jpg").write_bytes(b"xray-b")
+    (inbox / "broken.png").write_bytes(b"??")
+    (inbox / "orphan.pdf").write_bytes(b"%PDF-o")
+
+    calls = []
+    daemon = _daemon(tmp_path, calls, queue_size=1)
+    daemon.run_once()
+    daemon.drain()
+    by_name = dict(calls)
+    assert sorted(by_name) == ["a.png", "b.jpg", "broken.png"]
+    assert by_name["a.png"]["pdf_path"].endswith("a.pdf")
+    assert by_name["a.png"]["patient_info"] == {"age": 40}
+    assert by_name["a.png"]["pincode"] == "400001"
+    assert by_name["b.jpg"]["pdf_path"] is None
+    assert daemon.stats["completed"] == 2 and daemon.stats["failed"] == 1
+
+    out = sorted(os.listdir(tmp_path / "out"))
+    assert len([n for n in out if n.endswith(".plan.json")]) == 2
+    assert len([n for n in out if n.endswith(".error.json")]) == 1
+
+    # Restart: nothing is processed again, even after a rename; an edited file is
+    (inbox / "b.jpg").rename(inbox / "b2.jpg")
+    (inbox / "a.json").write_text(json.dumps({"age": 41}))
+    calls.clear()
+    daemon = _daemon(tmp_path, calls)
+    daemon.run_once()
+    daemon.drain()
+    assert [c[0] for c in calls] == ["a.png"]
+
+    # A plan written before a crash, but missing from the ledger, is not recomputed
+    os.remove(tmp_path / "in" / ".triage_state.jsonl")
+    calls.clear()
+    daemon = _daemon(tmp_path, calls)
+    daemon.run_once()
+    daemon.drain()
+    assert [c[0] for c in calls] == ["broken.png"]
+    assert daemon.stats["recovered"] == 2
+
+
+def test_ledger_ignores_torn_line(tmp_path):
+    path = str(tmp_path / "state.jsonl")
+    Ledger(path).record("k1", "done")
+    with open(path, "a") as f:
+        f.write('{"key": "k2", "sta')
+    ledger = Ledger(path)
+    assert set(ledger.done) == {"k1"} and not ledger.failed
+    # The torn line is cut off, so the next record is not glued onto it
+    ledger.record("k3", "done")
+    assert set(Ledger(path).done) == {"k1", "k3"}
+
+
+def test_dropfolder_worker_survives_unwritable_outbox(tmp_path):
+    inbox = tmp_path / "in"
+    inbox.mkdir()
+    (inbox / "a.png").write_bytes(b"xray-a")
+    calls = []
+    daemon = _daemon(tmp_path, calls, workers=1)
+    os.rmdir(tmp_path / "out")  # plans can't be written
+    daemon.run_once()
+    assert daemon.stats["errors"] == 1 and not daemon.ledger.done
+    # The same worker still takes new jobs
+    os.mkdir(tmp_path / "out")
+    (inbox / "b.png").write_bytes(b"xray-b")
+    daemon.run_once()
+    daemon.drain()
+    assert daemon.stats["completed"] == 1 and [c[0] for c in calls] == ["a.png", "b.png"]
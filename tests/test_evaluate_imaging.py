@@ -0,0 +1,63 @@
+# tests/test_evaluate_imaging.py
+from unittest.mock import patch
+
+import numpy as np
+from PIL import Image
+
+from dataset_shards import build_shards
+from evaluate_imaging import evaluate, quality_metrics
+
+
+def test_quality_metrics_confusion_and_calibration():
+    """Tests the confusion matrix orientation and calibration on a hand-checked example."""
+    labels = [0, 1, 2, 2]
+    probs = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0], [0.0, 1.0, 0.0]]
+    metrics = quality_metrics(labels, probs)
+    assert metrics["accuracy"] == 0.75
+    assert metrics["confusion_matrix"]["matrix"] == [[1, 0, 0], [0, 1, 0], [0, 1, 1]]
+    assert metrics["per_class"]["pneumonia"] == {"support": 1, "precision": 0.5, "recall": 1.0}
+    # Every prediction is fully confident, so calibration error is the error rate
+    assert metrics["ece"] == 0.25
+    assert metrics["brier"] == 0.5
+
+
+def test_evaluate_rules_backend(tmp_path):
+    """Tests an end-to-end report over a labelled directory with the rule-based backend."""
+    for cls, name in [("normal", "normal_1.png"), ("pneumonia", "pneumonia_1.png"), ("covid_suspect", "covid_1.png"),
+                      ("pneumonia", "scan_2.png")]:
+        (tmp_path / cls).mkdir(exist_ok=True)
+        Image.new("RGB", (8, 8)).save(tmp_path / cls / name)
+
+    report = evaluate(str(tmp_path), backend="rules", model_path=str(tmp_path / "no_model.h5"), batch_size=3)
+    assert report["images"] == 4
+    assert report["accuracy"] == 0.75
+    assert report["confusion_matrix"]["matrix"][1] == [1, 1, 0]
+    assert report["throughput"]["images_per_sec"] > 0
+    assert set(report["throughput"]["per_image_latency_ms"]) == {"p50", "p95", "p99"}
+
+
+class BrightnessModel:
+    """Stands in for the CNN: probabilities that follow the image's mean brightness."""
+
+    def predict(self, batch, **kwargs):
+        b = np.asarray(batch).mean(axis=(1, 2, 3)) * 0.9
+        return np.stack([b, 0.9 - b, np.full(len(b), 0.1)], axis=1)
+
+
+def test_evaluate_scores_files_and_shards_alike(tmp_path):
+    """Tests that the file and shard paths report the same quality metrics for the same images."""
+    src = tmp_path / "xrays"
+    for label, cls in enumerate(["normal", "pneumonia", "covid_suspect"]):
+        (src / cls).mkdir(parents=True)
+        for i in range(3):
+            Image.new("RGB", (64, 64), (37 * i + 11 * label,) * 3).save(src / cls / f"{i}.png")
+    build_shards(str(src), str(tmp_path / "shards"))
+    model_file = tmp_path / "imaging_cnn.h5"
+    model_file.write_bytes(b"weights")
+
+    with patch("agents.imaging_agent.TF_AVAILABLE", True), \
+            patch("agents.imaging_agent.load_model", return_value=BrightnessModel(), create=True):
+        files = evaluate(str(src), backend="cnn", model_path=str(model_file), batch_size=4)
+        shards = evaluate(shards_dir=str(tmp_path / "shards"), backend="cnn", model_path=str(model_file), batch_size=4)
+    for key in ("images", "accuracy", "confusion_matrix", "per_class", "ece", "brier"):
+        assert files[key] == shards[key], key
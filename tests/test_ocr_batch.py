@@ -0,0 +1,71 @@
+# tests/test_ocr_batch.py
+import threading
+
+import pytest
+from PIL import Image
+
+from agents.ingestion_agent import IngestionAgent
+from agents.ocr_batch import TesseractBatcher, tesseract_batch
+
+
+def test_tesseract_batch_splits_pages_per_image(fake_tesseract, tmp_path):
+    cmd, runs = fake_tesseract.cmd, fake_tesseract.runs
+    tiff = tmp_path / "two.tif"
+    Image.new("L", (30, 10)).save(tiff, save_all=True, append_images=[Image.new("L", (30, 10))])
+    images = [Image.new("RGB", (10, 10)), Image.open(tiff), Image.new("L", (20, 10))]
+    out = tesseract_batch(images, tesseract_cmd=cmd, psm=6)
+    assert out == [["10 frame 0\n"], ["30 frame 0\n", "30 frame 1\n"], ["20 frame 0\n"]]
+    assert runs() == ["--psm 6"]
+
+
+def test_batcher_groups_threads_and_isolates_bad_images(fake_tesseract):
+    cmd, runs = fake_tesseract.cmd, fake_tesseract.runs
+    batcher = TesseractBatcher(max_batch_size=8, max_wait_ms=300, tesseract_cmd=cmd)
+    widths = [10, 11, 13, 14, 15]
+    results = {}
+
+    def ocr(w):
+        try:
+            results[w] = batcher.image_to_string(Image.new("L", (w, 10)))
+        except RuntimeError as e:
+            results[w] = e
+
+    threads = [threading.Thread(target=ocr, args=(w,)) for w in widths]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+    assert results[10] == "10 frame 0\n" and results[15] == "15 frame 0\n"
+    assert isinstance(results[13], RuntimeError)
+    # One failed run for the whole batch, then one run per image
+    assert batcher.stats()["batch_sizes"] == {5: 1}
+    assert len(runs()) == 1 + len(widths)
+
+
+@pytest.mark.parametrize("workers,runs", [(1, 1), (2, 2)])
+def test_ingestion_uses_batched_runs_for_scanned_pdf(workers, runs, fake_tesseract, tmp_path):
+    """One tesseract run per OCR pool worker (or one through the batcher), pages kept in order."""
+    pdf = str(tmp_path / "scan.pdf")
+    pages = [Image.new("RGB", (w, 60), (255, 255, 255)) for w in (100, 200, 300)]
+    pages[0].save(pdf, "PDF", save_all=True, append_images=pages[1:])
+    batcher = TesseractBatcher(max_batch_size=8, max_wait_ms=50, tesseract_cmd=fake_tesseract.cmd)
+    agent = IngestionAgent(ocr_workers=workers, ocr_batcher=batcher, tesseract_cmd=fake_tesseract.cmd)
+    text = agent._extract_text_from_pdf(pdf)
+    batcher.close()
+    assert text.splitlines() == ["100 frame 0", "200 frame 0", "300 frame 0"]
+    assert len(fake_tesseract.runs()) == runs
+
+
+def test_batcher_prepares_images_off_the_caller_thread(fake_tesseract):
+    batcher = TesseractBatcher(max_wait_ms=1, workers=2, tesseract_cmd=fake_tesseract.cmd)
+    assert len(batcher._threads) == 2
+    threads = []
+
+    def prepare(img):
+        threads.append(threading.current_thread())
+        return img.resize((40, 10))
+
+    assert batcher.image_to_string(Image.new("L", (20, 10)), prepare) == "40 frame 0\n"
+    batcher.close()
+    assert threads and threading.current_thread() not in threads
@@ -0,0 +1,87 @@
+# tests/test_order_store.py
+import os
+import threading
+
+import pytest
+
+import order_store
+from order_store import OrderLogLocked, OrderStore
+
+
+def test_order_store_in_memory_ids_are_unique():
+    """Tests monotonic IDs and lookup without a log file."""
+    store = OrderStore()
+    first = store.create({"items": [{"sku": "OTC001"}]})
+    second = store.create({"items": []})
+    prefix = f"MOCKORD-{store.node}-"
+    assert first["order_id"] == prefix + "000001" and second["order_id"] == prefix + "000002"
+    assert store.get(prefix + "000001")["items"] == [{"sku": "OTC001"}]
+    assert store.get(prefix + "999999") is None
+    # Stores in other processes start their own sequence under a different node part
+    assert OrderStore().create({"items": []})["order_id"] != first["order_id"]
+
+
+def test_order_store_group_commit_and_recovery(tmp_path):
+    """Tests concurrent durable writes, recovery and dropping a torn final line."""
+    path = tmp_path / "orders.jsonl"
+    store = OrderStore(str(path))
+    ids = []
+
+    def worker():
+        for _ in range(50):
+            ids.append(store.create({"items": []})["order_id"])
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    store.close()
+
+    assert len(set(ids)) == 400
+    # Concurrent writers share fsyncs
+    assert store.stats["batches"] < 400
+
+    with open(path, "ab") as f:
+        f.write(b'{"seq": 401, "order": {"order_id": "MOCKO')  # crash mid-write
+    reopened = OrderStore(str(path))
+    assert len(reopened) == 400 and reopened.stats["recovered"] == 400
+    assert reopened.get(ids[0]) is not None
+    assert reopened.create({"items": []})["order_id"].endswith("-000401")
+    reopened.close()
+    assert len(path.read_text().splitlines()) == 401
+
+
+def test_order_store_log_has_one_owner(tmp_path):
+    """Tests that a second store cannot open a log that is already in use."""
+    path = str(tmp_path / "orders.jsonl")
+    store = OrderStore(path)
+    with pytest.raises(OrderLogLocked):
+        OrderStore(path)
+    store.close()
+    OrderStore(path).close()
+
+
+def test_order_store_publishes_only_durable_orders(tmp_path, monkeypatch):
+    """Tests that an order whose fsync fails is neither visible nor left in the log."""
+    path = tmp_path / "orders.jsonl"
+    store = OrderStore(str(path))
+    kept = store.create({"items": []})
+    real_fsync = os.fsync
+
+    def broken_fsync(fd):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(order_store.os, "fsync", broken_fsync)
+    with pytest.raises(OSError):
+        store.create({"items": ["lost"]})
+    assert len(store) == 1 and store.stats["orders"] == 1
+    monkeypatch.setattr(order_store.os, "fsync", real_fsync)
+
+    again = store.create({"items": []})
+    assert again["order_id"].endswith("-000002")
+    store.close()
+    assert len(path.read_text().splitlines()) == 2
+    reopened = OrderStore(str(path))
+    assert reopened.get(kept["order_id"]) and reopened.get(again["order_id"])
+    reopened.close()
@@ -0,0 +1,145 @@
+# tests/test_pharmacy_shards.py
+import json
+import os
+import queue
+import random
+import signal
+
+import pandas as pd
+import pytest
+
+from agents.pharmacy_agent import PharmacyAgent
+from agents.pharmacy_shards import ShardedPharmacyRouter, cells_within, geo_cell
+
+
+@pytest.fixture
+def network(tmp_path):
+    """Pharmacies clustered around two cities ~1,000 km apart, with random stock."""
+    rng = random.Random(7)
+    pharmacies, rows = [], []
+    for city, (lat, lon) in enumerate([(19.1, 72.85), (28.6, 77.2)]):
+        for i in range(60):
+            pid = f"ph{city}{i:03d}"
+            pharmacies.append({"id": pid, "name": pid, "lat": lat + rng.uniform(-0.3, 0.3),
+                               "lon": lon + rng.uniform(-0.3, 0.3), "delivery_km": rng.choice([5, 8, 12])})
+            for sku in rng.sample(["OTC001", "OTC002", "OTC003", "OTC004"], 2):
+                rows.append({"pharmacy_id": pid, "sku": sku, "drug_name": sku, "form": "tab", "strength": "-",
+                             "price": round(rng.uniform(10, 100), 2), "qty": rng.randint(0, 3)})
+    (tmp_path / "pharmacies.json").write_text(json.dumps(pharmacies))
+    pd.DataFrame(rows).to_csv(tmp_path / "inventory.csv", index=False)
+    (tmp_path / "zipcodes.csv").write_text("pincode,lat,lon\n400050,19.1,72.85\n110001,28.6,77.2\n")
+    return str(tmp_path / "pharmacies.json"), str(tmp_path / "inventory.csv")
+
+
+def test_cells_within_covers_radius():
+    """Tests that the query cells include every cell a point within the radius can fall in."""
+    cells = set(cells_within(19.1, 72.85, 12, 0.05))
+    for dlat, dlon in [(0.1, 0.0), (-0.1, 0.0), (0.0, 0.11), (0.0, -0.11)]:
+        assert geo_cell(19.1 + dlat, 72.85 + dlon, 0.05) in cells
+
+
+def test_sharded_router_matches_single_agent(network, tmp_path):
+    """Tests that routed, merged matches equal the single-process agent and stay local."""
+    pharmacies_json, inventory_csv = network
+    single = PharmacyAgent(pharmacies_json, inventory_csv, zipcodes_csv=None)
+    router = ShardedPharmacyRouter(pharmacies_json, inventory_csv, zipcodes_csv=None, n_shards=8, cell_deg=0.2,
+                                   work_dir=str(tmp_path / "shards"))
+    try:
+        stats = router.shard_stats()
+        assert sum(s["pharmacies"] for s in stats) == 120
+        assert sum(s["inventory_rows"] for s in stats) == len(single.inventory_df)
+        assert max(s["inventory_rows"] for s in stats) < len(single.inventory_df)
+
+        rng = random.Random(1)
+        for _ in range(40):
+            lat, lon = 19.1 + rng.uniform(-0.3, 0.3), 72.85 + rng.uniform(-0.3, 0.3)
+            sku = rng.choice(["OTC001", "OTC002", "OTC003", "OTC004"])
+            expected = single.find_nearest_with_stock(lat, lon, sku)
+            assert router.find_nearest_with_stock(lat, lon, sku) == expected
+            if expected:
+                assert router.reserve_items(expected["pharmacy_id"], sku) is True
+                assert single.reserve_items(expected["pharmacy_id"], sku) is True
+
+        # A 12 km radius overlaps at most 2x2 cells of 0.2 degrees, so only those shards are asked
+        before = list(router.requests)
+        router.find_nearest_with_stock(28.6, 77.2, "OTC001")
+        touched = [k for k in range(8) if router.requests[k] > before[k]]
+        assert touched == router.shards_for(28.6, 77.2) and 0 < len(touched) <= 4
+
+        res = router.apply_inventory_deltas([{"seq": 1, "pharmacy_id": "ph0000", "sku": "OTC009", "qty": 5, "price": 9.5},
+                                             {"seq": 2, "pharmacy_id": "nope", "sku": "OTC009", "qty": 5, "price": 9.5}])
+        assert res == {"applied": 1, "skipped": 0, "rejected": 1, "seq": 1}
+        assert router.reserve_items("ph0000", "OTC009", qty=5) is True
+    finally:
+        router.close()
+
+
+def test_sharded_router_keeps_cities_on_separate_shards(network, tmp_path):
+    """Tests that neighbouring cells share shards, so a query never reaches the other city's shards."""
+    pharmacies_json, inventory_csv = network
+    router = ShardedPharmacyRouter(pharmacies_json, inventory_csv, zipcodes_csv=None, n_shards=8, cell_deg=0.05,
+                                   work_dir=str(tmp_path / "shards"))
+    try:
+        shard_of = router.owners(p["id"] for p in json.load(open(pharmacies_json)))
+        assert len(shard_of) == 120
+        mumbai = {k for pid, k in shard_of.items() if pid.startswith("ph0")}
+        delhi = {k for pid, k in shard_of.items() if pid.startswith("ph1")}
+        assert not mumbai & delhi
+        rng = random.Random(3)
+        for _ in range(20):
+            shards = router.shards_for(19.1 + rng.uniform(-0.2, 0.2), 72.85 + rng.uniform(-0.2, 0.2))
+            assert set(shards) <= mumbai and len(shards) < 8
+    finally:
+        router.close()
+
+
+def test_sharded_router_pincodes_pharmacy_updates_and_feed(network, tmp_path):
+    """Tests the PharmacyAgent behaviour the router forwards: pincode areas, list updates and the feed."""
+    pharmacies_json, inventory_csv = network
+    zipcodes_csv = str(tmp_path / "zipcodes.csv")
+    single = PharmacyAgent(pharmacies_json, inventory_csv, zipcodes_csv=zipcodes_csv)
+    router = ShardedPharmacyRouter(pharmacies_json, inventory_csv, zipcodes_csv=zipcodes_csv, n_shards=4,
+                                   cell_deg=0.2, work_dir=str(tmp_path / "shards"))
+    try:
+        def ids(area):
+            return [p["id"] for p, _ in area]
+
+        assert ids(router.pharmacies_for_pincode("400050")) == ids(single.pharmacies_for_pincode("400050"))
+        assert router.pharmacies_for_pincode("999999") is None
+
+        # A pharmacy moved next to the Delhi pincode, and a new one there, are found through it
+        moved = [dict(p, lat=28.6, lon=77.2) if p["id"] == "ph0000" else p for p in single.pharmacies]
+        moved.append({"id": "new1", "name": "new1", "lat": 28.601, "lon": 77.2, "delivery_km": 5})
+        router.set_pharmacies(moved)
+        single.set_pharmacies(moved)
+        assert ids(router.pharmacies_for_pincode("110001")) == ids(single.pharmacies_for_pincode("110001"))
+        assert {"ph0000", "new1"} <= set(ids(router.pharmacies_for_pincode("110001")))
+
+        feed = queue.Queue()
+        for item in [{"seq": 1, "pharmacy_id": "new1", "sku": "OTC005", "qty": 2, "price": 12},
+                     json.dumps({"seq": 2, "pharmacy_id": "ph0000", "sku": "OTC005", "qty": 1, "price": 12}), None]:
+            feed.put(item)
+        assert router.consume_inventory_feed(feed) == {"applied": 2, "skipped": 0, "rejected": 0, "seq": 2}
+        match = router.find_nearest_with_stock(0, 0, "OTC005", pincode="110001")
+        assert match["pharmacy_id"] in ("ph0000", "new1")
+    finally:
+        router.close()
+
+
+def test_sharded_router_reports_dead_shard(network, tmp_path):
+    """Tests that a dead shard process gives a clear error and doesn't break the other shards."""
+    pharmacies_json, inventory_csv = network
+    router = ShardedPharmacyRouter(pharmacies_json, inventory_csv, zipcodes_csv=None, n_shards=4, cell_deg=0.2,
+                                   work_dir=str(tmp_path / "shards"))
+    try:
+        shard_of = router.owners(p["id"] for p in json.load(open(pharmacies_json)))
+        dead = shard_of["ph0000"]
+        os.kill(router._procs[dead].pid, signal.SIGKILL)
+        router._procs[dead].join(timeout=5)
+        with pytest.raises(RuntimeError, match=f"shard {dead} .*not running"):
+            router.shard_stats()
+        alive = next(pid for pid, k in shard_of.items() if k != dead)
+        assert router.apply_inventory_deltas([{"seq": 1, "pharmacy_id": alive, "sku": "X", "qty": 1, "price": 5}])["applied"] == 1
+        assert router.reserve_items(alive, "X") is True
+    finally:
+        router.close()
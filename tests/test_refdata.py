@@ -0,0 +1,74 @@
+# tests/test_refdata.py
+import math
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from agents.orchestrator import Orchestrator
+from agents.pharmacy_agent import PharmacyAgent
+from agents.therapy_agent import TherapyAgent
+from refdata import SharedOtcCatalogue, SharedTable, build_reference_data, export_table, load_reference_data
+from service import default_orchestrator_factory
+
+
+def test_shared_table_round_trip(tmp_path):
+    """Tests numeric, text, missing and nested values through memory-mapped columns."""
+    df = pd.DataFrame({"sku": ["A1", "B2", "ç3"], "age_min": [0, 2, 5], "price": [1.5, 2.0, 3.25],
+                       "contra": ["x", None, "z"], "services": [["24x7"], [], ["delivery", "24x7"]]})
+    export_table(df, str(tmp_path / "t"))
+    table = SharedTable(str(tmp_path / "t"))
+
+    assert len(table) == 3 and table.columns == list(df.columns)
+    assert isinstance(table["age_min"], np.memmap) and not table["age_min"].flags.writeable
+    assert list(table["sku"]) == ["A1", "B2", "ç3"]
+    assert math.isnan(table["contra"][1])
+    assert table.row(2) == {"sku": "ç3", "age_min": 5, "price": 3.25, "contra": "z",
+                            "services": ["delivery", "24x7"]}
+    assert table.records()[-1]["services"] == ["delivery", "24x7"]
+
+
+def test_agents_on_shared_reference_data(tmp_path):
+    """Tests that agents give the same answers from shared tables as from the CSVs."""
+    refdata = load_reference_data(str(tmp_path / "refdata"))
+    # Attaching again reuses the built version
+    assert build_reference_data(str(tmp_path / "refdata")) == refdata.path
+    assert len([d for d in os.listdir(tmp_path / "refdata") if not d.startswith(".")]) == 1
+
+    patient = {"age": 30, "allergies": ["paracetamol"], "medications": ["warfarin"], "notes": "fever"}
+    probs = {"pneumonia": 0.7, "normal": 0.2, "covid_suspect": 0.1}
+    shared = TherapyAgent(meds_df=refdata.meds, inter_df=refdata.interactions)
+    assert shared.suggest_otc(probs, dict(patient)) == TherapyAgent().suggest_otc(probs, dict(patient))
+    assert shared.interactions == TherapyAgent().interactions
+    # The lookups served from the shared tables answer like the in-memory ones
+    local = TherapyAgent()
+    for drug in list(local.interactions) + ["not a drug"]:
+        assert refdata.interaction_index.get(drug) == local.interactions.get(drug)
+    for condition in ("pneumonia", "fever", "cough", "covid_suspect", "normal", "a"):
+        assert refdata.otc_catalogue.matching(condition) == local.otc_catalogue.matching(condition)
+
+    # Orchestrators on the same refdata share its lookups instead of building their own
+    first, second = Orchestrator(refdata=refdata), Orchestrator(refdata=refdata)
+    assert first.therapy.interactions is second.therapy.interactions is refdata.interaction_index
+    assert first.therapy.otc_catalogue is refdata.otc_catalogue
+    assert first.therapy.suggest_otc(probs, dict(patient)) == TherapyAgent().suggest_otc(probs, dict(patient))
+    with pytest.raises(ValueError):
+        default_orchestrator_factory(refdata_dir=str(tmp_path / "refdata"), pharmacy_shards=2)
+
+    pharmacy = PharmacyAgent(pharmacies=refdata.pharmacies)
+    assert pharmacy.pharmacies is refdata.pharmacies  # not decoded into a private list
+    assert pharmacy.find_nearest_with_stock(19.1, 72.86, "OTC001") == \
+        PharmacyAgent().find_nearest_with_stock(19.1, 72.86, "OTC001")
+    assert [p["id"] for p, _ in pharmacy.pharmacies_for_pincode("400050")] == ["ph002", "ph003", "ph001"]
+
+
+def test_shared_otc_catalogue_matches_within_rows(tmp_path):
+    """Tests that a match spanning two rows' indications in the shared blob is not a hit."""
+    df = pd.DataFrame({"indications": ["pneu", "monia;cough", "viral pneumonia", "pneumonia pneumonia"],
+                       "age_min": [0, 0, 3, 0], "keywords": [[], ["x"], [], []],
+                       "sku": ["A", "B", "C", "D"], "drug_name": ["a", "b", "c", "d"]})
+    export_table(df, str(tmp_path / "otc"))
+    catalogue = SharedOtcCatalogue(SharedTable(str(tmp_path / "otc")))
+    assert [r[3] for r in catalogue.matching("pneumonia")] == ["C", "D"]
+    assert catalogue.matching("cough") == [("monia;cough", 0, ["x"], "B", "b")]
@@ -0,0 +1,99 @@
+# tests/test_service.py
+import json
+import threading
+import urllib.request
+import urllib.error
+
+from agents.orchestrator import InvalidRequest
+from service import TriageService, make_server
+
+
+class FakeOrchestrator:
+    """Stands in for Orchestrator; blocks until released so queue behaviour can be observed."""
+
+    def __init__(self, release):
+        self.release = release
+        self.event_log = type("Log", (), {"events": []})()
+        self.fulfilled = []
+
+    def run_iter(self, xray_path, **kwargs):
+        yield "ingestion", {}
+        self.release.wait(5)
+        if xray_path == "missing.png":
+            raise FileNotFoundError("X-ray image not found at path: missing.png")
+        if kwargs.get("pincode") == "000000":
+            raise InvalidRequest("Unknown pincode: 000000")
+        if xray_path == "corrupt.png":
+            raise ValueError("cannot reshape array")
+        yield "doctor_escalation", {}
+        # Stock reservation and order creation happen from here on
+        self.fulfilled.append(xray_path)
+        yield "order", None
+        yield "plan", {"xray": xray_path, "patient_lat": kwargs.get("patient_lat")}
+
+
+def _post(port, body):
+    req = urllib.request.Request(f"http://127.0.0.1:{port}/triage", data=json.dumps(body).encode(),
+                                 headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            return resp.status, json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_service_backpressure_and_drain():
+    """Tests 429 on a full queue, plan round-trip over HTTP, and graceful drain."""
+    release = threading.Event()
+    service = TriageService(workers=1, queue_size=1, timeout_s=5,
+                            orchestrator_factory=lambda: FakeOrchestrator(release), input_root=".")
+    server = make_server(service, port=0)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        running = service.submit({"xray_path": "a.png"})   # picked up by the single worker
+        while service.jobs.qsize():
+            pass
+        queued = service.submit({"xray_path": "b.png"})    # fills the queue
+        assert running is not None and queued is not None
+
+        status, body = _post(port, {"xray_path": "c.png"})
+        assert status == 429 and service.stats["rejected"] == 1
+
+        release.set()
+        assert json.loads(queued.result(timeout=5))["xray"] == "b.png"
+        assert _post(port, {"xray_path": "d.png", "patient_lat": 19.0}) == (200, {"xray": "d.png", "patient_lat": 19.0})
+        assert _post(port, {"xray_path": "missing.png"})[0] == 404
+        assert _post(port, {})[0] == 400
+        assert _post(port, {"xray_path": "d.png", "patient_lat": "north"})[0] == 400
+        assert _post(port, {"xray_path": "/etc/passwd"})[0] == 400
+        assert _post(port, {"xray_path": "../d.png"})[0] == 400
+        assert _post(port, {"xray_path": "a.png", "pincode": "000000"})[0] == 400
+        # Internal errors are not the client's fault, even when they are ValueErrors
+        assert _post(port, {"xray_path": "corrupt.png"})[0] == 500
+
+        service.drain(timeout=5)
+        assert service.health()["status"] == "draining"
+        assert _post(port, {"xray_path": "e.png"})[0] == 503
+        assert service.stats["completed"] == 3
+    finally:
+        server.shutdown()
+
+
+def test_service_stops_timed_out_job():
+    """Tests that a job answered with 504 is stopped before it reserves stock or creates an order."""
+    release = threading.Event()
+    orch = FakeOrchestrator(release)
+    service = TriageService(workers=1, queue_size=2, timeout_s=0.2, orchestrator_factory=lambda: orch,
+                            input_root=".")
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        assert _post(server.server_address[1], {"xray_path": "slow.png"})[0] == 504
+        release.set()
+        service.drain(timeout=5)
+        assert orch.fulfilled == []
+        assert service.stats["timed_out"] == 1 and service.stats["abandoned"] == 1
+    finally:
+        server.shutdown()
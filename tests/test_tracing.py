@@ -0,0 +1,137 @@
+# tests/test_tracing.py
+import json
+
+import pytest
+
+import tracing
+from tracing import Tracer, InMemoryExporter, FileExporter, span
+
+
+@pytest.fixture
+def exporter():
+    exp = InMemoryExporter()
+    tracing.configure(sample_rate=1.0, exporter=exp)
+    yield exp
+    tracing.configure(sample_rate=0.0)
+
+
+def test_nested_spans_and_errors(exporter):
+    """Tests parent/child links, attributes, durations and error status."""
+    with span("root", run=1) as root:
+        with span("child", sku="OTC001") as child:
+            child.set_attribute("matched", True)
+        with pytest.raises(KeyError):
+            with span("failing"):
+                raise KeyError("x")
+
+    assert len(exporter.traces) == 1
+    spans = {s.name: s for s in exporter.traces[0]}
+    assert set(spans) == {"root", "child", "failing"}
+    assert spans["child"].parent_span_id == root.span_id == spans["failing"].parent_span_id
+    assert len({s.trace_id for s in spans.values()}) == 1
+    assert spans["child"].attributes == {"sku": "OTC001", "matched": True}
+    assert spans["failing"].status == tracing.STATUS_ERROR
+    assert spans["root"].duration_ms >= spans["child"].duration_ms >= 0
+
+
+def test_head_sampling_is_per_trace():
+    """Tests that the root's sampling decision covers the whole trace."""
+    exp = InMemoryExporter()
+    tracer = Tracer(sample_rate=0.5, exporter=exp)
+    for _ in range(200):
+        with tracer.span("root"):
+            with tracer.span("child"):
+                pass
+    assert 40 < len(exp.traces) < 160
+    assert all(len(t) == 2 for t in exp.traces)
+
+    off = Tracer(sample_rate=0.0, exporter=exp)
+    with off.span("root") as s:
+        assert s is tracing.NOOP_SPAN
+
+
+def test_file_export_is_otlp_json(tmp_path):
+    """Tests one OTLP/JSON ExportTraceServiceRequest per line."""
+    path = tmp_path / "traces" / "t.jsonl"
+    tracer = Tracer(sample_rate=1.0, exporter=FileExporter(str(path)))
+    with tracer.span("triage.run", pincode="400058"):
+        with tracer.span("pharmacy.lookup", qty=1, ratio=0.5):
+            pass
+    doc = json.loads(path.read_text().splitlines()[0])
+    resource = doc["resourceSpans"][0]
+    assert resource["resource"]["attributes"][0] == {"key": "service.name",
+                                                      "value": {"stringValue": "healthcare-triage"}}
+    spans = resource["scopeSpans"][0]["spans"]
+    lookup, run = spans
+    assert len(run["traceId"]) == 32 and len(run["spanId"]) == 16 and "parentSpanId" not in run
+    assert lookup["parentSpanId"] == run["spanId"]
+    assert int(lookup["endTimeUnixNano"]) >= int(lookup["startTimeUnixNano"])
+    assert {"key": "qty", "value": {"intValue": "1"}} in lookup["attributes"]
+    assert {"key": "ratio", "value": {"doubleValue": 0.5}} in lookup["attributes"]
+
+
+def test_orchestrator_run_is_traced(exporter, tmp_path):
+    """Tests spans for each agent call and the per-SKU pharmacy operations."""
+    from PIL import Image
+    from agents.orchestrator import Orchestrator
+
+    xray = tmp_path / "pneumonia_scan.png"
+    Image.new("RGB", (64, 64)).save(xray)
+    Orchestrator().run(str(xray), patient_info={"age": 30, "allergies": [], "notes": "cough"}, pincode="400058")
+
+    spans = exporter.traces[-1]
+    by_id = {s.span_id: s for s in spans}
+    names = [s.name for s in spans]
+    for name in ("triage.run", "IngestionAgent.process_inputs", "ImagingAgent.predict", "TherapyAgent.suggest_otc",
+                 "DoctorEscalationAgent.evaluate", "pharmacy.lookup", "pharmacy.reserve", "OrderStore.create"):
+        assert name in names
+    lookup = next(s for s in spans if s.name == "pharmacy.lookup")
+    assert by_id[lookup.parent_span_id].name == "PharmacyAgent.fulfil_sku"
+    assert lookup.attributes["precomputed_area"] is True
+
+
+def test_batched_work_joins_the_submitting_traces(exporter, tmp_path):
+    """Tests that a micro-batch is traced under one caller's span and linked to the others'."""
+    import threading
+    from PIL import Image
+    from agents.imaging_agent import ImagingAgent, ImagingBatcher
+
+    scans = []
+    for i in range(2):
+        path = tmp_path / f"scan{i}.png"
+        Image.new("RGB", (32, 32), (i, 0, 0)).save(path)
+        scans.append(str(path))
+    batcher = ImagingBatcher(ImagingAgent(model_path=str(tmp_path / "none.h5")), max_batch_size=2,
+                             max_wait_ms=5000)
+    roots = {}
+
+    def caller(i):
+        with span(f"caller{i}") as root:
+            roots[i] = root
+            batcher.submit(scans[i]).result(timeout=5)
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+
+    batches = [s for trace in exporter.traces for s in trace if s.name == "imaging.batch"]
+    assert len(batches) == 1 and batches[0].attributes["batch_size"] == 2
+    owner, other = sorted(roots.values(), key=lambda r: r.trace_id != batches[0].trace_id)
+    assert batches[0].parent_span_id == owner.span_id
+    assert batches[0].links == [(other.trace_id, other.span_id)]
+    otlp = tracing.to_otlp([batches[0]])["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+    assert otlp["links"] == [{"traceId": other.trace_id, "spanId": other.span_id}]
+
+
+def test_record_span_adds_finished_child(exporter):
+    """Tests recording work timed outside the tracer, e.g. in a pool process."""
+    tracing.record_span("orphan", 1, 2)  # no current span: dropped
+    with span("root") as root:
+        tracing.record_span("ocr.pool_job", 10, 20, error="over budget", pages=2)
+    job = next(s for s in exporter.traces[0] if s.name == "ocr.pool_job")
+    assert job.parent_span_id == root.span_id and job.duration_ms == 10 / 1e6
+    assert job.status == tracing.STATUS_ERROR and job.attributes == {"pages": 2}
+    assert len(exporter.traces) == 1 and len(exporter.traces[0]) == 2
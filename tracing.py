@@ -0,0 +1,260 @@
+# tracing.py
+"""
+Lightweight hierarchical tracing for the agent pipeline.
+
+    from tracing import span
+    with span("pharmacy.lookup", sku=sku) as s:
+        ...
+        s.set_attribute("matched", True)
+
+Spans nest through contextvars, so each thread/task sees its own parent. Work handed to
+another thread (a micro-batcher) carries the submitter's contextvars.copy_context() and
+runs under batch_span(), which joins the submitting trace; work timed in another process
+is added with record_span(). The sampling
+decision is made once per trace, at the root span (head sampling). Unsampled traces and
+the default disabled tracer cost little more than a contextvar lookup. Finished traces
+go to an exporter as OpenTelemetry (OTLP/JSON) ExportTraceServiceRequest objects. The
+file exporter writes one per line, the format the OpenTelemetry Collector's file
+receiver reads.
+
+    tracing.configure(sample_rate=0.1, path="traces/triage.jsonl")
+"""
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+STATUS_UNSET, STATUS_OK, STATUS_ERROR = 0, 1, 2
+SPAN_KIND_INTERNAL = 1
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+def _restore(token, parent):
+    try:
+        _current.reset(token)
+    except ValueError:
+        # A span held open across generator yields (e.g. Orchestrator.run_iter) can end
+        # in a different context than it started in
+        _current.set(parent)
+
+
+class Span:
+    __slots__ = ("trace", "trace_id", "span_id", "parent_span_id", "name", "start_ns", "end_ns",
+                 "attributes", "status", "status_message", "links")
+
+    def __init__(self, trace, trace_id, parent_span_id, name, attributes):
+        self.trace = trace  # list of the trace's finished spans, shared by all its spans
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = STATUS_UNSET
+        self.status_message = ""
+        self.links = []
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_status(self, code, message=""):
+        self.status = code
+        self.status_message = message
+
+    def add_link(self, other):
+        """Point at a span of another trace this one also worked for."""
+        self.links.append((other.trace_id, other.span_id))
+
+    @property
+    def duration_ms(self):
+        return None if self.end_ns is None else (self.end_ns - self.start_ns) / 1e6
+
+
+class _NoopSpan:
+    """Stands in for spans of unsampled traces; marks the context as not sampled."""
+    trace_id = span_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_status(self, code, message=""):
+        pass
+
+    def add_link(self, other):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None]
+
+
+def to_otlp(spans, service_name="healthcare-triage"):
+    """An OTLP/JSON ExportTraceServiceRequest dict for a list of finished spans."""
+    out = []
+    for s in spans:
+        span = {"traceId": s.trace_id, "spanId": s.span_id, "name": s.name, "kind": SPAN_KIND_INTERNAL,
+                "startTimeUnixNano": str(s.start_ns), "endTimeUnixNano": str(s.end_ns),
+                "attributes": _otlp_attributes(s.attributes),
+                "status": {"code": s.status, "message": s.status_message} if s.status_message else {"code": s.status}}
+        if s.parent_span_id:
+            span["parentSpanId"] = s.parent_span_id
+        if s.links:
+            span["links"] = [{"traceId": t, "spanId": i} for t, i in s.links]
+        out.append(span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otlp_attributes({"service.name": service_name})},
+        "scopeSpans": [{"scope": {"name": "tracing"}, "spans": out}],
+    }]}
+
+
+class InMemoryExporter:
+    """Keeps finished traces (lists of spans) in memory; handy in tests and notebooks."""
+
+    def __init__(self):
+        self.traces = []
+
+    def export(self, spans, service_name):
+        self.traces.append(spans)
+
+
+class FileExporter:
+    """Appends one OTLP/JSON ExportTraceServiceRequest line per finished trace."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def export(self, spans, service_name):
+        line = json.dumps(to_otlp(spans, service_name), separators=(",", ":")) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+class Tracer:
+    def __init__(self, sample_rate=0.0, exporter=None, service_name="healthcare-triage"):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.service_name = service_name
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Start a span as a child of the current one (or a new, possibly sampled, trace)."""
+        parent = _current.get()
+        if parent is None:
+            if self.sample_rate <= 0 or self.exporter is None or random.random() >= self.sample_rate:
+                token = _current.set(NOOP_SPAN)
+                try:
+                    yield NOOP_SPAN
+                finally:
+                    _restore(token, parent)
+                return
+            span = Span([], "%032x" % random.getrandbits(128), None, name, attributes)
+        elif parent is NOOP_SPAN:
+            yield NOOP_SPAN
+            return
+        else:
+            span = Span(parent.trace, parent.trace_id, parent.span_id, name, attributes)
+
+        token = _current.set(span)
+        try:
+            yield span
+        except GeneratorExit:
+            raise  # the consumer stopped iterating early; not a failure
+        except BaseException as e:
+            span.set_status(STATUS_ERROR, f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _restore(token, parent)
+            span.end_ns = time.time_ns()
+            span.trace.append(span)
+            if parent is None:
+                self._export(span.trace)
+
+    def _export(self, spans):
+        try:
+            self.exporter.export(spans, self.service_name)
+        except Exception:
+            pass  # tracing must never break a triage run
+
+
+_tracer = Tracer()
+
+
+def configure(sample_rate=1.0, path=None, exporter=None, service_name="healthcare-triage"):
+    """Install the process-wide tracer. With neither `path` nor `exporter`, tracing is off."""
+    global _tracer
+    if exporter is None and path:
+        exporter = FileExporter(path)
+    _tracer = Tracer(sample_rate, exporter, service_name)
+    return _tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def span(name, **attributes):
+    """Context manager for a span on the process-wide tracer."""
+    return _tracer.span(name, **attributes)
+
+
+@contextmanager
+def batch_span(name, contexts, **attributes):
+    """
+    Span for work one thread does for several callers, e.g. a micro-batch, given each
+    caller's contextvars.copy_context() from submit time. The span (and spans opened inside
+    it) joins the trace of the first sampled caller and links to the other callers' spans;
+    with no sampled caller nothing is recorded. Meant for threads with no span of their own.
+    """
+    callers = []
+    for ctx in contexts:
+        parent = ctx.get(_current, None)
+        if isinstance(parent, Span) and all(parent is not c for c in callers):
+            callers.append(parent)
+    token = _current.set(callers[0] if callers else NOOP_SPAN)
+    try:
+        with _tracer.span(name, **attributes) as s:
+            for other in callers[1:]:
+                s.add_link(other)
+            yield s
+    finally:
+        _restore(token, None)
+
+
+def record_span(name, start_ns, end_ns, error=None, **attributes):
+    """Add a finished child of the current span for work timed elsewhere (e.g. another process)."""
+    parent = _current.get()
+    if not isinstance(parent, Span):
+        return
+    s = Span(parent.trace, parent.trace_id, parent.span_id, name, attributes)
+    s.start_ns, s.end_ns = start_ns, end_ns
+    if error:
+        s.set_status(STATUS_ERROR, error)
+    parent.trace.append(s)
+
+
+def current_span():
+    s = _current.get()
+    return s if s is not None else NOOP_SPAN
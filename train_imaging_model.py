@@ -1,13 +1,15 @@
 # train_imaging_model.py
+import argparse
 import os
 import numpy as np
 from PIL import Image
 import tensorflow as tf
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Dropout
 from tensorflow.keras.optimizers import Adam
 
+from dataset_shards import CLASS_NAMES, IMAGE_EXTS, open_shards
+
 
 def create_synthetic_dataset():
     """Create a small synthetic dataset for demo purposes"""
@@ -56,72 +58,120 @@ def create_synthetic_dataset():
         print(f"Found {count} images in {path}")
 
 
-def train_model():
-    # Dataset path
-    data_dir = "data/xrays"
-
+IMG_SIZE = (64, 64)
+
+
+def list_labelled_images(data_dir, val_split=0.2, seed=42):
+    """Split <data_dir>/<class>/* into shuffled (paths, labels) train and validation lists, per class."""
+    rng = np.random.default_rng(seed)
+    train, val = ([], []), ([], [])
+    for label, cls in enumerate(CLASS_NAMES):
+        class_dir = os.path.join(data_dir, cls)
+        if not os.path.isdir(class_dir):
+            continue
+        files = sorted(f for f in os.listdir(class_dir) if f.lower().endswith(IMAGE_EXTS))
+        rng.shuffle(files)
+        n_val = int(len(files) * val_split)
+        for i, f in enumerate(files):
+            split = val if i < n_val else train
+            split[0].append(os.path.join(class_dir, f))
+            split[1].append(label)
+    return train, val
+
+
+def _decode_resize(path, label):
+    img = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    # Nearest-neighbour keeps uint8 and matches the inference-time preprocessing
+    img = tf.image.resize(img, IMG_SIZE, method="nearest")
+    img.set_shape(IMG_SIZE + (3,))
+    return img, label
+
+
+def _to_model_input(img, label):
+    return tf.cast(img, tf.float32) / 255.0, tf.one_hot(tf.cast(label, tf.int32), len(CLASS_NAMES))
+
+
+def make_dataset(paths, labels, batch_size, cache="memory", shuffle=True, seed=42):
+    """
+    tf.data input pipeline: parallel decode/resize, cache of the decoded uint8 images
+    (in memory, or on disk when `cache` is a file path), shuffle, batch and prefetch.
+    """
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    ds = ds.map(_decode_resize, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    if cache == "memory":
+        ds = ds.cache()
+    elif cache and cache != "none":
+        os.makedirs(os.path.dirname(cache) or ".", exist_ok=True)
+        ds = ds.cache(cache)
+    if shuffle:
+        ds = ds.shuffle(min(len(paths), 10000), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.map(_to_model_input, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def make_shard_datasets(shards_dir, batch_size, val_split=0.2, seed=42, block=256):
+    """
+    Train/validation pipelines over preprocessed memmap shards (see dataset_shards.py).
+    Contiguous blocks are read straight from the memory maps in shuffled block order,
+    so nothing is decoded and only the pages in use are resident. The split and every
+    epoch's order follow from `seed`.
+    """
+    shards = open_shards(shards_dir)
+    rng = np.random.default_rng(seed)
+    val_masks = [rng.random(len(labels)) < val_split for _, labels in shards]
+
+    def blocks(want_val, shuffle):
+        order_rng = np.random.default_rng(seed)
+
+        def gen():
+            order = [(s, start) for s, (_, labels) in enumerate(shards) for start in range(0, len(labels), block)]
+            if shuffle:
+                order_rng.shuffle(order)
+            for s, start in order:
+                images, labels = shards[s]
+                keep = val_masks[s][start:start + block] == want_val
+                if keep.any():
+                    yield images[start:start + block][keep], labels[start:start + block][keep]
+        return gen
+
+    spec = (tf.TensorSpec((None,) + IMG_SIZE + (3,), tf.uint8), tf.TensorSpec((None,), tf.int8))
+
+    def make(want_val, shuffle):
+        ds = tf.data.Dataset.from_generator(blocks(want_val, shuffle), output_signature=spec).unbatch()
+        if shuffle:
+            ds = ds.shuffle(10000, seed=seed, reshuffle_each_iteration=True)
+        ds = ds.map(_to_model_input, num_parallel_calls=tf.data.AUTOTUNE)
+        return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+    n_val = int(sum(m.sum() for m in val_masks))
+    print(f"Found {sum(len(m) for m in val_masks) - n_val} training and {n_val} validation images in {shards_dir}")
+    return make(False, True), (make(True, False) if n_val else None)
+
+
+def make_file_datasets(data_dir, batch_size, cache="memory", val_split=0.2, seed=42):
     # Create synthetic dataset if it doesn't exist
     if not os.path.exists(data_dir) or not os.listdir(data_dir):
         create_synthetic_dataset()
-    else:
-        # Check if we have images
-        has_images = False
-        for category in ["normal", "pneumonia", "covid_suspect"]:
-            if os.path.exists(f"{data_dir}/{category}") and os.listdir(f"{data_dir}/{category}"):
-                has_images = True
-                break
-
-        if not has_images:
-            create_synthetic_dataset()
-
-    # Image preprocessing
-    img_size = (64, 64)
-    batch_size = 4  # Reduced batch size to avoid issues with small dataset
-
-    datagen = ImageDataGenerator(rescale=1.0 / 255, validation_split=0.2)
-
-    try:
-        train_gen = datagen.flow_from_directory(
-            data_dir,
-            target_size=img_size,
-            batch_size=batch_size,
-            class_mode="categorical",
-            subset="training"
-        )
-
-        val_gen = datagen.flow_from_directory(
-            data_dir,
-            target_size=img_size,
-            batch_size=batch_size,
-            class_mode="categorical",
-            subset="validation"
-        )
-
-        # Check if we have data
-        if train_gen.samples == 0:
-            raise ValueError("No training data found")
-
-    except Exception as e:
-        print(f"Error creating data generators: {e}")
-        print("Creating new synthetic dataset...")
+
+    (train_paths, train_labels), (val_paths, val_labels) = list_labelled_images(data_dir, val_split, seed)
+    if not train_paths:
+        print("No training data found, creating synthetic dataset...")
         create_synthetic_dataset()
+        (train_paths, train_labels), (val_paths, val_labels) = list_labelled_images(data_dir, val_split, seed)
+    print(f"Found {len(train_paths)} training and {len(val_paths)} validation images")
 
-        # Try again
-        train_gen = datagen.flow_from_directory(
-            data_dir,
-            target_size=img_size,
-            batch_size=batch_size,
-            class_mode="categorical",
-            subset="training"
-        )
-
-        val_gen = datagen.flow_from_directory(
-            data_dir,
-            target_size=img_size,
-            batch_size=batch_size,
-            class_mode="categorical",
-            subset="validation"
-        )
+    val_cache = cache + ".val" if cache not in ("memory", "none") else cache
+    train_ds = make_dataset(train_paths, train_labels, batch_size, cache=cache, seed=seed)
+    val_ds = make_dataset(val_paths, val_labels, batch_size, cache=val_cache, shuffle=False) if val_paths else None
+    return train_ds, val_ds
+
+
+def train_model(data_dir="data/xrays", batch_size=32, epochs=10, cache="memory", val_split=0.2, shards_dir=None,
+                seed=42):
+    if shards_dir:
+        train_ds, val_ds = make_shard_datasets(shards_dir, batch_size, val_split, seed)
+    else:
+        train_ds, val_ds = make_file_datasets(data_dir, batch_size, cache, val_split, seed)
 
     # Simple CNN
     model = Sequential([
@@ -140,7 +190,7 @@ def train_model():
                   metrics=["accuracy"])
 
     print("Starting model training...")
-    history = model.fit(train_gen, epochs=10, validation_data=val_gen)
+    history = model.fit(train_ds, epochs=epochs, validation_data=val_ds)
 
     # Save model
     os.makedirs("models", exist_ok=True)
@@ -150,4 +200,14 @@ def train_model():
     return model
 
 if __name__ == "__main__":
-    train_model()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Train the imaging CNN.")
+    parser.add_argument("--data-dir", default="data/xrays")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--cache", default="memory",
+                        help="'memory', 'none', or a file path for an on-disk cache of decoded images")
+    parser.add_argument("--val-split", type=float, default=0.2)
+    parser.add_argument("--shards", default=None, help="train from memmap shards built by dataset_shards.py")
+    parser.add_argument("--seed", type=int, default=42, help="seed for the train/validation split and shuffling")
+    args = parser.parse_args()
+    train_model(args.data_dir, args.batch_size, args.epochs, args.cache, args.val_split, args.shards, args.seed)
\ No newline at end of file
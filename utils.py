@@ -1,10 +1,23 @@
 # utils.py
+import csv
+import hashlib
 import math
+import os
+import threading
 import re
 import time
 import json
+from collections import deque, OrderedDict
+from concurrent.futures import Future
 from datetime import datetime
 
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 def now_ts():
     return datetime.now().isoformat()
 
@@ -19,17 +32,311 @@ def haversine_km(lat1, lon1, lat2, lon2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
     return R * c
 
-def deidentify_text(text):
-    # Very simple PII redaction for demo: redact numbers that look like phone/ID
+# The three redaction rules merged into one alternation. Alternatives are tried in the
+# order the rules used to run (emails, then phones, then IDs), which yields exactly the
+# same result as three sequential re.sub passes.
+_PII_PATTERN = re.compile(
+    r'(?P<EMAIL>[\w\.-]+@[\w\.-]+\.\w+)'
+    r'|(?P<PHONE>\b\d{10}\b)'
+    r'|(?P<ID>\b\d{4,}\b)'
+)
+# Every PII match lies inside a run of [\w.@-] chars that holds a digit or an '@'.
+# Searching for those anchors lets the regex engine skip plain prose at C speed.
+_PII_ANCHOR = re.compile(r'[\d@][\w.@-]*')
+_PII_TOKENS = {"EMAIL": "[REDACTED_EMAIL]", "PHONE": "[REDACTED_PHONE]", "ID": "[REDACTED_ID]"}
+_CHUNK_BREAKS = " \n\t\r\f\v"
+
+
+def _redact(text, out, offset=0, audit=None):
+    """Append the redacted form of `text` to `out`, recording spans in `audit` if given."""
+    prev = 0
+    for m in _PII_ANCHOR.finditer(text):
+        start, end = m.span()
+        # Walk back to the start of the run (str.isalnum matches the regex \w set)
+        while start > prev and (text[start - 1].isalnum() or text[start - 1] in "_.@-"):
+            start -= 1
+        if end - start < 4:
+            continue
+        for pm in _PII_PATTERN.finditer(text, start, end):
+            label = pm.lastgroup
+            out.append(text[prev:pm.start()])
+            out.append(_PII_TOKENS[label])
+            prev = pm.end()
+            if audit is not None:
+                audit["spans"].append((offset + pm.start(), offset + prev, label))
+                audit["counts"][label] = audit["counts"].get(label, 0) + 1
+    out.append(text[prev:])
+
+
+def _new_audit():
+    return {"spans": [], "counts": {}}
+
+
+def deidentify_text(text, audit=None):
+    # Very simple PII redaction for demo: redact emails, phone numbers and numeric IDs.
+    # Pass a dict as `audit` to receive the redacted "spans" and per-type "counts".
     if not text:
         return text
-    # remove emails
-    text = re.sub(r'[\w\.-]+@[\w\.-]+\.\w+', '[REDACTED_EMAIL]', text)
-    # remove phone numbers (simple)
-    text = re.sub(r'\b\d{10}\b', '[REDACTED_PHONE]', text)
-    # remove sequences of digits (IDs)
-    text = re.sub(r'\b\d{4,}\b', '[REDACTED_ID]', text)
-    return text
+    if audit is not None:
+        audit.update(_new_audit())
+    out = []
+    _redact(text, out, audit=audit)
+    return "".join(out)
+
+
+def deidentify_stream(chunks, audit=None):
+    """
+    Redact PII from an iterable of text chunks, yielding redacted pieces.
+
+    Text is only emitted up to the last whitespace seen, since no PII match can span
+    whitespace; output joined together equals deidentify_text() on the whole text.
+    Span offsets in `audit` refer to the concatenated input.
+    """
+    if audit is not None:
+        audit.update(_new_audit())
+    pending = ""
+    offset = 0
+    for chunk in chunks:
+        pending += chunk
+        cut = max(pending.rfind(c) for c in _CHUNK_BREAKS) + 1
+        if not cut:
+            continue
+        out = []
+        _redact(pending[:cut], out, offset, audit)
+        offset += cut
+        pending = pending[cut:]
+        yield "".join(out)
+    if pending:
+        out = []
+        _redact(pending, out, offset, audit)
+        yield "".join(out)
+
+class PhraseMatcher:
+    """
+    Aho-Corasick automaton over a fixed list of phrases.
+
+    find() walks the text once and reports every phrase that occurs in it (substring
+    semantics, like `phrase in text`), however many phrases there are.
+    """
+
+    def __init__(self, phrases):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for i, phrase in enumerate(phrases):
+            state = 0
+            for ch in phrase.lower():
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][ch] = nxt
+                state = nxt
+            self._out[state].append(i)
+
+        # Breadth-first pass to set failure links and inherit their outputs
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for ch, nxt in self._goto[state].items():
+                pending.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text):
+        """Return the sorted indices of all phrases found in text (case-insensitive)."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for ch in (text or "").lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return sorted(found)
+
+
+class ClinicalRules:
+    """Keyword rule table (phrase, rule, value) compiled into a single PhraseMatcher."""
+
+    def __init__(self, rules_csv):
+        with open(rules_csv, newline="", encoding="utf-8") as f:
+            self.rules = list(csv.DictReader(f))
+        self.matcher = PhraseMatcher([r["phrase"] for r in self.rules])
+
+    def find(self, text, rule=None):
+        """Matched rule rows for text in table order, optionally only those of one rule type."""
+        hits = [self.rules[i] for i in self.matcher.find(text)]
+        if rule is not None:
+            hits = [r for r in hits if r["rule"] == rule]
+        return hits
+
+
+_clinical_rules = {}
+_clinical_rules_lock = threading.Lock()
+
+
+def load_clinical_rules(rules_csv="data/clinical_rules.csv"):
+    """
+    Shared ClinicalRules for `rules_csv`, rebuilt when the file's mtime or size changes.
+    Agents built after an edit get the new rules; existing ones keep theirs.
+    """
+    st = os.stat(rules_csv)
+    sig = (st.st_mtime_ns, st.st_size)
+    with _clinical_rules_lock:
+        cached = _clinical_rules.get(rules_csv)
+        if cached is None or cached[0] != sig:
+            cached = _clinical_rules[rules_csv] = (sig, ClinicalRules(rules_csv))
+        return cached[1]
+
+
+def percentiles_ms(samples):
+    """p50/p95/p99 of durations in seconds, as milliseconds."""
+    arr = np.array(samples) * 1000.0
+    return {"p50": round(float(np.percentile(arr, 50)), 3),
+            "p95": round(float(np.percentile(arr, 95)), 3),
+            "p99": round(float(np.percentile(arr, 99)), 3)}
+
+
+def file_sha256(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def triage_key(xray_path, pdf_path=None, patient_info=None):
+    """Identity of a triage job: X-ray and PDF content plus the patient payload."""
+    h = hashlib.sha256()
+    for path in (xray_path, pdf_path):
+        try:
+            h.update(file_sha256(path).encode() if path else b"-")
+        except OSError:
+            # Unreadable inputs are keyed by path; the job itself will report the error
+            h.update(str(path).encode())
+    h.update(json.dumps(patient_info, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class SingleFlight:
+    """
+    Runs at most one computation per key at a time. Callers that arrive while it is
+    running wait for it and share its result (or exception) instead of recomputing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Returns (result, leader): leader is True for the caller that actually ran fn."""
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return fut.result(), False
+
+        try:
+            fut.set_result(fn())
+        except BaseException as e:
+            fut.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return fut.result(), True
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by entry count and by approximate size in bytes,
+    with an optional time-to-live. Hit/miss/eviction counters are kept for monitoring.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 << 20, ttl_s=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self._data = OrderedDict()  # key -> (value, nbytes, expires_at)
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes=0):
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            if nbytes > self.max_bytes:
+                return
+            expires = time.monotonic() + self.ttl_s if self.ttl_s else None
+            self._data[key] = (value, nbytes, expires)
+            self.nbytes += nbytes
+            while len(self._data) > self.max_entries or self.nbytes > self.max_bytes:
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        self.nbytes -= self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self.nbytes, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+def to_compact_json(obj):
+    """Compact JSON bytes (no indentation or spaces); uses orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # e.g. integers beyond 64 bits; fall back to the stdlib
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+
+
+def resolve_refs(data, plan):
+    """Event data with the {"$ref": "#/stage/..."} stubs of a slim event log replaced by what they point to."""
+    if isinstance(data, dict):
+        if set(data) == {"$ref"} and str(data["$ref"]).startswith("#/"):
+            obj = plan
+            for part in data["$ref"][2:].split("/"):
+                obj = obj[int(part)] if isinstance(obj, list) else obj[part]
+            return obj
+        return {k: resolve_refs(v, plan) for k, v in data.items()}
+    return data
+
 
 class EventLog:
     def __init__(self):
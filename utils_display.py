@@ -2,20 +2,108 @@
 import streamlit as st
 import plotly.express as px
 
+import html
 import json
+import math
 import re
 
-def colorize_json(data):
-    """Convert dict to JSON with HTML color coding."""
-    text = json.dumps(data, indent=2)
+from utils import LRUCache, resolve_refs
 
-    # Highlight JSON elements
-    #text = re.sub(r'\"(.*?)\"(?=\s*:)', r'<span style="color:#4FC3F7;">"\1"</span>', text)  # Keys
-    text = re.sub(r'\"(.*?)\"', r'<span style="color:#A5D6A7;">"\1"</span>', text)           # Strings
-    text = re.sub(r'\b(\d+)\b', r'<span style="color:#FFB74D;">\1</span>', text)            # Numbers
-    text = re.sub(r'\b(true|false|null)\b', r'<span style="color:#CE93D8;">\1</span>', text, flags=re.IGNORECASE)  # Booleans
+# Strings, literals and numbers, matched in one pass over the JSON text
+_JSON_TOKEN = re.compile(r'("(?:[^"\\]|\\.)*")|\b(true|false|null)\b|(-?\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b)')
+_TOKEN_COLORS = ("#A5D6A7", "#CE93D8", "#FFB74D")  # strings, booleans/null, numbers
 
-    return text
+# Event payloads above this many characters of pretty JSON are cut until expanded
+EVENT_PREVIEW_CHARS = 2000
+_event_html_cache = LRUCache(max_entries=4096, max_bytes=32 << 20)
+
+
+def _colorize_text(text, max_chars=None):
+    hidden = 0
+    if max_chars and len(text) > max_chars:
+        hidden = len(text) - max_chars
+        text = text[:max_chars]
+    out, pos = [], 0
+    for m in _JSON_TOKEN.finditer(text):
+        color = _TOKEN_COLORS[m.lastindex - 1]
+        out.append(html.escape(text[pos:m.start()], quote=False))
+        out.append(f'<span style="color:{color};">{html.escape(m.group(0), quote=False)}</span>')
+        pos = m.end()
+    out.append(html.escape(text[pos:], quote=False))
+    if hidden:
+        out.append(f'\n<span style="color:#718096;">… {hidden:,} more characters</span>')
+    return "".join(out)
+
+
+def colorize_json(data, max_chars=None):
+    """Convert dict to JSON with HTML color coding, optionally cut after max_chars characters."""
+    return _colorize_text(json.dumps(data, indent=2, default=str), max_chars)
+
+
+def event_data_html(event, max_chars=EVENT_PREVIEW_CHARS, cache_key=None):
+    """
+    Colorized HTML for an event's data and whether it was truncated. Streamlit re-runs the
+    whole page on every interaction, so with `cache_key` the result is rendered once and
+    cached. The cache is shared by all sessions: the key must identify this event's
+    payload across them (e.g. a unique run id and the event's index), or be None.
+    """
+    key = (cache_key, max_chars)
+    cached = _event_html_cache.get(key) if cache_key is not None else None
+    if cached is None:
+        text = json.dumps(event.get("data"), indent=2, default=str)
+        cached = (_colorize_text(text, max_chars), bool(max_chars) and len(text) > max_chars)
+        if cache_key is not None:
+            _event_html_cache.put(key, cached, nbytes=len(cached[0]))
+    return cached
+
+
+def paginate(items, page, page_size):
+    """(items on `page`, clamped 1-based page number, page count)."""
+    n_pages = max(1, math.ceil(len(items) / page_size))
+    page = min(max(1, int(page)), n_pages)
+    start = (page - 1) * page_size
+    return items[start:start + page_size], page, n_pages
+
+
+def display_event_log(events, key="audit", page_size=20, plan=None, run_id=None):
+    """
+    Paginated audit log, newest first. Event data is only rendered when the user asks for
+    it; $ref stubs in it are resolved against `plan`, the run's plan. With `run_id`, unique
+    across sessions, rendered data is cached per (run_id, event index).
+    """
+    n_events = len(events)
+    events = events[::-1]
+    col_info, col_page = st.columns([3, 1])
+    with col_page:
+        page = st.number_input("Page", min_value=1, max_value=max(1, math.ceil(len(events) / page_size)),
+                               value=1, step=1, key=f"{key}-page")
+    visible, page, n_pages = paginate(events, page, page_size)
+    with col_info:
+        st.caption(f"{len(events)} events • page {page} of {n_pages}")
+
+    first = (page - 1) * page_size
+    for i, event in enumerate(visible, start=first):
+        st.markdown(f"""
+        <div class="event-log-item">
+            <span class="event-timestamp">{event.get('ts', '')}</span> - 
+            <span class="event-source">[{html.escape(str(event['source']))}]</span>: 
+            <span class="event-message">{html.escape(str(event['message']))}</span>
+        </div>
+        """, unsafe_allow_html=True)
+
+        if event.get("data") and st.checkbox(f"📋 View raw data from [{event['source']}]", key=f"{key}-data-{i}"):
+            if plan is not None:
+                event = dict(event, data=resolve_refs(event["data"], plan))
+            cache_key = (run_id, n_events - 1 - i) if run_id is not None else None
+            body, truncated = event_data_html(event, cache_key=cache_key)
+            if truncated and st.checkbox("Show full payload", key=f"{key}-full-{i}"):
+                body, _ = event_data_html(event, max_chars=None, cache_key=cache_key)
+            st.markdown(f"""
+            <div class="event-expander" style="margin-top: 0.5rem;">
+                <div class="event-expander-content">
+                    <pre style="background-color: #f7fafc; padding: 1rem; border-radius: 0.375rem; overflow-x: auto;">{body}</pre>
+                </div>
+            </div> """, unsafe_allow_html=True)
 
 
 def display_metric_card(title, value, subtitle, color="#2b6cb0"):